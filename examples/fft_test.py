@@ -14,6 +14,7 @@ import os
 import numpy as np
 
 import rdaclient as rc
+import spectral
 
 __author__ = "Dmytro Bielievtsov"
 __email__ = "belevtsoff@gmail.com"
@@ -27,6 +28,7 @@ args = parser.parse_args()
 
 address = ('', 51244)   # server address
 window = 500            # plotting window (samples)
+hop = 50                # distance between consecutive windows (samples)
 channel = args.chan     # channel to plot
 
 real_width = True       # whether to show real band widths
@@ -62,7 +64,7 @@ g = os.popen('gnuplot', 'w')
 
 # set up gnuplot
 print >> g, 'set terminal x11'
-print >> g, 'set yrange [0:250]'
+print >> g, 'set yrange [0:1]'
 
 if real_width:
     print >> g, 'set xrange [0:%s]' % max(gamma)
@@ -71,7 +73,7 @@ else:
     print >> g, 'set xlabel \"delta, alpha, beta, gamma\"'
     print >> g, 'set xrange [0.5:4.5]'
     
-print >> g, 'set ylabel \"power\"'
+print >> g, 'set ylabel \"amplitude (rms)\"'
 print >> g, 'set grid'
 g.flush()
 
@@ -92,33 +94,26 @@ def boxplot(g, data):
     
 
 def run_fft():
-    lastidx = None
-    while client.is_streaming:
-        sig = client.poll(window) # wait for new data
-                
-        if sig is not None:
-            sig = sig[:, channel]
-            
-            # calculate FFT
-            freq = np.fft.fftfreq(len(sig), sample_interval)
-            spec = np.abs(np.fft.fft(sig)) ** 2
-            
-            # integrate
-            bands = np.array([np.sqrt(np.sum(spec[(freq > delta[0]) & (freq <= delta[1])])),
-                              np.sqrt(np.sum(spec[(freq > alpha[0]) & (freq <= alpha[1])])),
-                              np.sqrt(np.sum(spec[(freq > beta[0]) & (freq <= beta[1])])),
-                              np.sqrt(np.sum(spec[(freq > gamma[0]) & (freq <= gamma[1])]))])
-            
-            if not real_width:
-                loc_x = np.arange(1, 5)
-                loc_widths = np.ones(4)
-            else:
-                loc_x = x
-                loc_widths = widths
-            
-            data = np.vstack((loc_x, bands, loc_widths)).T # stack x, y and width in a single matrix
+    # spectra of all channels are calculated at once
+    engine = spectral.SpectralEngine(client.start_msg.nChannels, sampling_freq,
+                                     [delta, alpha, beta, gamma],
+                                     nfft=window, hop=hop)
+    
+    # skip to the latest window, if plotting can't keep up
+    for k, sig, latency in client.iter_windows(window, hop, 'latest'):
+        power = engine.update(sig[np.newaxis])[0, channel]
+        bands = np.sqrt(power)
+        
+        if not real_width:
+            loc_x = np.arange(1, 5)
+            loc_widths = np.ones(4)
+        else:
+            loc_x = x
+            loc_widths = widths
+        
+        data = np.vstack((loc_x, bands, loc_widths)).T # stack x, y and width in a single matrix
 
-            boxplot(g, data) # plot
+        boxplot(g, data) # plot
 
 #------------------------------------------------------------------------------ 
 # Ctrl + C handling
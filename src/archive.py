@@ -0,0 +1,606 @@
+'''
+Compressed recording archives with random access. See archive.ArchiveWriter
+and archive.ArchiveReader docstrings for more information
+
+'''
+
+from multiprocessing import Process, Queue, Event
+from multiprocessing.sharedctypes import RawValue
+from collections import OrderedDict
+from Queue import Empty
+import ctypes as c
+import logging
+import signal
+import struct
+import json
+import zlib
+import bz2
+
+import numpy as np
+
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+__author__ = "Dmytro Bielievtsov"
+__email__ = "belevtsoff@gmail.com"
+
+MAGIC = 'RDAARC01'
+FOOTER = struct.Struct('<Q8s')
+
+# chunk encodings
+RAW = 0
+INT16 = 1
+DELTA = 2
+
+encodings = {'raw': RAW, 'int16': INT16, 'delta': DELTA}
+
+class ArchiveWriter(object):
+    '''
+    Records the client's buffer to a compressed archive. The archive
+    consists of fixed-size chunks, each compressed separately, and an
+    index with the sample range and the file offset of every chunk, so
+    that a part of the recording can be read without decompressing the
+    rest (see `ArchiveReader`).
+
+    The chunks are encoded before compressing:
+
+    * 'int16': the samples are divided by the channel resolutions and
+      stored as 16-bit integers. The RDA data is the amplifier integers
+      multiplied by the resolutions, so this is lossless
+    * 'delta': the same integers, stored as differences between the
+      consecutive samples, which compress better for smooth signals
+    * 'raw': the float32 samples
+
+    A chunk, which can't be encoded losslessly (e.g. the data is
+    filtered, or the integers don't fit), is stored as 'raw'.
+
+    The writing is done by a separate process, which reads the buffer
+    through a cursor, so it doesn't delay the acquisition. If it lags
+    behind by more than the buffer capacity, the lost samples are missing
+    in the archive (see `ArchiveMetrics.nLost`).
+
+    Parameters
+    ----------
+    client : rdaclient.Client
+        a streaming client
+    filename : string
+        archive file name
+    chunkSize : int, optional
+        chunk size (in samples)
+    codec : {'zlib', 'bz2', 'lzma', 'none'}, optional
+        compression codec. 'lzma' requires the lzma module
+    encoding : {'delta', 'int16', 'raw'}, optional
+        chunk encoding
+    level : int, optional
+        compression level
+
+    Attributes
+    ----------
+    metrics : ArchiveMetrics
+        shared metrics
+
+    Examples
+    --------
+    >>> client.start_streaming()
+    >>> writer = ArchiveWriter(client, 'session.rda')
+    >>> writer.start()
+    >>> writer.add_marker(client.last_sample, 'stimulus')
+    >>> writer.stop()
+
+    '''
+    def __init__(self, client, filename, chunkSize=5000, codec='zlib',
+                 encoding='delta', level=6):
+        self.logger = logging.getLogger('archive')
+
+        get_codec(codec)
+        if encoding not in encodings:
+            raise Exception('unknown encoding: %s' % encoding)
+
+        self.client = client
+        self.filename = filename
+        self.chunkSize = chunkSize
+        self.codec = codec
+        self.encoding = encoding
+        self.level = level
+
+        self.metrics = RawValue(ArchiveMetrics)
+
+        self.__markers = Queue()
+        self.__stop = Event()
+        self.__worker = None
+
+    def start(self, position=None, timeout=0.1):
+        '''
+        Spawns the writer process
+
+        Parameters
+        ----------
+        position : int, optional
+            index of the first sample to record. By default, starts from
+            the current write position
+        timeout : float, optional
+            maximum time the writer waits for the new data without checking
+            whether it's stopped (seconds)
+
+        '''
+        client = self.client
+        if client.start_msg is None:
+            raise Exception('nothing to record, start streaming first')
+
+        info = {'nChannels': int(client.start_msg.nChannels),
+                'samplingInterval': client.start_msg.dSamplingInterval,
+                'channelNames': list(client.channel_names),
+                'resolutions': [float(r) for r in client.resolutions],
+                'chunkSize': self.chunkSize,
+                'codec': self.codec}
+
+        self.__stop.clear()
+        self.__worker = Process(target=self.__run,
+                                args=(client.cursor(position), info, timeout))
+        self.__worker.daemon = True
+        self.__worker.start()
+
+    def stop(self):
+        '''
+        Stops the writer process. The buffered data is flushed and the
+        index is written, so the archive is complete only after this call
+
+        '''
+        self.__stop.set()
+        if self.__worker is not None:
+            # the end of the markers, in order with the ones added before
+            self.__markers.put(None)
+            self.__worker.join()
+            self.__worker = None
+
+    def add_marker(self, sample, description, nPoints=1, channel=-1):
+        '''
+        Adds a marker to the archive index
+
+        Parameters
+        ----------
+        sample : int
+            marker position (sample index)
+        description : string
+            marker description
+        nPoints : int, optional
+            marker duration (in samples)
+        channel : int, optional
+            channel index, -1 for all channels
+
+        '''
+        self.__markers.put((int(sample), int(nPoints), int(channel),
+                            str(description)))
+
+    def __run(self, cursor, info, timeout):
+        '''
+        The writer loop
+
+        '''
+        # Ctrl+C is handled by the parent process
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+        compress = get_codec(self.codec)[0]
+        resolutions = np.asarray(info['resolutions'], 'float32')
+        m = self.metrics
+
+        chunks = []
+        markers = []
+        pending = []
+        start = cursor.position
+        ended = False
+
+        f = open(self.filename, 'wb')
+        try:
+            f.write(MAGIC)
+
+            while True:
+                stopping = self.__stop.is_set()
+                data = cursor.read(timeout=0 if stopping else timeout)
+                m.nLost += cursor.nLost
+
+                # a gap: the chunk must be contiguous
+                if cursor.nLost:
+                    self.__write_chunk(f, chunks, start, pending, resolutions,
+                                       compress)
+                    pending = []
+                    start = cursor.position - len(data)
+
+                if len(data):
+                    pending.append(np.array(data))
+
+                # flush the completed chunks, or everything when stopping
+                n = sum(len(p) for p in pending)
+                while n >= self.chunkSize or (stopping and n):
+                    block = np.concatenate(pending)
+                    size = min(n, self.chunkSize)
+                    pending = [block[size:]]
+                    self.__write_chunk(f, chunks, start, [block[:size]],
+                                       resolutions, compress)
+                    start += size
+                    n -= size
+
+                if not ended:
+                    ended = self.__get_markers(markers)
+
+                if stopping and not len(data):
+                    break
+
+            # the markers added right before stop() may be still in transit
+            if not ended:
+                self.__get_markers(markers, block=True)
+
+            # index and footer
+            info['chunks'] = chunks
+            info['markers'] = sorted(markers)
+            offset = f.tell()
+            f.write(json.dumps(info))
+            f.write(FOOTER.pack(offset, MAGIC))
+        finally:
+            f.close()
+
+    def __get_markers(self, markers, block=False):
+        '''
+        Moves the added markers to a list, until there are no more, or, if
+        blocking, until the end sentinel put by stop(). Returns whether
+        the sentinel was received
+
+        '''
+        while True:
+            try:
+                marker = self.__markers.get(block)
+            except Empty:
+                return False
+            if marker is None:
+                return True
+            markers.append(marker)
+
+    def __write_chunk(self, f, chunks, start, pending, resolutions, compress):
+        '''
+        Encodes, compresses and writes a chunk, appending its index entry
+
+        '''
+        if not pending or not sum(len(p) for p in pending):
+            return
+
+        data = np.concatenate(pending)
+        encoding, encoded = encode(data, resolutions, encodings[self.encoding])
+        payload = compress(encoded.tobytes(), self.level)
+
+        chunks.append([start, len(data), f.tell(), len(payload), encoding])
+        f.write(payload)
+
+        m = self.metrics
+        m.nChunks += 1
+        m.nSamples += len(data)
+        m.rawBytes += data.nbytes
+        m.compressedBytes += len(payload)
+
+
+class ArchiveReader(object):
+    '''
+    Reads an archive written by `ArchiveWriter`. Only the chunks covering
+    the requested samples are read and decompressed, the decoded chunks
+    are cached (the least recently used ones are evicted first).
+
+    Parameters
+    ----------
+    filename : string
+        archive file name
+    cacheSize : int, optional
+        maximum number of the cached chunks
+
+    Attributes
+    ----------
+    nChannels : int
+    samplingInterval : float
+        sampling interval (microseconds)
+    channel_names : list of strings
+    resolutions : ndarray
+        channel resolutions (uV)
+    markers : list of tuples
+        (sample, nPoints, channel, description) of the markers
+    chunks : ndarray
+        chunk index, every row is (sampleStart, nSamples, offset, size,
+        encoding)
+
+    '''
+    def __init__(self, filename, cacheSize=16):
+        self.logger = logging.getLogger('archive')
+        self.filename = filename
+        self.cacheSize = cacheSize
+
+        self.__f = open(filename, 'rb')
+        if self.__f.read(len(MAGIC)) != MAGIC:
+            raise Exception('%s is not an archive' % filename)
+
+        self.__f.seek(-FOOTER.size, 2)
+        offset, magic = FOOTER.unpack(self.__f.read(FOOTER.size))
+        if magic != MAGIC:
+            raise Exception('%s has no index (not finalized?)' % filename)
+
+        info = json.loads(self.__read_index(offset))
+
+        self.nChannels = info['nChannels']
+        self.samplingInterval = info['samplingInterval']
+        self.channel_names = [str(name) for name in info['channelNames']]
+        self.resolutions = np.asarray(info['resolutions'], 'float32')
+        self.markers = [(sample, nPoints, channel, str(description))
+                        for sample, nPoints, channel, description in info['markers']]
+        self.chunks = np.asarray(info['chunks'], 'int64').reshape((-1, 5))
+
+        self.__decompress = get_codec(info['codec'])[1]
+        self.__cache = OrderedDict()
+
+    nSamples = property(lambda self: int(self.chunks[-1, 0] + self.chunks[-1, 1])
+                        if len(self.chunks) else 0, None, None,
+                        'Index of the last archived sample + 1, read-only (int)')
+
+    def __read_index(self, offset):
+        '''
+        Reads the index given its offset
+
+        '''
+        self.__f.seek(0, 2)
+        size = self.__f.tell() - FOOTER.size - offset
+        self.__f.seek(offset)
+        return self.__f.read(size)
+
+    def get_data(self, sampleStart, sampleEnd, channels=None, fill=None):
+        '''
+        Gets the archived data
+
+        Parameters
+        ----------
+        sampleStart : int
+            first sample index (included)
+        sampleEnd : int
+            last samples index (excluded)
+        channels : int, slice or sequence of ints, optional
+            channels to select (see `ringbuffer.get_channel_index`)
+        fill : float, optional
+            if given, the samples not archived (see `get_gaps`) are set to
+            this value
+
+        Returns
+        -------
+        data : ndarray
+            data chunk of shape (nSamples, nChannels)
+
+        Raises
+        ------
+        Exception
+            If (part of) the data is not archived and no `fill` is given
+
+        '''
+        starts = self.chunks[:, 0]
+        ends = starts + self.chunks[:, 1]
+        first = np.searchsorted(ends, sampleStart, 'right')
+        last = np.searchsorted(starts, sampleEnd, 'left')
+
+        pieces = []
+        position = sampleStart
+        for i in xrange(first, last):
+            if starts[i] > position:
+                if fill is None:
+                    break
+                pieces.append(self.__fill(starts[i] - position, fill, channels))
+                position = starts[i]
+            chunk = self.__get_chunk(i)
+            piece = chunk[position - starts[i]:min(sampleEnd, ends[i]) - starts[i]]
+            pieces.append(piece if channels is None else piece[:, channels])
+            position += len(piece)
+
+        if position < sampleEnd:
+            if fill is None:
+                raise Exception('samples %s to %s are not archived' %
+                                (position, sampleEnd))
+            pieces.append(self.__fill(sampleEnd - position, fill, channels))
+
+        if not pieces:
+            data = np.empty((0, self.nChannels), 'float32')
+            return data if channels is None else data[:, channels]
+        return pieces[0] if len(pieces) == 1 else np.concatenate(pieces)
+
+    def get_gaps(self, sampleStart, sampleEnd):
+        '''
+        Gets the spans of the given samples, which are not archived (e.g.
+        lost due to the buffer overruns while recording)
+
+        Returns
+        -------
+        gaps : list of tuples
+            (sampleStart, sampleEnd) of the gaps
+
+        '''
+        starts = self.chunks[:, 0]
+        ends = starts + self.chunks[:, 1]
+        first = np.searchsorted(ends, sampleStart, 'right')
+        last = np.searchsorted(starts, sampleEnd, 'left')
+
+        gaps = []
+        position = sampleStart
+        for i in xrange(first, last):
+            if starts[i] > position:
+                gaps.append((position, int(starts[i])))
+            position = max(position, int(ends[i]))
+
+        if position < sampleEnd:
+            gaps.append((position, sampleEnd))
+        return gaps
+
+    def get_markers(self, sampleStart, sampleEnd):
+        '''
+        Gets the markers within the given samples
+
+        Returns
+        -------
+        markers : list of tuples
+            (sample, nPoints, channel, description) of the markers
+
+        '''
+        return [marker for marker in self.markers
+                if sampleStart <= marker[0] < sampleEnd]
+
+    def __fill(self, nSamples, value, channels):
+        '''
+        Creates a data piece filled with a value
+
+        '''
+        piece = np.empty((nSamples, self.nChannels), 'float32')
+        piece.fill(value)
+        return piece if channels is None else piece[:, channels]
+
+    def __get_chunk(self, i):
+        '''
+        Gets a decoded chunk from the cache, or reads it
+
+        '''
+        if i in self.__cache:
+            chunk = self.__cache.pop(i)
+        else:
+            start, n, offset, size, encoding = self.chunks[i]
+            self.__f.seek(offset)
+            raw = self.__decompress(self.__f.read(size))
+            chunk = decode(raw, n, self.nChannels, self.resolutions, encoding)
+            chunk.flags.writeable = False
+
+            if len(self.__cache) >= self.cacheSize:
+                self.__cache.popitem(last=False)
+
+        self.__cache[i] = chunk
+        return chunk
+
+    def reopen(self):
+        '''
+        Reopens the archive file, e.g. in a forked process, which must not
+        share the file offset with its parent
+
+        '''
+        self.__f = open(self.filename, 'rb')
+        self.__cache = OrderedDict()
+
+    def close(self):
+        '''
+        Closes the archive file
+
+        '''
+        self.__f.close()
+
+
+class ArchiveMetrics(c.Structure):
+    '''
+    A ctypes structure with the shared archive writer metrics
+
+    Attributes
+    ----------
+    nChunks : c_ulong
+        number of the written chunks
+    nSamples : c_ulong
+        number of the written samples
+    nLost : c_ulong
+        number of the samples lost due to the buffer overruns
+    rawBytes : c_ulonglong
+        size of the written data before compression (bytes)
+    compressedBytes : c_ulonglong
+        size of the written data after compression (bytes)
+
+    '''
+    _fields_ = [
+                ('nChunks', c.c_ulong),
+                ('nSamples', c.c_ulong),
+                ('nLost', c.c_ulong),
+                ('rawBytes', c.c_ulonglong),
+                ('compressedBytes', c.c_ulonglong)
+                ]
+
+
+def get_codec(codec):
+    '''
+    Gets the compression functions
+
+    Parameters
+    ----------
+    codec : {'zlib', 'bz2', 'lzma', 'none'}
+        codec name
+
+    Returns
+    -------
+    compress, decompress : callables
+        compress(data, level) and decompress(data)
+
+    '''
+    if codec == 'zlib':
+        return zlib.compress, zlib.decompress
+    elif codec == 'bz2':
+        return lambda data, level: bz2.compress(data, max(level, 1)), bz2.decompress
+    elif codec == 'lzma':
+        if lzma is None:
+            raise Exception('lzma codec requires the lzma module')
+        return lambda data, level: lzma.compress(data, preset=level), lzma.decompress
+    elif codec == 'none':
+        return lambda data, level: data, lambda data: data
+    else:
+        raise Exception('unknown codec: %s' % codec)
+
+def encode(data, resolutions, encoding):
+    '''
+    Encodes a chunk, falling back to the other encodings if the requested
+    one is not lossless
+
+    Parameters
+    ----------
+    data : ndarray
+        float32 data of shape (nSamples, nChannels)
+    resolutions : ndarray
+        channel resolutions
+    encoding : int
+        requested encoding (RAW, INT16 or DELTA)
+
+    Returns
+    -------
+    encoding : int
+        actual encoding
+    encoded : ndarray
+
+    '''
+    data = np.asarray(data, 'float32')
+    if encoding == RAW:
+        return RAW, data
+
+    q = np.round(data / resolutions)
+    if not np.array_equal((q * resolutions).astype('float32'), data) or \
+       np.abs(q).max() >= 2 ** 30:
+        return RAW, data
+
+    if encoding == INT16 and np.abs(q).max() < 2 ** 15:
+        return INT16, q.astype('int16')
+
+    # the first sample as is, then the differences
+    q = q.astype('int64')
+    q[1:] -= q[:-1].copy()
+    return DELTA, q.astype('int32')
+
+def decode(raw, nSamples, nChannels, resolutions, encoding):
+    '''
+    Decodes a chunk (see `encode`)
+
+    Returns
+    -------
+    data : ndarray
+        float32 data of shape (nSamples, nChannels)
+
+    '''
+    if encoding == RAW:
+        return np.frombuffer(raw, 'float32').reshape((nSamples, nChannels)).copy()
+
+    if encoding == INT16:
+        q = np.frombuffer(raw, 'int16')
+    else:
+        q = np.cumsum(np.frombuffer(raw, 'int32').reshape((nSamples, nChannels)),
+                      axis=0, dtype='int64')
+
+    q = q.reshape((nSamples, nChannels))
+    return (q * resolutions).astype('float32')
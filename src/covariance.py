@@ -0,0 +1,174 @@
+'''
+Sliding-window spatial covariance matrices, e.g. for Riemannian or CSP
+classifiers. See covariance.CovarianceStage's docstring for more
+information
+
+'''
+
+import numpy as np
+
+import ringbuffer
+import stages
+
+__author__ = "Dmytro Bielievtsov"
+__email__ = "belevtsoff@gmail.com"
+
+class CovarianceStage(stages.Stage):
+    '''
+    A processing stage computing channels x channels covariance matrices of
+    hop-aligned sliding windows incrementally.
+
+    The input is split into blocks of `hop` samples. For every completed
+    block, the sum of samples and the sum of their outer products (block
+    terms) are computed once and stored in the `blocks` buffer. The
+    covariance of the window number k, covering the samples [k*hop,
+    k*hop + nBlocks*hop), is then assembled by adding the newest block
+    terms to the running sum and subtracting the oldest ones. The
+    matrices are written to the output buffer, one flattened (nChannels,
+    nChannels) matrix per window, so that its sample k is the window k.
+
+    Parameters
+    ----------
+    hop : int
+        distance between the starts of consecutive windows (in samples)
+    nBlocks : int, optional
+        window length (in hops)
+    shrinkage : float, optional
+        shrinkage intensity, between 0 and 1. The covariance matrix C is
+        replaced with (1 - shrinkage) * C + shrinkage * trace(C) / nChannels * I
+    resultSize : int, optional
+        capacity of the output buffer (in windows)
+    source : Stage, optional
+        the stage whose output should be processed
+
+    Attributes
+    ----------
+    hop
+    nBlocks
+    shrinkage
+    blocks : RingBuffer
+        block terms, its rows are the concatenated sums of samples
+        (nChannels) and flattened sums of outer products (nChannels x
+        nChannels) of the blocks
+
+    '''
+    def __init__(self, hop, nBlocks=10, shrinkage=0, resultSize=1000, source=None):
+        super(CovarianceStage, self).__init__(source)
+
+        if not 0 <= shrinkage <= 1:
+            raise Exception('shrinkage must be between 0 and 1')
+
+        self.hop = hop
+        self.nBlocks = nBlocks
+        self.shrinkage = shrinkage
+        self.resultSize = resultSize
+        self.blocks = ringbuffer.RingBuffer()
+
+        self.__carry = None
+        self.__sum = None
+
+    def initialize(self, nChannels, samplingFreq, bufSize, windowSize=1):
+        self.nChannels = nChannels
+        self.samplingFreq = samplingFreq
+
+        self.output.initialize(nChannels ** 2, self.resultSize)
+        self.blocks.initialize(nChannels + nChannels ** 2,
+                               max(bufSize // self.hop, self.nBlocks) + self.nBlocks,
+                               self.nBlocks, 'float64')
+
+        self.__carry = np.empty((0, nChannels))
+        self.__sum = np.zeros(nChannels + nChannels ** 2)
+
+    def get_output_channels(self, nChannels):
+        return nChannels ** 2
+
+    def transform(self, data):
+        new = np.concatenate((self.__carry, np.reshape(data, (len(data), -1))))
+        nFull = len(new) // self.hop
+        self.__carry = new[nFull * self.hop:]
+
+        if not nFull:
+            return np.empty((0, self.nChannels ** 2))
+
+        # block terms of the completed blocks
+        x = new[:nFull * self.hop].reshape((nFull, self.hop, -1)).astype('float64')
+        terms = np.hstack((x.sum(1),
+                           np.einsum('bic,bid->bcd', x, x).reshape((nFull, -1))))
+
+        first = self.blocks.nSamplesWritten
+        self.blocks.put_data(terms)
+
+        # running sum over the last nBlocks blocks
+        sums = []
+        for j in xrange(first, first + nFull):
+            self.__sum += terms[j - first]
+            if j >= self.nBlocks:
+                if (j - self.nBlocks) % self.nBlocks:
+                    self.__sum -= self.__get_terms(j - self.nBlocks, terms, first)
+                else:
+                    # re-sum from scratch from time to time to avoid drift
+                    self.__sum = self.blocks.get_data(j - self.nBlocks + 1,
+                                                      j + 1).sum(0)
+            if j >= self.nBlocks - 1:
+                sums.append(self.__sum.copy())
+
+        if not sums:
+            return np.empty((0, self.nChannels ** 2))
+
+        return self.__get_cov(np.array(sums)).reshape((len(sums), -1))
+
+    def __get_terms(self, j, terms, first):
+        '''
+        Gets the block terms of the block j, from the new terms if possible
+
+        '''
+        if j >= first:
+            return terms[j - first]
+        return self.blocks.get_data(j, j + 1)[0]
+
+    def __get_cov(self, sums, nSamples=None):
+        '''
+        Gets the (shrunk) covariance matrices given the sums
+
+        '''
+        n = nSamples or self.nBlocks * self.hop
+        C = self.nChannels
+
+        s1 = sums[:, :C]
+        s2 = sums[:, C:].reshape((-1, C, C))
+        cov = (s2 - s1[:, :, np.newaxis] * s1[:, np.newaxis, :] / n) / (n - 1)
+
+        if self.shrinkage:
+            mu = np.trace(cov, axis1=1, axis2=2) / C
+            cov *= 1 - self.shrinkage
+            cov[:, np.arange(C), np.arange(C)] += self.shrinkage * mu[:, np.newaxis]
+
+        return cov
+
+    def get_covariance(self, firstBlock, nBlocks=None):
+        '''
+        Gets the covariance matrix of an arbitrary hop-aligned window from
+        the stored block terms
+
+        Parameters
+        ----------
+        firstBlock : int
+            index of the first block, the window starts from the sample
+            firstBlock * hop
+        nBlocks : int, optional
+            window length (in hops), defaults to the stage's one
+
+        Returns
+        -------
+        cov : ndarray
+            covariance matrix of shape (nChannels, nChannels)
+
+        Raises
+        ------
+        BufferError
+            If the block terms are not available
+
+        '''
+        nBlocks = nBlocks or self.nBlocks
+        sums = self.blocks.get_data(firstBlock, firstBlock + nBlocks).sum(0)
+        return self.__get_cov(sums[np.newaxis], nBlocks * self.hop)[0]
@@ -0,0 +1,152 @@
+'''
+Multi-resolution min/max/mean decimation of the buffered data, useful for
+displaying long time spans at a fixed cost. See decimation.DecimationPyramid's
+docstring for more information
+
+'''
+
+import numpy as np
+
+import ringbuffer
+import stages
+
+__author__ = "Dmytro Bielievtsov"
+__email__ = "belevtsoff@gmail.com"
+
+class DecimationPyramid(stages.Stage):
+    '''
+    A processing stage maintaining a pyramid of decimated buffers (levels).
+    A sample number b of the level with the decimation factor f summarizes
+    the input samples [b*f, (b+1)*f) with their per-channel minimum,
+    maximum and mean. The buffers are updated incrementally: the first
+    level is computed from the new data block, the subsequent ones - from
+    the newly completed samples of the previous level.
+
+    Every level sample is a row of length 3*nChannels: minimums, maximums
+    and means of all channels.
+
+    Parameters
+    ----------
+    factors : sequence of ints, optional
+        decimation factors of the levels in ascending order. Each factor
+        must be a multiple of the previous one
+    levelSize : int, optional
+        minimum capacity of the level buffers (in samples). By default,
+        every level covers the same time span as the input buffer
+    source : Stage, optional
+        the stage whose output should be decimated
+
+    Attributes
+    ----------
+    factors
+    levels : list of RingBuffer
+        level buffers, the `output` is the first one
+
+    '''
+    def __init__(self, factors=(10, 100, 1000), levelSize=1, source=None):
+        super(DecimationPyramid, self).__init__(source)
+
+        factors = [int(f) for f in factors]
+        ratios = [factors[0]] + [f2 // f1 for f1, f2 in zip(factors[:-1], factors[1:])]
+        if min(ratios) < 1 or any(r * f1 != f2 for r, f1, f2 in
+                                  zip(ratios[1:], factors[:-1], factors[1:])):
+            raise Exception('each factor must be a multiple of the previous one')
+
+        self.factors = factors
+        self.levelSize = levelSize
+        self.levels = [self.output] + [ringbuffer.RingBuffer() for f in factors[1:]]
+
+        self.__ratios = ratios
+        self.__carry = None
+
+    def initialize(self, nChannels, samplingFreq, bufSize, windowSize=1):
+        self.nChannels = nChannels
+        self.samplingFreq = samplingFreq
+
+        for level, f in zip(self.levels, self.factors):
+            level.initialize(3 * nChannels, max(bufSize // f, self.levelSize),
+                             max(windowSize // f, 1))
+
+        # incomplete bucket of every level, in the format of its input
+        self.__carry = [np.empty((0, nChannels))] + \
+                       [np.empty((0, 3 * nChannels)) for f in self.factors[1:]]
+
+    def get_output_channels(self, nChannels):
+        return 3 * nChannels
+
+    def process(self, data):
+        data = np.asarray(data).reshape((len(data), -1))
+        block = None
+
+        for i, (level, ratio) in enumerate(zip(self.levels, self.__ratios)):
+            new = np.concatenate((self.__carry[i], data))
+            nFull = len(new) // ratio
+            self.__carry[i] = new[nFull * ratio:]
+
+            if not nFull:
+                break
+
+            buckets = new[:nFull * ratio].reshape((nFull, ratio, -1))
+
+            if i == 0:
+                data = np.hstack((buckets.min(1), buckets.max(1), buckets.mean(1)))
+            else:
+                n = self.nChannels
+                data = np.hstack((buckets[:, :, :n].min(1),
+                                  buckets[:, :, n:2 * n].max(1),
+                                  buckets[:, :, 2 * n:].mean(1)))
+
+            level.put_data(data.astype(level.nptype))
+            if i == 0:
+                block = data
+
+        if block is None:
+            block = np.empty((0, 3 * self.nChannels))
+        return block
+
+    def query(self, sampleStart, sampleEnd, nPoints):
+        '''
+        Gets the decimated data covering the given span of the input
+        samples from the coarsest level, which still has at least `nPoints`
+        samples there (e.g. the width of a plot in pixels). The cost
+        depends on `nPoints` only, not on the span length.
+
+        Parameters
+        ----------
+        sampleStart : int
+            first input sample index (included)
+        sampleEnd : int
+            last input sample index (excluded)
+        nPoints : int
+            desired minimum number of points
+
+        Returns
+        -------
+        first : int
+            index of the first returned level sample. It covers the input
+            samples starting from first * factor
+        factor : int
+            decimation factor of the chosen level
+        mins, maxs, means : ndarray
+            per-channel minimums, maximums and means of shape
+            (nLevelSamples, nChannels)
+
+        Raises
+        ------
+        BufferError
+            If the data is not available
+
+        '''
+        for level, f in reversed(zip(self.levels, self.factors)):
+            if (sampleEnd - sampleStart) // f >= nPoints:
+                break
+
+        first = -(-sampleStart // f)
+        last = min(sampleEnd // f, level.nSamplesWritten)
+        if last <= first:
+            data = np.empty((0, 3 * self.nChannels), level.nptype)
+        else:
+            data = level.get_data(first, last)
+
+        n = self.nChannels
+        return first, f, data[:, :n], data[:, n:2 * n], data[:, 2 * n:]
@@ -0,0 +1,373 @@
+'''
+Low-latency event detection on the incoming data. See
+events.EventDetector's docstring for more information
+
+'''
+
+from multiprocessing.sharedctypes import RawValue
+import ctypes as c
+import threading
+import logging
+import Queue
+import time
+
+import numpy as np
+
+import stages
+
+__author__ = "Dmytro Bielievtsov"
+__email__ = "belevtsoff@gmail.com"
+
+class EventDetector(object):
+    '''
+    A threshold crossing detector, run by the Streamer as a plugin (see
+    `rdaclient.Client.add_plugin`) right after every data block is written,
+    so only the new samples are evaluated, for all channels at once.
+
+    The detected feature is either the signal itself ('value'), its slope
+    (difference between consecutive samples, 'slope') or its envelope
+    (exponential moving average of the absolute value, 'envelope'). A
+    rising crossing is detected when the feature reaches the threshold,
+    after which the detector is re-armed only when the feature falls to
+    `threshold - hysteresis` (and vice versa for the falling crossings).
+    The detector state is carried across the blocks.
+
+    The callbacks are not called by the Streamer itself: the events are
+    put to a queue and dispatched by a dedicated thread of the Streamer
+    process, so a slow callback doesn't delay the acquisition. Since the
+    callbacks are run in the Streamer process, they must be added before
+    the streaming is started and can only communicate with the main
+    process via the shared memory, pipes, etc.
+
+    The latency of every dispatched event, i.e. the time between the
+    event sample and the start of the callback, is estimated from the
+    block arrival time, as recorded by the Streamer on receiving the
+    block, and the sampling interval (see `get_metrics`). So it includes
+    the time spent in the buffer, the stages and the preceding plugins.
+
+    Parameters
+    ----------
+    threshold : float or array_like
+        common or per-channel threshold
+    channels : int or sequence of ints, optional
+        channels to watch, by default all
+    feature : {'value', 'slope', 'envelope'}, optional
+        detected feature
+    direction : {'rising', 'falling', 'both'}, optional
+        crossing direction
+    hysteresis : float, optional
+        re-arming distance from the threshold
+    refractory : int, optional
+        minimum distance between the events of a channel (in samples)
+    envelope : int, optional
+        time constant of the envelope (in samples)
+    queueSize : int, optional
+        maximum number of the events waiting for dispatching, the newer
+        events are dropped (see `DetectorMetrics.nDropped`)
+
+    Attributes
+    ----------
+    callbacks : list of callables
+        callback(event), where `event` is an `Event`
+    metrics : DetectorMetrics
+        shared metrics
+
+    Examples
+    --------
+    >>> det = EventDetector(50., channels=[0, 1], hysteresis=10.)
+    >>> det.add_callback(lambda event: trigger.send())
+    >>> det.attach(client)
+    >>> client.start_streaming()
+    >>> print det.get_metrics()
+
+    '''
+    def __init__(self, threshold, channels=None, feature='value',
+                 direction='rising', hysteresis=0, refractory=0, envelope=10,
+                 queueSize=100):
+        self.logger = logging.getLogger('events')
+
+        if feature not in ('value', 'slope', 'envelope'):
+            raise Exception('unknown feature: %s' % feature)
+        if direction not in ('rising', 'falling', 'both'):
+            raise Exception('unknown direction: %s' % direction)
+
+        self.threshold = np.asarray(threshold, dtype=float)
+        self.channels = channels if channels is None else np.atleast_1d(channels)
+        self.feature = feature
+        self.direction = direction
+        self.hysteresis = hysteresis
+        self.refractory = refractory
+        self.envelope = envelope
+        self.queueSize = queueSize
+
+        self.callbacks = []
+        self.metrics = RawValue(DetectorMetrics)
+
+        self.__client = None
+        self.__queue = None
+        self.__thread = None
+        self.__interval = None
+
+        # carried state: the last sample, the envelope filter state, the
+        # crossing states and the last event samples
+        self.__last = None
+        self.__zi = None
+        self.__armed = {}
+        self.__lastEvent = None
+
+        alpha = 1. / max(envelope, 1)
+        self.__sos = np.array([[alpha, 0, 0, 1, alpha - 1, 0]])
+
+    def add_callback(self, callback):
+        '''
+        Adds a callback. Must be called before the streaming is started
+
+        '''
+        self.callbacks.append(callback)
+
+    def attach(self, client, budget=1e-3, maxOverruns=10):
+        '''
+        Adds the detector to a client as a plugin
+
+        Parameters
+        ----------
+        client : rdaclient.Client
+            a client, which hasn't started streaming yet
+        budget : float or None, optional
+            time budget per block (seconds)
+        maxOverruns : int, optional
+            number of consecutive budget overruns, after which the detector
+            is disabled
+
+        Returns
+        -------
+        plugin : rdaclient.Plugin
+
+        '''
+        self.__client = client
+        return client.add_plugin(self, budget, maxOverruns,
+                                 name='event detector', arrival=True)
+
+    def __call__(self, data, sampleStart, arrival=None):
+        '''
+        Evaluates a new data block (called by the Streamer). `arrival` is
+        the block arrival time, the current time by default
+
+        '''
+        if arrival is None:
+            arrival = time.time()
+
+        if self.__thread is None:
+            self.__start()
+
+        x = np.asarray(data, dtype=float)
+        if self.channels is not None:
+            x = x[:, self.channels]
+
+        events = self.detect(x, sampleStart)
+        if not events:
+            return
+
+        end = sampleStart + len(x)
+        for sample, channel, direction, value in events:
+            # the sample age at the block arrival
+            age = (end - 1 - sample) * self.__interval
+            event = Event(sample, channel, direction, value, arrival - age)
+            try:
+                self.__queue.put_nowait(event)
+            except Queue.Full:
+                self.metrics.nDropped += 1
+            self.metrics.nEvents += 1
+
+    def detect(self, x, sampleStart):
+        '''
+        Detects the crossings in a new block of the watched channels,
+        updating the detector state
+
+        Parameters
+        ----------
+        x : ndarray
+            data block of shape (nSamples, nWatchedChannels)
+        sampleStart : int
+            index of the first sample of the block
+
+        Returns
+        -------
+        events : list of tuples
+            (sample, channel, direction, value) of the detected events,
+            sorted by sample. The direction is 1 for the rising crossings
+            and -1 for the falling ones
+
+        '''
+        if self.__last is None:
+            self.__last = x[:1].copy()
+            self.__zi = np.zeros((1, 2, x.shape[1]))
+            self.__lastEvent = np.zeros(x.shape[1], int) - self.refractory - 1
+
+        if self.feature == 'slope':
+            y = np.diff(np.concatenate((self.__last, x)), axis=0)
+        elif self.feature == 'envelope':
+            y, self.__zi = stages.sosfilt(self.__sos, np.abs(x), self.__zi)
+        else:
+            y = x
+        self.__last = x[-1:].copy()
+
+        directions = []
+        if self.direction in ('rising', 'both'):
+            directions.append(1)
+        if self.direction in ('falling', 'both'):
+            directions.append(-1)
+
+        found = []
+        for d in directions:
+            # fire at the threshold, re-arm at threshold -/+ hysteresis
+            fire = d * y >= d * self.threshold
+            rearm = d * y < d * self.threshold - self.hysteresis
+
+            armed = self.__armed.get(d)
+            if armed is None:
+                armed = ~fire[0]
+
+            # the state after every sample: forward-filled from the last
+            # sample, where either of the conditions holds
+            decided = fire | rearm
+            idx = np.where(decided, np.arange(1, len(y) + 1)[:, np.newaxis], 0)
+            idx = np.maximum.accumulate(idx, axis=0)
+            states = np.vstack((armed, rearm))[idx, np.arange(y.shape[1])]
+
+            # armed before the sample and fired by it
+            prev = np.vstack((armed, states[:-1]))
+            samples, channels = np.nonzero(prev & fire)
+            found.extend((s, ch, d) for s, ch in zip(samples, channels))
+
+            self.__armed[d] = states[-1]
+
+        found.sort()
+        events = []
+        for s, ch, d in found:
+            sample = sampleStart + s
+            if sample - self.__lastEvent[ch] > self.refractory:
+                self.__lastEvent[ch] = sample
+                channel = ch if self.channels is None else self.channels[ch]
+                events.append((sample, channel, d, y[s, ch]))
+
+        return events
+
+    def __start(self):
+        '''
+        Starts the dispatcher thread in the Streamer process
+
+        '''
+        client = self.__client
+        if client is not None and client.start_msg is not None:
+            self.__interval = client.start_msg.dSamplingInterval / 1e6
+        else:
+            self.__interval = 0.
+
+        self.__queue = Queue.Queue(self.queueSize)
+        self.__thread = threading.Thread(target=self.__dispatch)
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def __dispatch(self):
+        '''
+        The dispatcher loop
+
+        '''
+        m = self.metrics
+        while True:
+            event = self.__queue.get()
+
+            latency = time.time() - event.time
+            m.lastLatency = latency
+            m.maxLatency = max(m.maxLatency, latency)
+            m.totalLatency += latency
+            m.nDispatched += 1
+
+            for callback in self.callbacks:
+                try:
+                    callback(event)
+                except Exception:
+                    self.logger.exception('event callback failed')
+
+    def get_metrics(self):
+        '''
+        Gets the detector metrics
+
+        Returns
+        -------
+        metrics : dict
+            numbers of the detected, dispatched and dropped events, and
+            the last, mean and maximum latency (seconds) between the event
+            sample and the start of its dispatching
+
+        '''
+        m = self.metrics
+        return {'events': m.nEvents,
+                'dispatched': m.nDispatched,
+                'dropped': m.nDropped,
+                'lastLatency': m.lastLatency,
+                'meanLatency': m.totalLatency / max(m.nDispatched, 1),
+                'maxLatency': m.maxLatency}
+
+
+class Event(object):
+    '''
+    A detected event
+
+    Attributes
+    ----------
+    sample : int
+        index of the sample, at which the threshold was crossed
+    channel : int
+        channel index
+    direction : int
+        1 for the rising crossing, -1 for the falling one
+    value : float
+        feature value at the sample
+    time : float
+        estimated acquisition time of the sample (as in time.time())
+
+    '''
+    __slots__ = ('sample', 'channel', 'direction', 'value', 'time')
+
+    def __init__(self, sample, channel, direction, value, time):
+        self.sample = sample
+        self.channel = channel
+        self.direction = direction
+        self.value = value
+        self.time = time
+
+    def __repr__(self):
+        return 'Event(sample=%s, channel=%s, direction=%s, value=%s)' % \
+               (self.sample, self.channel, self.direction, self.value)
+
+
+class DetectorMetrics(c.Structure):
+    '''
+    A ctypes structure with the shared event detector metrics
+
+    Attributes
+    ----------
+    nEvents : c_ulong
+        number of the detected events
+    nDispatched : c_ulong
+        number of the dispatched events
+    nDropped : c_ulong
+        number of the events dropped due to the full queue
+    lastLatency : c_double
+        latency of the last dispatched event (seconds)
+    maxLatency : c_double
+        maximum latency (seconds)
+    totalLatency : c_double
+        sum of the latencies (seconds)
+
+    '''
+    _fields_ = [
+                ('nEvents', c.c_ulong),
+                ('nDispatched', c.c_ulong),
+                ('nDropped', c.c_ulong),
+                ('lastLatency', c.c_double),
+                ('maxLatency', c.c_double),
+                ('totalLatency', c.c_double)
+                ]
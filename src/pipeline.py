@@ -0,0 +1,393 @@
+'''
+Multi-process processing pipelines. See pipeline.Pipeline's docstring for
+more information
+
+'''
+
+from multiprocessing import Process, Condition, Event
+from multiprocessing.sharedctypes import RawValue
+import ctypes as c
+import logging
+import signal
+import time
+
+import ringbuffer
+
+__author__ = "Dmytro Bielievtsov"
+__email__ = "belevtsoff@gmail.com"
+
+class Pipeline(object):
+    '''
+    A chain of processing stages (see `stages.Stage`), each of which runs
+    in its own worker process. Every stage consumes the output buffer of
+    the previous one (the first one - the client's buffer) through a
+    cursor, and writes to its own shared output buffer.
+
+    The workers are woken up by notifications, instead of polling: the
+    Streamer notifies the first stage via a plugin (see
+    `rdaclient.Client.add_plugin`), every stage notifies the next one
+    after writing its output.
+
+    If a stage lags behind, one of the following policies is applied:
+
+    * 'block' (backpressure): the previous stage pauses until the lag
+      drops below `maxLag`. The first stage can't block the acquisition,
+      so its input may be overrun (see `StageMetrics.nLost`)
+    * 'drop': the stage skips the oldest unprocessed samples, so that the
+      lag doesn't exceed `maxLag` (see `StageMetrics.nDropped`). Note,
+      that the stateful stages (e.g. filters) see a discontinuity then
+
+    Parameters
+    ----------
+    client : rdaclient.Client
+        a client, the pipeline should be created before the streaming is
+        started
+
+    Attributes
+    ----------
+    nodes : list of PipelineNode
+        the pipeline nodes in the processing order
+
+    Examples
+    --------
+    >>> pipe = Pipeline(client)
+    >>> filt = pipe.add(stages.FilterStage(sos=sos))
+    >>> decim = pipe.add(decimation.DecimationPyramid((10,)), policy='drop')
+    >>> client.start_streaming()
+    >>> pipe.start()
+    >>> print pipe.get_metrics()
+    >>> pipe.stop()
+
+    '''
+    def __init__(self, client):
+        self.logger = logging.getLogger('pipeline')
+        self.client = client
+        self.nodes = []
+
+        # the Streamer notifies the first stage about every new block
+        self.__notifier = Notifier()
+        try:
+            client.add_plugin(lambda data, sampleStart: self.__notifier.notify(),
+                              budget=None, name='pipeline notifier')
+        except Exception:
+            self.logger.warning('client is already streaming, ' \
+                                'the first stage will poll for the data')
+
+    def add(self, stage, policy='block', maxLag=None, maxChunk=None):
+        '''
+        Adds a stage to the end of the pipeline
+
+        Parameters
+        ----------
+        stage : stages.Stage
+            processing stage
+        policy : {'block', 'drop'}, optional
+            what to do if the stage lags behind by more than `maxLag`
+            samples
+        maxLag : int, optional
+            maximum lag (in samples), by default a half of the input
+            buffer capacity
+        maxChunk : int, optional
+            maximum number of samples processed at once
+
+        Returns
+        -------
+        stage : stages.Stage
+            the same stage, for convenience
+
+        '''
+        if policy not in ('block', 'drop'):
+            raise Exception('unknown lag policy: %s' % policy)
+
+        self.nodes.append(PipelineNode(stage, policy, maxLag, maxChunk))
+        return stage
+
+    def start(self, timeout=0.1):
+        '''
+        Initializes the stages and spawns the workers. The client must be
+        streaming
+
+        Parameters
+        ----------
+        timeout : float, optional
+            maximum time the workers sleep without checking whether the
+            pipeline is stopped (seconds)
+
+        '''
+        client = self.client
+        if client.start_msg is None:
+            raise Exception('nothing to process, start streaming first')
+
+        nChannels = int(client.start_msg.nChannels)
+        samplingFreq = 1e6 / client.start_msg.dSamplingInterval
+        cursor = client.cursor()
+        notifier = self.__notifier
+
+        for i, node in enumerate(self.nodes):
+            node.initialize(cursor, notifier, nChannels, samplingFreq,
+                            client.buffer_size, client.buffer_window)
+
+            if i:
+                self.nodes[i - 1].downstream = node
+
+            # the next stage reads this stage's output
+            stage = node.stage
+            cursor = ringbuffer.Cursor(stage.output, 0)
+            notifier = node.notifier
+            nChannels = stage.output.nChannels
+            samplingFreq = stage.get_output_freq(stage.samplingFreq)
+
+        for node in self.nodes:
+            node.start(timeout)
+
+    def stop(self):
+        '''
+        Stops the workers
+
+        '''
+        for node in self.nodes:
+            node.stop()
+
+    def get_metrics(self):
+        '''
+        Gets the per-stage metrics
+
+        Returns
+        -------
+        metrics : list of dicts
+            metrics of every stage: its name, lag (in samples), throughput
+            (samples per second), busy fraction (time spent processing
+            per second), and the numbers of dropped and lost samples
+
+        '''
+        return [node.get_metrics() for node in self.nodes]
+
+
+class PipelineNode(object):
+    '''
+    A pipeline stage, run in a worker process. Created by `Pipeline.add`
+
+    Attributes
+    ----------
+    stage : stages.Stage
+    policy : string
+    maxLag : int
+    metrics : StageMetrics
+        shared metrics
+    notifier : Notifier
+        notified after the output is written
+    consumed : Notifier
+        notified after the input is consumed
+    downstream : PipelineNode or None
+        the next node
+
+    '''
+    def __init__(self, stage, policy='block', maxLag=None, maxChunk=None):
+        self.logger = logging.getLogger('pipeline')
+        self.stage = stage
+        self.policy = policy
+        self.maxLag = maxLag
+        self.maxChunk = maxChunk
+        self.name = stage.__class__.__name__
+
+        self.metrics = RawValue(StageMetrics)
+        self.notifier = Notifier()
+        self.consumed = Notifier()
+        self.downstream = None
+
+        self.__cursor = None
+        self.__input = None
+        self.__stop = Event()
+        self.__worker = None
+        self.__started = None
+
+    def initialize(self, cursor, notifier, nChannels, samplingFreq, bufSize,
+                   windowSize=1):
+        '''
+        Initializes the stage and its input
+
+        Parameters
+        ----------
+        cursor : ringbuffer.Cursor
+            cursor on the input buffer
+        notifier : Notifier
+            notified when the new input data is available
+        nChannels : int
+            number of input channels
+        samplingFreq : float
+            input sampling frequency (Hz)
+        bufSize : int
+            input (and output) buffer capacity (in samples)
+        windowSize : int, optional
+            output buffer pocket size (in samples)
+
+        '''
+        self.stage.initialize(nChannels, samplingFreq, bufSize, windowSize)
+        self.__cursor = cursor
+        self.__input = notifier
+        self.bufSize = bufSize
+
+        if self.maxLag is None:
+            self.maxLag = bufSize // 2
+
+        self.metrics.position = cursor.position
+
+    def start(self, timeout=0.1):
+        '''
+        Spawns the worker process
+
+        '''
+        self.__stop.clear()
+        self.__started = time.time()
+        self.__worker = Process(target=self.__run, args=(timeout,))
+        self.__worker.daemon = True
+        self.__worker.start()
+
+    def stop(self):
+        '''
+        Stops the worker process
+
+        '''
+        self.__stop.set()
+        if self.__worker is not None:
+            self.__worker.join()
+
+    def get_metrics(self):
+        '''
+        Gets the node metrics (see `Pipeline.get_metrics`)
+
+        '''
+        m = self.metrics
+        elapsed = max(time.time() - (self.__started or time.time()), 1e-9)
+
+        # the local cursor copy is not moved, it only tells how many
+        # samples are written to the input buffer
+        written = self.__cursor.position + self.__cursor.available
+
+        return {'name': self.name,
+                'lag': written - m.position,
+                'throughput': m.nProcessed / elapsed,
+                'busy': m.busyTime / elapsed,
+                'dropped': m.nDropped,
+                'lost': m.nLost}
+
+    def __run(self, timeout):
+        '''
+        The worker loop
+
+        '''
+        # Ctrl+C is handled by the parent process
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+        cursor = self.__cursor
+        m = self.metrics
+        stage = self.stage
+
+        while not self.__stop.is_set():
+            # backpressure from the next stage
+            down = self.downstream
+            if down is not None and down.policy == 'block':
+                down.consumed.wait(lambda: stage.output.nSamplesWritten - \
+                                   down.metrics.position <= down.maxLag, timeout)
+                if stage.output.nSamplesWritten - down.metrics.position > down.maxLag:
+                    continue
+
+            # wait for the new data
+            if not self.__input.wait(lambda: cursor.available > 0, timeout):
+                continue
+
+            if self.policy == 'drop' and cursor.available > self.maxLag:
+                nDropped = cursor.available - self.maxLag
+                cursor.seek(cursor.position + nDropped)
+                m.nDropped += nDropped
+
+            data = cursor.read(self.maxChunk)
+            m.nLost += cursor.nLost
+
+            then = time.time()
+            stage.process(data)
+            m.busyTime += time.time() - then
+
+            m.nProcessed += len(data)
+            m.position = cursor.position
+
+            self.notifier.notify()
+            self.consumed.notify()
+
+
+class Notifier(object):
+    '''
+    An inter-process notification primitive, based on a condition
+    variable. The waiting side checks its predicate (e.g. whether there's
+    new data in a buffer) while holding the lock, so no notifications are
+    lost
+
+    '''
+    def __init__(self):
+        self.__cond = Condition()
+
+    def notify(self):
+        '''
+        Wakes up all the waiting processes
+
+        '''
+        self.__cond.acquire()
+        try:
+            self.__cond.notify_all()
+        finally:
+            self.__cond.release()
+
+    def wait(self, predicate, timeout):
+        '''
+        Waits until the predicate is true or the timeout is over
+
+        Parameters
+        ----------
+        predicate : callable
+            condition to wait for
+        timeout : float
+            timeout (seconds)
+
+        Returns
+        -------
+        result : bool
+            the last value of the predicate
+
+        '''
+        self.__cond.acquire()
+        try:
+            result = predicate()
+            if not result:
+                self.__cond.wait(timeout)
+                result = predicate()
+            return result
+        finally:
+            self.__cond.release()
+
+
+class StageMetrics(c.Structure):
+    '''
+    A ctypes structure with the shared pipeline stage metrics
+
+    Attributes
+    ----------
+    position : c_ulong
+        index of the next input sample to be processed
+    nProcessed : c_ulong
+        number of processed samples
+    nDropped : c_ulong
+        number of samples dropped due to the 'drop' policy
+    nLost : c_ulong
+        number of samples lost due to the input overruns
+    busyTime : c_double
+        total processing time (seconds)
+
+    '''
+    _fields_ = [
+                ('position', c.c_ulong),
+                ('nProcessed', c.c_ulong),
+                ('nDropped', c.c_ulong),
+                ('nLost', c.c_ulong),
+                ('busyTime', c.c_double)
+                ]
+
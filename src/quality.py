@@ -0,0 +1,232 @@
+'''
+Online signal-quality and artifact flagging. See quality.QualityStage's
+docstring for more information
+
+'''
+
+import numpy as np
+
+import stages
+
+__author__ = "Dmytro Bielievtsov"
+__email__ = "belevtsoff@gmail.com"
+
+# quality flags
+FLAT = 1
+CLIPPED = 2
+NOISY = 4
+LINE_NOISE = 8
+JUMP = 16
+UNCHECKED = 32
+ALL = FLAT | CLIPPED | NOISY | LINE_NOISE | JUMP | UNCHECKED
+
+class QualityStage(stages.Stage):
+    '''
+    A processing stage flagging bad channels block-wise as the data is
+    written. The input is split into blocks of `blockSize` samples, all
+    the checks are done for all completed blocks and channels at once.
+    The result is a bitmask per block and channel, written to the output
+    buffer of type uint8, so that its sample b holds the flags of the input
+    samples [b*blockSize, (b+1)*blockSize). A consumer can then reject a
+    window by reading a few bytes (see `get_flags` and `is_clean`) instead
+    of re-analyzing the raw data.
+
+    The flags are:
+
+    * FLAT: peak-to-peak amplitude doesn't exceed `flat`
+    * CLIPPED: absolute amplitude reaches the clipping limit
+    * NOISY: standard deviation exceeds `maxStd`
+    * LINE_NOISE: amplitude of the `lineFreq` component exceeds `maxLine`
+    * JUMP: difference between consecutive samples exceeds `maxJump`
+    * UNCHECKED: (part of) the samples are not checked yet (see
+      `get_flags`)
+
+    The checks with no threshold given (None) are disabled, so by default
+    only the clipping is checked, with the 'auto' limits.
+
+    Parameters
+    ----------
+    blockSize : int
+        block size (in samples)
+    flat : float, optional
+        flatline threshold (uV), e.g. 0 for the exactly flat channels
+    clip : 'auto', float or array_like, optional
+        clipping limits (uV), either common or per-channel. If 'auto', the
+        limits are derived from the channel resolutions as `clipLevel` of
+        the 16-bit amplifier range (32767 * resolution)
+    clipLevel : float, optional
+        fraction of the amplifier range for the 'auto' clipping limits
+    maxStd : float, optional
+        standard deviation threshold (uV)
+    lineFreq : float, optional
+        power line frequency (Hz)
+    maxLine : float, optional
+        line noise amplitude threshold (uV)
+    maxJump : float, optional
+        amplitude jump threshold (uV)
+    source : Stage, optional
+        the stage whose output should be checked
+
+    Attributes
+    ----------
+    blockSize
+    clipLimits : None or ndarray
+        per-channel clipping limits (uV)
+
+    '''
+    def __init__(self, blockSize, flat=None, clip='auto', clipLevel=0.99,
+                 maxStd=None, lineFreq=None, maxLine=None, maxJump=None,
+                 source=None):
+        super(QualityStage, self).__init__(source)
+
+        if (lineFreq is None) != (maxLine is None):
+            raise Exception('both lineFreq and maxLine are required')
+
+        self.blockSize = blockSize
+        self.flat = flat
+        self.clip = clip
+        self.clipLevel = clipLevel
+        self.maxStd = maxStd
+        self.lineFreq = lineFreq
+        self.maxLine = maxLine
+        self.maxJump = maxJump
+        self.clipLimits = None
+
+        self.__carry = None
+        self.__last = None
+        self.__line = None
+
+    def initialize(self, nChannels, samplingFreq, bufSize, windowSize=1):
+        self.nChannels = nChannels
+        self.samplingFreq = samplingFreq
+
+        # every block of the input buffer is covered
+        self.output.initialize(nChannels, bufSize // self.blockSize + 1, 1, 'uint8')
+
+        if self.clip is None:
+            self.clipLimits = None
+        elif isinstance(self.clip, basestring):
+            if self.resolutions is None:
+                self.logger.warning('channel resolutions are unknown, ' \
+                                    'the clipping check is disabled')
+                self.clipLimits = None
+            else:
+                self.clipLimits = self.clipLevel * 32767 * \
+                                  np.asarray(self.resolutions, dtype=float)
+        else:
+            self.clipLimits = np.ones(nChannels) * self.clip
+
+        # complex exponential at the line frequency, scaled to get the
+        # amplitude from a dot product
+        if self.lineFreq is not None:
+            n = np.arange(self.blockSize)
+            self.__line = 2. / self.blockSize * \
+                          np.exp(-2j * np.pi * self.lineFreq / samplingFreq * n)
+
+        self.__carry = np.empty((0, nChannels))
+        self.__last = None
+
+    def transform(self, data):
+        new = np.concatenate((self.__carry, np.reshape(data, (len(data), -1))))
+        nFull = len(new) // self.blockSize
+        self.__carry = new[nFull * self.blockSize:]
+
+        flags = np.zeros((nFull, self.nChannels), 'uint8')
+        if not nFull:
+            return flags
+
+        x = new[:nFull * self.blockSize].reshape((nFull, self.blockSize, -1))
+        x = x.astype('float64')
+
+        if self.flat is not None:
+            flags[x.max(1) - x.min(1) <= self.flat] |= FLAT
+
+        if self.clipLimits is not None:
+            flags[np.abs(x).max(1) >= self.clipLimits] |= CLIPPED
+
+        if self.maxStd is not None or self.__line is not None:
+            centered = x - x.mean(1)[:, np.newaxis]
+
+            if self.maxStd is not None:
+                std = np.sqrt((centered ** 2).mean(1))
+                flags[std > self.maxStd] |= NOISY
+
+            if self.__line is not None:
+                amp = np.abs(np.dot(centered.transpose((0, 2, 1)), self.__line))
+                flags[amp > self.maxLine] |= LINE_NOISE
+
+        if self.maxJump is not None:
+            samples = x.reshape((-1, self.nChannels))
+            prev = samples[:1] if self.__last is None else self.__last
+            jumps = np.abs(np.diff(np.concatenate((prev, samples)), axis=0))
+            flags[jumps.reshape(x.shape).max(1) > self.maxJump] |= JUMP
+            self.__last = samples[-1:]
+
+        return flags
+
+    def get_flags(self, sampleStart, sampleEnd, channels=None):
+        '''
+        Gets the flags of a span of the input samples, combined over all
+        the blocks it overlaps. If the span runs into the blocks not
+        checked yet (e.g. the last, incomplete one), the UNCHECKED flag is
+        set for all the channels
+
+        Parameters
+        ----------
+        sampleStart : int
+            first input sample index (included)
+        sampleEnd : int
+            last input sample index (excluded)
+        channels : int, slice or sequence of ints, optional
+            channels to select (see `ringbuffer.get_channel_index`)
+
+        Returns
+        -------
+        flags : ndarray
+            per-channel flags (bitwise OR over the blocks)
+
+        Raises
+        ------
+        BufferError
+            If the flags are not available anymore
+
+        '''
+        first = sampleStart // self.blockSize
+        end = -(-sampleEnd // self.blockSize)
+        last = min(end, self.output.nSamplesWritten)
+
+        if last <= first:
+            flags = np.zeros((1, self.nChannels), 'uint8')
+            if channels is not None:
+                flags = flags[:, channels]
+        else:
+            flags = self.output.get_data(first, last, channels=channels)
+
+        flags = np.bitwise_or.reduce(flags, 0)
+        if end > last:
+            flags |= UNCHECKED
+        return flags
+
+    def is_clean(self, sampleStart, sampleEnd, mask=ALL, channels=None):
+        '''
+        Checks whether a span of the input samples has none of the given
+        flags (see `get_flags`). By default, the span is not clean unless
+        it's checked completely
+
+        Parameters
+        ----------
+        sampleStart : int
+            first input sample index (included)
+        sampleEnd : int
+            last input sample index (excluded)
+        mask : int, optional
+            flags to check, e.g. FLAT | CLIPPED
+        channels : int, slice or sequence of ints, optional
+            channels to check
+
+        Returns
+        -------
+        clean : bool
+
+        '''
+        return not (self.get_flags(sampleStart, sampleEnd, channels) & mask).any()
@@ -2,12 +2,16 @@
 RDA client classes. See rdaclient.Client's docstring for more information
 '''
 
-from multiprocessing import Process, Queue
+from multiprocessing import Process, Queue, Pool
+from multiprocessing.sharedctypes import RawValue
 from collections import deque
 import signal
 import ctypes as c
 import socket
+import struct
+import os
 import logging
+import json
 import time
 
 import numpy as np
@@ -15,10 +19,15 @@ import numpy as np
 import rdadefs
 import rdatools
 import ringbuffer
+import replay
+import scheduling
 
 __author__ = "Dmytro Bielievtsov"
 __email__ = "belevtsoff@gmail.com"
 
+SNAPSHOT_MAGIC = 'RDASNP01'
+SNAPSHOT_HEADER = struct.Struct('<QQ')
+
 class Client(object):
     '''
     An asynchronous RDA (Remote Data Access) client with buffer. Spawns a
@@ -32,6 +41,25 @@ class Client(object):
         buffer capacity (in samples)
     buffer_window : int, optional
         buffer pocket size (in samples)
+    stats_block : int, optional
+        if positive, the buffer maintains running statistics with the given
+        block size (see `ringbuffer.RingBuffer.initialize`)
+    buffer_layout : {'sample', 'channel'}, optional
+        memory layout of the buffer. Use 'channel' if mostly long chunks
+        of a few channels are read
+    buffer_hugepages : bool, optional
+        whether to back the buffer with huge pages
+    buffer_prefault : bool, optional
+        whether to fault the buffer memory in in the background (see
+        `ringbuffer.allocate`)
+    streamer_cpus : sequence of ints, optional
+        CPUs to pin the Streamer process to
+    streamer_nice : int, optional
+        niceness of the Streamer process
+    streamer_mlock : bool, optional
+        whether the Streamer should lock its memory. The placement is
+        applied where permitted (see `scheduling.apply_placement`), use
+        `scheduling.self_test` to check its effect on the jitter
         
     Attributes
     ----------
@@ -42,13 +70,24 @@ class Client(object):
     start_msg : None or rda_msg_start_full_t
         a start message obtained from the server after the first
         start_streaming() call.
+    channel_names : None or list of strings
+        channel names from the start message
+    resolutions : None or ndarray
+        channel resolutions from the start message (uV)
+    recording : None or recording reader
+        the recording opened by open_recording()
         
     Notes
     -----
     The RDA data sharing is used by the BrainVision software.
     
     '''
-    def __init__(self, buffer_size=300000, buffer_window=1):
+    CLOCK_READ_TRIES = 1000
+    
+    def __init__(self, buffer_size=300000, buffer_window=1, stats_block=0,
+                 buffer_layout='sample', buffer_hugepages=False,
+                 buffer_prefault=False, streamer_cpus=None,
+                 streamer_nice=None, streamer_mlock=False):
         self.logger = logging.getLogger('rdaclient')
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         
@@ -56,11 +95,28 @@ class Client(object):
         self.__buffer_size = buffer_size
         self.__data_dtype = 'float32' # for now
         self.__buffer_window = buffer_window
+        self.__stats_block = stats_block
+        self.__buffer_layout = buffer_layout
+        self.__buffer_hugepages = buffer_hugepages
+        self.__buffer_prefault = buffer_prefault
+        self.__placement = {'cpus': streamer_cpus,
+                            'nice': streamer_nice,
+                            'mlock': streamer_mlock}
         
         self.__streamer = None
+        self.__stages = []
+        self.__plugins = []
+        self.__pool = None
+        self.__clock = RawValue(ClockModel)
+        self.__replay = None
+        self.__buffer_files = []
         self.q = Queue()
         
         self.start_msg = None
+        self.channel_names = None
+        self.resolutions = None
+        self.recording = None
+        self.__channel_idx = {}
     
     def __get_is_streaming(self):
         try:
@@ -75,6 +131,10 @@ class Client(object):
                             'Buffer\'s data type, read-only (string)')
     buffer_window = property(lambda self: self.__buffer_window, None, None,
                             'Buffer pocket size, read-only (in samples)')
+    stages = property(lambda self: list(self.__stages), None, None,
+                            'Processing stages, read-only (list)')
+    plugins = property(lambda self: list(self.__plugins), None, None,
+                            'Streamer plugins, read-only (list)')
     last_sample = property(lambda self: self.__buf.nSamplesWritten, None, None,
                             'Number of a last sample written to the buffer\
                             (= total no.)')
@@ -92,6 +152,49 @@ class Client(object):
         self.sock.connect(destaddr)
         self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
     
+    def open_recording(self, filename, speed=1., blockSize=None, start=0):
+        '''
+        Opens a recording to be replayed instead of connecting to a server.
+        The Streamer then reads the recording block by block and feeds it
+        to the buffer, the stages and the plugins exactly as the online
+        data, so the same code can be validated offline. See
+        `replay.open_recording` for the supported formats
+        
+        The replay is paced by a virtual clock, started by every
+        start_streaming() call: a block is written, when the recording
+        time of its last sample (divided by `speed`) is elapsed. The block
+        arrival times (see `time_of_sample`) are the virtual ones, i.e. the
+        start time plus the recording time, regardless of the speed. The
+        samples missing from the recording (e.g. lost while archiving, see
+        `archive.ArchiveReader.get_gaps`) are replayed as zeros, so that
+        the sample indices stay the same.
+        
+        Parameters
+        ----------
+        filename : string
+            recording file name
+        speed : float or None, optional
+            replay speed multiplier. If None, the data is replayed as fast
+            as possible. Note, that the consumers reading the buffer in
+            other processes may be overrun then, unlike the stages and the
+            plugins, which are run by the Streamer
+        blockSize : int, optional
+            block size (in samples), by default 20 ms of data
+        start : int, optional
+            index of the first sample to replay
+        
+        '''
+        if self.is_streaming:
+            raise Exception('already streaming')
+        
+        self.recording = replay.open_recording(filename)
+        if blockSize is None:
+            blockSize = max(1, int(round(2e4 / self.recording.samplingInterval)))
+        
+        self.__replay = (speed, blockSize, start)
+        self.logger.info('opened recording %s: %s samples' %
+                         (filename, self.recording.nSamples))
+    
     def start_streaming(self, timeout=10):
         '''
         Starts data streaming from the server, using the following algorithm:
@@ -111,6 +214,60 @@ class Client(object):
         if self.is_streaming:
             raise Exception('already streaming')
         
+        if self.__replay is None:
+            self.__receive_start_msg(timeout)
+            
+            if self.__buf.is_initialized and \
+               self.start_msg.nChannels != self.__buf.nChannels:
+                raise Exception('the number of channels has changed')
+        elif self.start_msg is None:
+            rec = self.recording
+            self.start_msg = rdatools.create_start_msg(rec.samplingInterval,
+                                                       rec.resolutions,
+                                                       rec.channel_names)
+            self.channel_names, self.resolutions = \
+                rdatools.get_channel_table(self.start_msg)
+            self.__channel_idx = {}
+        
+        if not self.__buf.is_initialized:
+            self.logger.info('initializing buffer...')
+            self.__buf.initialize(int(self.start_msg.nChannels),
+                                  self.buffer_size,
+                                  self.buffer_window,
+                                  self.data_dtype,
+                                  self.__stats_block,
+                                  self.__buffer_layout,
+                                  self.__buffer_hugepages,
+                                  self.__buffer_prefault)
+            
+            for stage in self.__stages:
+                self.__initialize_stage(stage)
+            
+            for plugin in self.__plugins:
+                plugin.initialize(self.buffer_size)
+        
+        self.logger.info('spawning a streamer process...')
+
+        if self.__replay is None:
+            fd, source = self.sock.fileno(), None
+        else:
+            # resume the replay where it was stopped
+            speed, blockSize, start = self.__replay
+            fd, source = None, (self.recording, speed, blockSize,
+                                start + self.__buf.nSamplesWritten)
+        
+        self.__clock.nominal = self.start_msg.dSamplingInterval / 1e6
+        self.__streamer = Streamer(self.q, fd, self.__buf.raw,
+                                   self.__stages, self.__plugins, self.__clock,
+                                   source, self.__placement)
+        self.__streamer._daemonic = True
+        self.__streamer.start()
+    
+    def __receive_start_msg(self, timeout):
+        '''
+        Waits until start/data message arrives or timeout is over
+        
+        '''
         self.logger.info('waiting for an rda start message...')
         
         hdr = rdadefs.rda_msg_hdr_t()
@@ -126,6 +283,9 @@ class Client(object):
                 
             if hdr.nType == rdadefs.RDA_START_MSG:
                 self.start_msg = rdatools.rda_read_start_msg(self.sock, hdr)
+                self.channel_names, self.resolutions = \
+                    rdatools.get_channel_table(self.start_msg)
+                self.__channel_idx = {}
                 self.logger.info('start message received, ' + \
                                  rdatools.startmsg2string(self.start_msg))
                 break
@@ -137,20 +297,91 @@ class Client(object):
                 self.sock.recv(hdr.nSize - c.sizeof(hdr))
                 self.logger.info('skipped package (type = %s)' % hdr.nType)
             now = time.time()
+    
+    def add_stage(self, stage):
+        '''
+        Adds a processing stage, which is run by the Streamer on every new
+        data block (see `stages.Stage`). The stages are run in the order
+        they were added, so the source stage must be added first. Must be
+        called before the buffer is initialized (first start_streaming()
+        call)
         
+        Parameters
+        ----------
+        stage : stages.Stage
+            processing stage
         
-        if not self.__buf.is_initialized:
-            self.logger.info('initializing buffer...')
-            self.__buf.initialize(int(self.start_msg.nChannels),
-                                  self.buffer_size,
-                                  self.buffer_window,
-                                  self.data_dtype)
+        Returns
+        -------
+        stage : stages.Stage
+            the same stage, for convenience
         
-        self.logger.info('spawning a streamer process...')
-
-        self.__streamer = Streamer(self.q, self.sock.fileno(), self.__buf.raw)
-        self.__streamer._daemonic = True
-        self.__streamer.start()
+        '''
+        if self.__buf.is_initialized:
+            raise Exception('stages must be added before the streaming is started')
+        if stage.source is not None and stage.source not in self.__stages:
+            raise Exception('source stage must be added first')
+        
+        self.__stages.append(stage)
+        return stage
+    
+    def add_plugin(self, callback, budget=1e-3, maxOverruns=10,
+                   outputChannels=None, name=None, arrival=False):
+        '''
+        Adds a plugin, a lightweight callback run by the Streamer right
+        after every data block is written to the buffer (see `Plugin`).
+        Must be called before the buffer is initialized (first
+        start_streaming() call)
+        
+        Parameters
+        ----------
+        callback : callable
+            callback(data, sampleStart), where `data` is the new block and
+            `sampleStart` is the index of its first sample
+        budget : float or None, optional
+            time budget per block (seconds)
+        maxOverruns : int, optional
+            number of consecutive budget overruns, after which the plugin
+            is disabled
+        outputChannels : int, optional
+            if given, an output buffer with this number of channels is
+            allocated, and the values returned by the callback are
+            written to it
+        name : string, optional
+            plugin name, used for logging
+        arrival : bool, optional
+            if True, the callback is called as callback(data, sampleStart,
+            arrival), where `arrival` is the block arrival time (as in
+            time.time())
+        
+        Returns
+        -------
+        plugin : Plugin
+        
+        '''
+        if self.__buf.is_initialized:
+            raise Exception('plugins must be added before the streaming is started')
+        
+        plugin = Plugin(callback, budget, maxOverruns, outputChannels, name,
+                        arrival)
+        self.__plugins.append(plugin)
+        return plugin
+    
+    def __initialize_stage(self, stage):
+        '''
+        Initializes a stage given its source
+        
+        '''
+        if stage.source is None:
+            nChannels = self.__buf.nChannels
+            samplingFreq = 1e6 / self.start_msg.dSamplingInterval
+            stage.resolutions = self.resolutions
+        else:
+            nChannels = stage.source.output.nChannels
+            samplingFreq = stage.source.get_output_freq(stage.source.samplingFreq)
+        
+        stage.initialize(nChannels, samplingFreq, self.buffer_size,
+                         self.buffer_window)
     
     def stop_streaming(self, write_timelog=False):
         '''
@@ -179,9 +410,45 @@ class Client(object):
         Disconnects the client from a server
         
         '''
+        self.close_pool()
         self.sock.close()
+        
+        if self.recording is not None:
+            self.recording.close()
+        
+        self.__remove_buffer_files(0)
     
-    def get_data(self, sampleStart, sampleEnd):
+    def select_channels(self, channels):
+        '''
+        Converts a channel selection to an index to be used on the second
+        axis of the data. The result is cached, so the selection costs a
+        single slicing (or fancy indexing) operation afterwards
+        
+        Parameters
+        ----------
+        channels : int, string or sequence of ints and strings
+            channel selection, e.g. 3, 'C3,Cz,C4', 'EOG*' or ['Cz', 0]
+            (see `rdatools.select_channels`)
+        
+        Returns
+        -------
+        idx : int, slice or ndarray
+            channel index (see `ringbuffer.get_channel_index`)
+        
+        '''
+        if channels is None or isinstance(channels, (int, long, slice)):
+            return channels
+        
+        key = channels if isinstance(channels, basestring) else tuple(channels)
+        try:
+            return self.__channel_idx[key]
+        except KeyError:
+            names = self.channel_names or []
+            idx = ringbuffer.get_channel_index(rdatools.select_channels(names, channels))
+            self.__channel_idx[key] = idx
+            return idx
+    
+    def get_data(self, sampleStart, sampleEnd, channels=None):
         '''
         Gets the data from the buffer. If possible, the data is returned in
         the form of a numpy view on the corresponding chunk (without copy)
@@ -192,18 +459,599 @@ class Client(object):
             first sample index (included)
         sampleEnd : int
             last samples index (excluded)
+        channels : int, string or sequence, optional
+            channels to select (see `select_channels`)
         
         Returns
         -------
         data : ndarray (view or copy) or None
             data chunk or None, if the data is not available
+        
+        Raises
+        ------
+        Exception
+            If a channel is unknown
 
         '''
+        channels = self.select_channels(channels)
         try:
-            return self.__buf.get_data(sampleStart, sampleEnd)
-        except:
+            return self.__buf.get_data(sampleStart, sampleEnd, channels=channels)
+        except ringbuffer.BufferError:
             return None
+
+    def get_windows(self, starts, length, hop=None, nWindows=None, channels=None):
+        '''
+        Gets a batch of windows from the buffer as a single array of shape
+        (nWindows, length, nChannels). If possible, the data is returned in
+        the form of a read-only strided numpy view (without copy). See
+        `ringbuffer.RingBuffer.get_windows` for details
+
+        Parameters
+        ----------
+        starts : int or sequence of ints
+            window start indices (in samples). If `hop` is given, this is
+            the start index of the first window
+        length : int
+            window length (in samples)
+        hop : int, optional
+            distance between the starts of consecutive windows (in samples)
+        nWindows : int, optional
+            number of windows, used together with `hop`
+        channels : int, string or sequence, optional
+            channels to select (see `select_channels`)
+
+        Returns
+        -------
+        data : ndarray (view or copy) or None
+            stacked windows or None, if (part of) the data is not available
+
+        '''
+        try:
+            return self.__buf.get_windows(starts, length, hop, nWindows,
+                                          channels=self.select_channels(channels))
+        except ringbuffer.BufferError:
+            return None
+
+    def get_mean_var(self, sampleStart, sampleEnd):
+        '''
+        Gets the per-channel mean and variance of the given data chunk at a
+        cost independent of its size. Requires the running statistics
+        (see `stats_block`)
+        
+        Parameters
+        ----------
+        sampleStart : int
+            first sample index (included)
+        sampleEnd : int
+            last samples index (excluded)
+        
+        Returns
+        -------
+        (mean, var) : tuple of ndarrays or None
+            per-channel mean and variance or None, if the data is not
+            available
+        
+        '''
+        try:
+            return self.__buf.get_mean_var(sampleStart, sampleEnd)
+        except ringbuffer.BufferError:
+            return None
+    
+    def get_min_max(self, sampleStart, sampleEnd):
+        '''
+        Gets the per-channel minimum and maximum of the given data chunk
+        using the block summary. Requires the running statistics (see
+        `stats_block`)
+        
+        Parameters
+        ----------
+        sampleStart : int
+            first sample index (included)
+        sampleEnd : int
+            last samples index (excluded)
+        
+        Returns
+        -------
+        (min, max) : tuple of ndarrays or None
+            per-channel minimum and maximum or None, if the data is not
+            available
+        
+        '''
+        try:
+            return self.__buf.get_min_max(sampleStart, sampleEnd)
+        except ringbuffer.BufferError:
+            return None
+
+    def get_clock(self):
+        '''
+        Gets the current clock model, a linear mapping between the sample
+        indices and the host time, fitted by the Streamer to the block
+        arrival times (see `time_of_sample`)
+        
+        Returns
+        -------
+        clock : dict or None
+            the model parameters: reference sample index and its time,
+            sampling period (seconds), drift relative to the nominal
+            sampling period (ppm), rms of the arrival time residuals
+            (jitter, seconds), numbers of the fitted and rejected blocks.
+            None, if there's no model yet, or it can't be read (the
+            Streamer died while updating it)
+        
+        '''
+        model = self.__read_clock()
+        if model is None:
+            return None
+        
+        sample, t, period, jitter, nBlocks, nRejected = model
+        return {'sample': sample,
+                'time': t,
+                'period': period,
+                'drift': (period / self.__clock.nominal - 1) * 1e6,
+                'jitter': jitter,
+                'blocks': nBlocks,
+                'rejected': nRejected}
+    
+    def time_of_sample(self, sample):
+        '''
+        Gets the host time (as in time.time()) of a sample using the clock
+        model. The time includes the (mean) transmission latency, i.e. it's
+        the expected arrival time of the sample
+        
+        Parameters
+        ----------
+        sample : int, float or ndarray
+            sample index
+        
+        Returns
+        -------
+        t : float or ndarray or None
+            time (seconds) or None, if there's no clock model yet
+        
+        '''
+        model = self.__read_clock()
+        if model is None:
+            return None
+        
+        s0, t0, period = model[:3]
+        return t0 + (np.asarray(sample, dtype=float) - s0) * period
+    
+    def sample_at_time(self, t):
+        '''
+        Gets the (fractional) sample index at a host time using the clock
+        model (see `time_of_sample`)
+        
+        Parameters
+        ----------
+        t : float or ndarray
+            time (seconds)
+        
+        Returns
+        -------
+        sample : float or ndarray or None
+            sample index or None, if there's no clock model yet
+        
+        '''
+        model = self.__read_clock()
+        if model is None:
+            return None
+        
+        s0, t0, period = model[:3]
+        return s0 + (np.asarray(t, dtype=float) - t0) / period
+    
+    def get_data_by_time(self, t0, t1, channels=None):
+        '''
+        Gets the data of the samples with the host times in [t0, t1) (see
+        `time_of_sample` and `get_data`)
+        
+        Parameters
+        ----------
+        t0 : float
+            start time (included)
+        t1 : float
+            end time (excluded)
+        channels : int, string or sequence, optional
+            channels to select (see `select_channels`)
+        
+        Returns
+        -------
+        data : ndarray (view or copy) or None
+            data chunk or None, if the data is not available. The index of
+            its first sample is int(ceil(sample_at_time(t0)))
+        
+        '''
+        model = self.__read_clock()
+        if model is None:
+            return None
+        
+        s0, tRef, period = model[:3]
+        sampleStart = int(np.ceil(s0 + (t0 - tRef) / period))
+        sampleEnd = int(np.ceil(s0 + (t1 - tRef) / period))
+        return self.get_data(sampleStart, max(sampleStart, sampleEnd), channels)
+    
+    def __read_clock(self):
+        '''
+        Reads a consistent copy of the clock model, which might be updated
+        by the Streamer concurrently (the writer makes the version odd
+        while updating). Returns None, if there's no model yet or it stays
+        inconsistent, e.g. if the Streamer died while updating it
+        
+        '''
+        clock = self.__clock
+        for attempt in xrange(self.CLOCK_READ_TRIES):
+            version = clock.version
+            if version % 2:
+                if not self.is_streaming:
+                    break
+                time.sleep(1e-5)
+                continue
+            model = (clock.sample, clock.time, clock.period, clock.jitter,
+                     clock.nBlocks, clock.nRejected)
+            if clock.version == version:
+                break
+        else:
+            version = 1
+        
+        if version % 2:
+            self.logger.warning('unable to read the clock model')
+            return None
+        
+        if not model[4]:
+            return None
+        return model
+    
+    def save_snapshot(self, filename):
+        '''
+        Saves the buffer contents with the stream description and the
+        clock model to a file, so that a restarted client can continue
+        with the full context (see `restore_snapshot`). The buffer is
+        copied in memory at once and written sequentially, the streaming
+        may continue meanwhile
+        
+        Parameters
+        ----------
+        filename : string
+            snapshot file name
+        
+        '''
+        if not self.__buf.is_initialized:
+            raise Exception('buffer is not initialized, nothing to save')
+        
+        clock = self.__read_clock() or (0, 0, 0, 0, 0, 0)
+        meta = {'samplingInterval': self.start_msg.dSamplingInterval,
+                'channelNames': list(self.channel_names),
+                'resolutions': [float(r) for r in self.resolutions],
+                'clock': list(clock) + [self.__clock.nominal]}
+        
+        raw = self.__buf.snapshot()
+        meta = json.dumps(meta)
+        
+        f = open(filename, 'wb')
+        try:
+            f.write(SNAPSHOT_MAGIC + SNAPSHOT_HEADER.pack(len(meta), len(raw)))
+            f.write(meta)
+            f.write(raw)
+        finally:
+            f.close()
+        
+        self.logger.info('saved a snapshot of %s samples' % self.__buf.nSamplesWritten)
     
+    def restore_snapshot(self, filename):
+        '''
+        Restores the buffer contents, the stream description and the
+        clock model from a snapshot file (see `save_snapshot`). Must be
+        called before the buffer is initialized (first start_streaming()
+        call). The buffer size, pocket, statistics and layout are those of
+        the snapshot. The stages and the plugins are initialized with
+        empty outputs. The new data is appended after the restored one
+        
+        Parameters
+        ----------
+        filename : string
+            snapshot file name
+        
+        '''
+        if self.__buf.is_initialized:
+            raise Exception('buffer is already initialized')
+        
+        f = open(filename, 'rb')
+        try:
+            if f.read(len(SNAPSHOT_MAGIC)) != SNAPSHOT_MAGIC:
+                raise Exception('%s is not a snapshot' % filename)
+            metaSize, rawSize = SNAPSHOT_HEADER.unpack(f.read(SNAPSHOT_HEADER.size))
+            meta = json.loads(f.read(metaSize))
+            
+            # read directly into the new buffer
+            self.__buf.restore(f, rawSize)
+        finally:
+            f.close()
+        
+        buf = self.__buf
+        self.__buffer_size = buf.bufSize
+        self.__buffer_window = buf.pocketSize
+        self.__data_dtype = buf.nptype
+        self.__buffer_layout = buf.layout
+        
+        self.start_msg = rdatools.create_start_msg(meta['samplingInterval'],
+                                                   meta['resolutions'],
+                                                   [str(name) for name in
+                                                    meta['channelNames']])
+        self.channel_names, self.resolutions = \
+            rdatools.get_channel_table(self.start_msg)
+        self.__channel_idx = {}
+        
+        clock = self.__clock
+        (clock.sample, clock.time, clock.period, clock.jitter, clock.nBlocks,
+         clock.nRejected, clock.nominal) = meta['clock']
+        
+        for stage in self.__stages:
+            self.__initialize_stage(stage)
+        
+        for plugin in self.__plugins:
+            plugin.initialize(self.buffer_size)
+        
+        self.logger.info('restored a snapshot of %s samples' % buf.nSamplesWritten)
+    
+    def resize_buffer(self, nSamples, timeout=10, sleep=5e-4):
+        '''
+        Changes the buffer capacity, keeping the last samples (as many as
+        fit). While streaming, the buffer is moved by the Streamer between
+        two data blocks, so that no block is lost, and this call waits
+        until it's done. The readers of the other processes (cursors,
+        pool workers, etc.) switch to the new buffer on their next access
+        (see `ringbuffer.RingBuffer.resize`). The capacity of the stage
+        and plugin outputs stays the same
+        
+        Parameters
+        ----------
+        nSamples : int
+            the new buffer capacity (in samples)
+        timeout : float, optional
+            time to wait for the Streamer (in seconds)
+        sleep : float, optional
+            time to wait until the next check
+        
+        '''
+        if nSamples < self.buffer_window:
+            raise Exception('buffer must be larger than its window')
+        
+        if not self.__buf.is_initialized:
+            self.__buffer_size = nSamples
+            return
+        
+        filename = ringbuffer.create_shared_file('rdaclient-')
+        self.__buffer_files.append(filename)
+        
+        if self.is_streaming:
+            raw = self.__buf.raw
+            self.q.put(('resize', nSamples, filename,
+                        self.__buffer_hugepages, self.__buffer_prefault))
+            
+            then = time.time()
+            self.__buf.follow()
+            while self.__buf.raw is raw:
+                if time.time() - then > timeout or not self.is_streaming:
+                    raise Exception('the buffer was not resized')
+                time.sleep(sleep)
+                self.__buf.follow()
+        else:
+            self.__buf.resize(nSamples, filename, self.__buffer_hugepages,
+                              self.__buffer_prefault)
+        
+        self.__buffer_size = self.__buf.bufSize
+        self.logger.info('resized the buffer to %s samples' % nSamples)
+        
+        # the previous file is kept for the lagging readers
+        self.__remove_buffer_files(2)
+    
+    def __remove_buffer_files(self, nKept):
+        '''
+        Removes the files backing the buffer, except for the last `nKept`.
+        The memory is released when no process maps them anymore
+        
+        '''
+        while len(self.__buffer_files) > nKept:
+            try:
+                os.remove(self.__buffer_files.pop(0))
+            except OSError:
+                pass
+    
+    def cursor(self, position=None, channels=None):
+        '''
+        Creates a new cursor, which returns every new sample written to the
+        buffer exactly once. See `ringbuffer.Cursor` for details
+
+        Parameters
+        ----------
+        position : int, optional
+            index of the first sample to read. By default, only the samples
+            written after this call are read
+        channels : int, string or sequence, optional
+            channels to read (see `select_channels`)
+
+        Returns
+        -------
+        cursor : ringbuffer.Cursor
+
+        '''
+        if not self.__buf.is_initialized:
+            raise Exception('buffer is not initialized, start streaming first')
+
+        return ringbuffer.Cursor(self.__buf, position,
+                                 self.select_channels(channels))
+
+    def iter_windows(self, length, hop, policy='all', first=None, timeout=10,
+                     sleep=5e-4, channels=None):
+        '''
+        Iterates over hop-aligned sliding windows. The window number k
+        covers the samples [k*hop, k*hop + length) and is yielded exactly
+        once, as soon as it is completely written to the buffer. The
+        iteration stops when the streaming stops or no new window is
+        completed within the timeout.
+
+        Parameters
+        ----------
+        length : int
+            window length (in samples)
+        hop : int
+            distance between the starts of consecutive windows (in samples)
+        policy : {'all', 'latest', 'coalesce'}, optional
+            what to do if the consumer lags behind, i.e. several windows
+            are complete at once:
+
+            * 'all': yield all of them one by one
+            * 'latest': skip to the most recent one
+            * 'coalesce': yield all of them at once, stacked along the
+              first axis (see `get_windows`)
+        first : int, optional
+            number of the first window. By default, starts from the first
+            window which is not complete yet
+        timeout : float, optional
+            time to wait for the next window (seconds)
+        sleep : float, optional
+            time to wait until the next loop iteration. Used to avoid
+            100% processor loading.
+        channels : int, string or sequence, optional
+            channels to select (see `select_channels`)
+
+        Yields
+        ------
+        k : int
+            window number (the first one, if coalesced)
+        data : ndarray (view or copy)
+            window of shape (length, nChannels), or a stack of windows of
+            shape (nWindows, length, nChannels) if coalesced
+        latency : float
+            time passed since the last sample of the (first) window
+            arrived (seconds), as given by the clock model (see
+            `time_of_sample`). Until there's a clock model, it's estimated
+            from the number of the samples written since then
+
+        '''
+        if policy not in ('all', 'latest', 'coalesce'):
+            raise Exception('unknown lag policy: %s' % policy)
+
+        if not self.is_streaming:
+            raise Exception('nothing to wait, start streaming first')
+
+        interval = self.start_msg.dSamplingInterval / 1e6 # seconds
+        channels = self.select_channels(channels)
+
+        if first is None:
+            first = max(0, (self.last_sample - length) // hop + 1)
+        k = first
+
+        then = time.time()
+        while self.is_streaming:
+            # wait for the next window to be completed
+            ls = self.last_sample
+            while ls < k * hop + length:
+                if time.time() - then > timeout or not self.is_streaming:
+                    return
+                time.sleep(sleep)
+                ls = self.last_sample
+
+            last = (ls - length) // hop
+
+            # skip the overwritten (or otherwise unavailable) windows
+            oldest = -(-self.__buf.oldestSample // hop)
+            if k < oldest:
+                self.logger.warning('windows %s to %s are overwritten, skipped' %
+                                    (k, oldest - 1))
+                k = oldest
+
+            if policy == 'latest':
+                k = max(k, last)
+
+            if k > last:
+                continue # the first available window is not complete yet
+
+            nWindows = (policy == 'coalesce') and (last - k + 1) or 1
+
+            try:
+                data = self.__buf.get_windows(k * hop, length, hop, nWindows,
+                                              channels=channels)
+            except ringbuffer.BufferError:
+                # overwritten in the meantime, try again
+                if time.time() - then > timeout:
+                    return
+                time.sleep(sleep)
+                continue
+
+            if policy != 'coalesce':
+                data = data[0]
+
+            complete = self.time_of_sample(k * hop + length)
+            if complete is None:
+                latency = (ls - k * hop - length) * interval
+            else:
+                latency = time.time() - complete
+            yield k, data, latency
+
+            then = time.time()
+            k += nWindows
+
+    def map_windows(self, func, windows, workers=None, channels=None):
+        '''
+        Applies a function to a number of data windows in parallel. The
+        windows are processed by a persistent pool of worker processes,
+        attached to the same shared buffer, so that the workers read the
+        data without copies and only the (small) results are transferred
+        back. The pool is created on the first call and reused afterwards
+        (see `close_pool`)
+
+        Parameters
+        ----------
+        func : callable
+            func(data), where data is a window of shape (length, nChannels).
+            Must be picklable (e.g. a module-level function)
+        windows : sequence of (int, int)
+            windows as (sampleStart, sampleEnd) pairs
+        workers : int, optional
+            number of worker processes, by default the number of CPUs
+        channels : int, string or sequence, optional
+            channels to select (see `select_channels`)
+
+        Returns
+        -------
+        results : list
+            results in the order of the windows. The result is None, if
+            the window was not available or was overwritten while queued
+            or processed
+
+        '''
+        if not self.__buf.is_initialized:
+            raise Exception('buffer is not initialized, start streaming first')
+
+        if self.__pool is not None and self.__pool._processes != workers \
+           and workers is not None:
+            self.close_pool()
+
+        if self.__pool is None:
+            self.logger.info('spawning a worker pool...')
+            self.__pool = Pool(workers, _init_pool_worker, (self.__buf.raw,))
+
+        channels = self.select_channels(channels)
+        tasks = [(func, int(i), int(j), channels) for i, j in windows]
+        results = self.__pool.map(_process_window, tasks)
+
+        nOverrun = sum(1 for status, result in results if status)
+        if nOverrun:
+            self.logger.warning('%s of %s windows were not available' %
+                                (nOverrun, len(results)))
+
+        return [result for status, result in results]
+
+    def close_pool(self):
+        '''
+        Terminates the worker pool used by `map_windows`
+
+        '''
+        if self.__pool is not None:
+            self.__pool.terminate()
+            self.__pool.join()
+            self.__pool = None
+
     def wait(self, sampleStart, sampleEnd, timeout=1, sleep=5e-4):
         '''
         Gets the data from the buffer. Blocks if data is not available and
@@ -302,19 +1150,62 @@ class Streamer(Process):
         socket file descriptor (the one which is connected to a server)
     raw : sharectypes char array:
         a raw sharedctypes buffer array.
+    stages : list of stages.Stage, optional
+        initialized processing stages, run on every new data block
+    plugins : list of Plugin, optional
+        initialized plugins, run on every new data block after the stages
+    clock : ClockModel, optional
+        shared clock model, updated on every new data block
+    source : tuple, optional
+        (recording, speed, blockSize, position) of the recording to
+        replay instead of receiving the data (see `Client.open_recording`).
+        The socket file descriptor is ignored then
+    placement : dict, optional
+        CPU placement keyword arguments, applied when the process starts
+        (see `scheduling.apply_placement`)
+    
+    Notes
+    -----
+    The clock model is an exponentially weighted least-squares fit of the
+    block arrival times to the indices of the last samples of the blocks.
+    Once the model has settled, the blocks arriving too early or too late
+    (jitter) are not used for the fit.
     '''
-    def __init__(self, q, fd, raw):
+    # clock model fitting constants: forgetting factor (per block), number
+    # of blocks before the drift is fitted, jitter rejection threshold (in
+    # rms residuals) and the maximum number of consecutive rejections
+    CLOCK_FORGETTING = 0.999
+    CLOCK_WARMUP = 50
+    CLOCK_REJECT = 4.
+    CLOCK_MAX_REJECTED = 20
+    
+    def __init__(self, q, fd, raw, stages=(), plugins=(), clock=None,
+                 source=None, placement=None):
         self.logger = logging.getLogger('data_streamer')
-        self.sock = socket.fromfd(fd, socket.AF_INET, socket.SOCK_STREAM)
+        if source is None:
+            self.sock = socket.fromfd(fd, socket.AF_INET, socket.SOCK_STREAM)
+        else:
+            self.sock = None
+        self.source = source
         self.__buf = ringbuffer.RingBuffer()
         self.__buf.initialize_from_raw(raw)
+        self.stages = list(stages)
+        self.plugins = list(plugins)
+        self.clock = clock
+        self.placement = placement or {}
         self.q = q
         
+        # clock fitting state: reference point, weighted means, covariances
+        # and mean squared residual
+        self.__ref = None
+        self.__fit = None
+        
         self.timelog = deque(maxlen=100000)
         self.timelog_fname = 'streamer_timelog'
         
         # dictionary of known commands
-        self.cmds = {'save_timelog' : self.__save_timelog}
+        self.cmds = {'save_timelog' : self.__save_timelog,
+                     'resize' : self.__resize}
         
         super(Streamer, self).__init__()
        
@@ -334,6 +1225,11 @@ class Streamer(Process):
         # Client process to gracefully stop both the Client and the Streamer
         signal.signal(signal.SIGINT, signal.SIG_IGN)
         
+        scheduling.apply_placement(**self.placement)
+        
+        if self.source is not None:
+            cmd = self.__replay(cmd)
+        
         # stream until there's a stop command
         while cmd != 'stop':
             n = self.sock.recv_into(hdr)
@@ -379,16 +1275,186 @@ class Streamer(Process):
             data message
         
         '''
-        data = np.frombuffer(msg.fData, 'float32')
-        self.__buf.put_data(np.reshape(data, (-1, self.__buf.nChannels)))
         self.timelog.append(time.time())
+        
+        data = np.frombuffer(msg.fData, 'float32')
+        data = np.reshape(data, (-1, self.__buf.nChannels))
+        self.__put_block(data)
+        
         self.logger.debug('put data: rda block #%s, %s samples, time: %.3f' % (msg.nBlock,
                                                                              msg.nPoints,
                                                                              self.timelog[-1]))
     
+    def __put_block(self, data):
+        '''
+        Pushes a data block to the buffer, updates the clock model and runs
+        the stages and the plugins. The block arrival time is the last
+        timelog entry
+        
+        Parameters
+        ----------
+        data : ndarray
+            data block of shape (nSamples, nChannels)
+        
+        '''
+        sampleStart = self.__buf.nSamplesWritten
+        self.__buf.put_data(data)
+        self.__update_clock(sampleStart + len(data), self.timelog[-1])
+        self.__run_stages(data)
+        
+        for plugin in self.plugins:
+            plugin(data, sampleStart, self.timelog[-1])
+    
+    def __replay(self, cmd):
+        '''
+        Replays a recording until it's over or there's a stop command
+        
+        Parameters
+        ----------
+        cmd : string or None
+            the last command
+        
+        Returns
+        -------
+        cmd : string
+            'stop'
+        
+        '''
+        recording, speed, blockSize, position = self.source
+        interval = recording.samplingInterval / 1e6
+        first = position
+        then = time.time()
+        
+        # the file object (and its offset) is shared with the parent
+        recording.reopen()
+        
+        # keep the sample indices of the recording: the samples lost while
+        # recording are replayed as zeros
+        for gapStart, gapEnd in recording.get_gaps(position, recording.nSamples):
+            self.logger.warning('samples %s to %s are not recorded, ' \
+                                'replaying zeros' % (gapStart, gapEnd))
+        
+        while cmd != 'stop' and position < recording.nSamples:
+            end = min(position + blockSize, recording.nSamples)
+            data = np.asarray(recording.get_data(position, end, fill=0),
+                              'float32')
+            
+            # virtual clock
+            elapsed = (end - first) * interval
+            if speed:
+                delay = then + elapsed / speed - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+            
+            self.timelog.append(then + elapsed)
+            self.__put_block(data)
+            position = end
+            
+            cmd = self.__get_cmd()
+        
+        if position >= recording.nSamples:
+            self.logger.info('end of the recording, stopping...')
+        
+        return 'stop'
+    
+    def __update_clock(self, sample, t):
+        '''
+        Updates the clock model with a new block arrival time
+        
+        Parameters
+        ----------
+        sample : int
+            index of the last sample of the block + 1
+        t : float
+            arrival time
+        
+        '''
+        clock = self.clock
+        if clock is None:
+            return
+        
+        if self.__ref is None:
+            # the fit is done relative to the first block, so that the
+            # values stay small
+            self.__ref = (sample, t)
+            self.__fit = [0., 0., 0., 0., 0., 0, 0, 0]
+        
+        x = float(sample - self.__ref[0])
+        y = t - self.__ref[1]
+        W, mx, my, Cxx, Cxy, msr, nRejected, nFitted = self.__fit
+        
+        # the fit is restarted by every Streamer, e.g. after a restart or
+        # a snapshot restore, so the warm-up is counted by the fit itself
+        if nFitted >= self.CLOCK_WARMUP and Cxx > 0:
+            period = Cxy / Cxx
+        else:
+            period = clock.nominal
+        r = y - my - (x - mx) * period
+        
+        if nFitted >= self.CLOCK_WARMUP and \
+           r ** 2 > self.CLOCK_REJECT ** 2 * msr and \
+           nRejected < self.CLOCK_MAX_REJECTED:
+            self.__fit[6] += 1
+            clock.nRejected += 1
+            return
+        
+        lam = self.CLOCK_FORGETTING
+        W = lam * W + 1
+        dx = x - mx
+        mx += dx / W
+        dy = y - my
+        my += dy / W
+        Cxx = lam * Cxx + dx * (x - mx)
+        Cxy = lam * Cxy + dx * (y - my)
+        msr = r ** 2 if not nFitted else 0.99 * msr + 0.01 * r ** 2
+        nFitted += 1
+        self.__fit = [W, mx, my, Cxx, Cxy, msr, 0, nFitted]
+        
+        if nFitted >= self.CLOCK_WARMUP and Cxx > 0:
+            period = Cxy / Cxx
+        
+        # publish the model, the version is odd while updating
+        clock.version += 1
+        clock.sample = self.__ref[0] + mx
+        clock.time = self.__ref[1] + my
+        clock.period = period
+        clock.jitter = np.sqrt(msr)
+        clock.nBlocks += 1
+        clock.version += 1
+    
+    def __run_stages(self, data):
+        '''
+        Runs the processing stages on a new data block
+        
+        Parameters
+        ----------
+        data : ndarray
+            data block
+        
+        '''
+        outputs = {}
+        for stage in self.stages:
+            if not stage.is_enabled:
+                continue
+            if stage.source is None:
+                block = data
+            elif id(stage.source) in outputs:
+                block = outputs[id(stage.source)]
+            else:
+                # the source stage is disabled
+                continue
+            
+            try:
+                outputs[id(stage)] = stage.process(block)
+            except Exception:
+                self.logger.exception('stage %s failed, disabling' %
+                                      stage.__class__.__name__)
+                stage.disable()
+    
     def __get_cmd(self):
         '''
-        Gets the command from the queue
+        Gets the command from the queue. The commands with arguments, i.e.
+        the (command, arg1, ...) tuples, are executed right away
         
         Returns
         -------        
@@ -397,11 +1463,15 @@ class Streamer(Process):
         '''
         try:
             cmd = self.q.get(False)
-            return cmd
         except Exception:
             return None
         
-    def __execute_cmd(self, cmd):
+        if isinstance(cmd, tuple):
+            self.__execute_cmd(*cmd)
+            return None
+        return cmd
+        
+    def __execute_cmd(self, cmd, *args):
         '''
         Executes the command, if it's known
         
@@ -409,13 +1479,26 @@ class Streamer(Process):
         ----------
         cmd : string
             command
+        args : 
+            command arguments
         
         '''
         if self.cmds.has_key(cmd):
             try:
-                self.cmds[cmd]()
+                self.cmds[cmd](*args)
             except:
-                self.logger.warning('unable to execute command %s' % cmd)
+                self.logger.exception('unable to execute command %s' % cmd)
+    
+    def __resize(self, nSamples, filename, hugepages, prefault):
+        '''
+        Moves the buffer to a new one of another capacity (see
+        `Client.resize_buffer`)
+        
+        '''
+        then = time.time()
+        self.__buf.resize(nSamples, filename, hugepages, prefault)
+        self.logger.info('buffer resized to %s samples in %.3f s' %
+                         (nSamples, time.time() - then))
     
     def __save_timelog(self):
         '''
@@ -426,6 +1509,226 @@ class Streamer(Process):
         np.save(self.timelog_fname, np.array(self.timelog))
 
 
+#------------------------------------------------------------------------------ 
+
+class Plugin(object):
+    '''
+    A per-block processing callback, run by the Streamer right after every
+    data block is written to the buffer. Plugins are created with
+    `Client.add_plugin`.
+    
+    The callback should be lightweight and vectorized: it runs in the
+    acquisition path. Every call is timed, and the timing statistics are
+    kept in the shared memory, so that they can be inspected from the
+    Client process. If the callback exceeds its time budget `maxOverruns`
+    times in a row or raises an exception, the plugin is disabled.
+    
+    Parameters
+    ----------
+    callback : callable
+        callback(data, sampleStart), where `data` is the new block and
+        `sampleStart` is the index of its first sample. If the plugin has
+        an output buffer, the returned rows are written to it
+    budget : float or None, optional
+        time budget per block (seconds), None for unlimited
+    maxOverruns : int, optional
+        number of consecutive budget overruns, after which the plugin is
+        disabled
+    outputChannels : int, optional
+        number of channels of the output buffer, no buffer by default
+    name : string, optional
+        plugin name, used for logging
+    arrival : bool, optional
+        whether to pass the block arrival time to the callback, as
+        callback(data, sampleStart, arrival)
+    
+    Attributes
+    ----------
+    is_enabled
+    stats : PluginStats
+        shared timing statistics
+    output : RingBuffer or None
+        the output buffer
+    
+    '''
+    def __init__(self, callback, budget=1e-3, maxOverruns=10,
+                 outputChannels=None, name=None, arrival=False):
+        self.logger = logging.getLogger('plugin')
+        self.callback = callback
+        self.budget = budget
+        self.maxOverruns = maxOverruns
+        self.outputChannels = outputChannels
+        self.name = name or getattr(callback, '__name__', repr(callback))
+        self.arrival = arrival
+        
+        self.stats = RawValue(PluginStats)
+        self.output = outputChannels and ringbuffer.RingBuffer() or None
+    
+    is_enabled = property(lambda self: not self.stats.disabled, None, None,
+                          'Whether the plugin is enabled, read-only (bool)')
+    
+    def initialize(self, bufSize):
+        '''
+        Allocates the output buffer, if needed
+        
+        Parameters
+        ----------
+        bufSize : int
+            output buffer capacity (in samples)
+        
+        '''
+        if self.output is not None:
+            self.output.initialize(self.outputChannels, bufSize)
+    
+    def __call__(self, data, sampleStart, arrival=None):
+        '''
+        Runs the callback, if the plugin is enabled, and updates the
+        statistics
+        
+        '''
+        stats = self.stats
+        if stats.disabled:
+            return
+        
+        then = time.time()
+        try:
+            if self.arrival:
+                out = self.callback(data, sampleStart,
+                                    then if arrival is None else arrival)
+            else:
+                out = self.callback(data, sampleStart)
+            if out is not None and self.output is not None:
+                self.output.put_data(np.asarray(out, self.output.nptype))
+        except Exception:
+            self.logger.exception('plugin %s failed, disabling' % self.name)
+            stats.disabled = 1
+            return
+        elapsed = time.time() - then
+        
+        stats.nCalls += 1
+        stats.totalTime += elapsed
+        stats.lastTime = elapsed
+        stats.maxTime = max(stats.maxTime, elapsed)
+        
+        if self.budget is not None and elapsed > self.budget:
+            stats.nOverruns += 1
+            stats.nConsecutiveOverruns += 1
+            if stats.nConsecutiveOverruns >= self.maxOverruns:
+                self.logger.warning('plugin %s exceeded its time budget ' \
+                                    '(%.2f ms > %.2f ms) %s times in a row, disabling' %
+                                    (self.name, elapsed * 1e3, self.budget * 1e3,
+                                     stats.nConsecutiveOverruns))
+                stats.disabled = 1
+        else:
+            stats.nConsecutiveOverruns = 0
+
+
+class PluginStats(c.Structure):
+    '''
+    A ctypes structure with the plugin timing statistics
+    
+    Attributes
+    ----------
+    nCalls : c_ulong
+        number of calls
+    totalTime : c_double
+        total time spent in the plugin (seconds)
+    lastTime : c_double
+        time spent on the last block (seconds)
+    maxTime : c_double
+        maximum time spent on a block (seconds)
+    nOverruns : c_ulong
+        total number of time budget overruns
+    nConsecutiveOverruns : c_ulong
+        number of the last consecutive overruns
+    disabled : c_int
+        whether the plugin is disabled
+    
+    '''
+    _fields_ = [
+                ('nCalls', c.c_ulong),
+                ('totalTime', c.c_double),
+                ('lastTime', c.c_double),
+                ('maxTime', c.c_double),
+                ('nOverruns', c.c_ulong),
+                ('nConsecutiveOverruns', c.c_ulong),
+                ('disabled', c.c_int)
+                ]
+
+
+class ClockModel(c.Structure):
+    '''
+    A ctypes structure with the shared clock model: the time of a sample
+    s is time + (s - sample) * period
+    
+    Attributes
+    ----------
+    version : c_ulong
+        incremented before and after every update
+    sample : c_double
+        reference sample index
+    time : c_double
+        host time of the reference sample (seconds)
+    period : c_double
+        fitted sampling period (seconds)
+    nominal : c_double
+        nominal sampling period (seconds)
+    jitter : c_double
+        rms of the arrival time residuals (seconds)
+    nBlocks : c_ulong
+        number of the fitted blocks
+    nRejected : c_ulong
+        number of the blocks rejected due to the jitter
+    
+    '''
+    _fields_ = [
+                ('version', c.c_ulong),
+                ('sample', c.c_double),
+                ('time', c.c_double),
+                ('period', c.c_double),
+                ('nominal', c.c_double),
+                ('jitter', c.c_double),
+                ('nBlocks', c.c_ulong),
+                ('nRejected', c.c_ulong)
+                ]
+
+
+#------------------------------------------------------------------------------ 
+# map_windows worker functions
+
+_pool_buf = None
+
+def _init_pool_worker(raw):
+    '''
+    Attaches a pool worker to the shared buffer
+
+    '''
+    global _pool_buf
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    _pool_buf = ringbuffer.RingBuffer()
+    _pool_buf.initialize_from_raw(raw)
+
+def _process_window(task):
+    '''
+    Processes a window in a pool worker. Returns an error code (0 if OK)
+    and the result
+
+    '''
+    func, sampleStart, sampleEnd, channels = task
+    try:
+        data = _pool_buf.get_data(sampleStart, sampleEnd, channels=channels)
+    except ringbuffer.BufferError as e:
+        return e.code, None
+
+    result = func(data)
+
+    # the data might be overwritten while processing
+    e = _pool_buf.check_availablility(sampleStart, sampleEnd)
+    if e:
+        return e, None
+    return 0, result
+
+
 #------------------------------------------------------------------------------ 
 
 logging.basicConfig(level=logging.INFO, format='[%(process)-5d:%(threadName)-10s] %(name)s: %(levelname)s: %(message)s')
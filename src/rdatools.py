@@ -4,6 +4,7 @@ Some useful tools to work with BrainVision RDA (Remote Data Access) API
 '''
 
 from ctypes import *
+import fnmatch
 
 import numpy as np
 
@@ -127,14 +128,111 @@ def startmsg2string(msg):
     
     '''
     string = '%d channels: \n' % msg.nChannels
-    sChannelNames = ubyte2string(msg.sChannelNames).split('\x00')
-    dResolutions = np.frombuffer(msg.dResolutions, dtype=np.double)
+    sChannelNames, dResolutions = get_channel_table(msg)
     
     for chName, chRes in zip(sChannelNames, dResolutions):
         string += chName + ': %s uV\n' % chRes
     
     return string
 
+def get_channel_table(msg):
+    '''
+    Parses channel names and resolutions from an RDA start message
+    
+    Parameters
+    ----------
+    msg : rda_msg_start_full_t:
+        RDA start message
+    
+    Returns
+    -------
+    names : list of strings
+        channel names
+    resolutions : ndarray
+        channel resolutions (uV)
+    
+    '''
+    names = ubyte2string(msg.sChannelNames).split('\x00')[:msg.nChannels]
+    resolutions = np.frombuffer(msg.dResolutions, dtype=np.double).copy()
+    
+    return names, resolutions
+
+def create_start_msg(samplingInterval, resolutions, names):
+    '''
+    Creates an RDA start message, e.g. to describe a recording
+    
+    Parameters
+    ----------
+    samplingInterval : float
+        sampling interval (microseconds)
+    resolutions : sequence of floats
+        channel resolutions (uV)
+    names : sequence of strings
+        channel names
+    
+    Returns
+    -------
+    msg : rda_msg_start_full_t
+        RDA start message
+    
+    '''
+    nChannels = len(names)
+    sChannelNames = ''.join([name + '\x00' for name in names])
+    
+    msg = rda.rda_msg_start_t.full(nChannels, len(sChannelNames))()
+    msg.hdr.guid = rda.RDA_GUID
+    msg.hdr.nSize = sizeof(msg)
+    msg.hdr.nType = rda.RDA_START_MSG
+    msg.nChannels = nChannels
+    msg.dSamplingInterval = samplingInterval
+    msg.dResolutions[:] = [float(r) for r in resolutions]
+    memmove(msg.sChannelNames, sChannelNames, len(sChannelNames))
+    
+    return msg
+
+def select_channels(names, spec):
+    '''
+    Gets channel indices given a channel selection
+    
+    Parameters
+    ----------
+    names : list of strings
+        channel names
+    spec : int, string or sequence of ints and strings
+        channel selection. The strings may contain several comma
+        separated channel names or shell-style wildcards, e.g.
+        'C3,Cz,C4' or 'EOG*'. Integers are channel indices
+    
+    Returns
+    -------
+    idx : list of ints
+        channel indices in the order of selection
+    
+    '''
+    if isinstance(spec, basestring):
+        spec = spec.split(',')
+    elif not hasattr(spec, '__iter__'):
+        spec = [spec]
+    
+    idx = []
+    for item in spec:
+        if not isinstance(item, basestring):
+            idx.append(int(item))
+            continue
+        
+        item = item.strip()
+        if item in names:
+            idx.append(names.index(item))
+            continue
+        
+        matches = [i for i, name in enumerate(names)
+                   if fnmatch.fnmatchcase(name, item)]
+        if not matches:
+            raise Exception('unknown channel: %s' % item)
+        idx.extend(matches)
+    
+    return idx
+
 def ubyte2string(array):
     '''
     Converts a ctypes ubyte array to string
@@ -148,7 +246,7 @@ def ubyte2string(array):
     string
     
     '''
-    return ''.join([chr(b) for b in array])
+    return string_at(addressof(array), sizeof(array))
 
 def check_received(n, msg):
     '''
@@ -0,0 +1,251 @@
+'''
+Recording readers for the offline replay (see
+`rdaclient.Client.open_recording`). See replay.BrainVisionReader's
+docstring for more information
+
+'''
+
+import logging
+import os
+
+import numpy as np
+
+import archive
+
+__author__ = "Dmytro Bielievtsov"
+__email__ = "belevtsoff@gmail.com"
+
+# BrainVision binary formats
+binary_formats = {'IEEE_FLOAT_32': 'float32',
+                  'INT_16': 'int16',
+                  'UINT_16': 'uint16',
+                  'INT_32': 'int32'}
+
+class BrainVisionReader(object):
+    '''
+    Reads a BrainVision recording (.vhdr header, .eeg data and .vmrk
+    markers). The data file is memory-mapped, so only the requested
+    samples are read from the disk. Only the multiplexed binary data is
+    supported.
+
+    The reader has the same interface as `archive.ArchiveReader`.
+
+    Parameters
+    ----------
+    filename : string
+        header (.vhdr) file name
+
+    Attributes
+    ----------
+    nChannels : int
+    nSamples : int
+    samplingInterval : float
+        sampling interval (microseconds)
+    channel_names : list of strings
+    resolutions : ndarray
+        channel resolutions (uV)
+    markers : list of tuples
+        (sample, nPoints, channel, description) of the markers, the
+        channel is -1 for the markers related to all channels
+
+    '''
+    def __init__(self, filename):
+        self.logger = logging.getLogger('replay')
+        self.filename = filename
+
+        header = read_ini(filename)
+        common = header.get('Common Infos', {})
+        binary = header.get('Binary Infos', {})
+        path = os.path.dirname(os.path.abspath(filename))
+
+        if common.get('DataFormat', 'BINARY').upper() != 'BINARY' or \
+           common.get('DataOrientation', 'MULTIPLEXED').upper() != 'MULTIPLEXED':
+            raise Exception('only multiplexed binary data is supported')
+
+        fmt = binary.get('BinaryFormat', 'INT_16').upper()
+        if fmt not in binary_formats:
+            raise Exception('unsupported binary format: %s' % fmt)
+
+        self.nChannels = int(common['NumberOfChannels'])
+        self.samplingInterval = float(common['SamplingInterval'])
+
+        # channel table: Ch<n>=<name>,<reference>,<resolution>,<unit>
+        channels = header.get('Channel Infos', {})
+        self.channel_names = []
+        self.resolutions = np.ones(self.nChannels)
+        for i in xrange(self.nChannels):
+            fields = channels.get('Ch%s' % (i + 1), str(i + 1)).split(',')
+            self.channel_names.append(fields[0].replace('\\1', ','))
+            if len(fields) > 2 and fields[2].strip():
+                self.resolutions[i] = float(fields[2])
+
+        self.__dataFile = (os.path.join(path, common['DataFile']),
+                           binary_formats[fmt])
+        self.reopen()
+        self.nSamples = len(self.__data)
+
+        self.markers = []
+        if 'MarkerFile' in common:
+            self.markers = read_markers(os.path.join(path, common['MarkerFile']))
+
+    def get_data(self, sampleStart, sampleEnd, channels=None, fill=None):
+        '''
+        Gets the recorded data
+
+        Parameters
+        ----------
+        sampleStart : int
+            first sample index (included)
+        sampleEnd : int
+            last samples index (excluded)
+        channels : int, slice or sequence of ints, optional
+            channels to select (see `ringbuffer.get_channel_index`)
+        fill : float, optional
+            if given, the samples not recorded (see `get_gaps`) are set to
+            this value
+
+        Returns
+        -------
+        data : ndarray
+            data chunk of shape (nSamples, nChannels) (uV)
+
+        Raises
+        ------
+        Exception
+            If (part of) the data is not recorded and no `fill` is given
+
+        '''
+        gaps = self.get_gaps(sampleStart, sampleEnd)
+        if gaps and fill is None:
+            raise Exception('samples %s to %s are not recorded' %
+                            (sampleStart, sampleEnd))
+
+        start = min(max(sampleStart, 0), self.nSamples)
+        end = max(min(sampleEnd, self.nSamples), start)
+        data = self.__data[start:end]
+        resolutions = self.resolutions
+        if channels is not None:
+            data = data[:, channels]
+            resolutions = resolutions[channels]
+
+        data = (data * resolutions).astype('float32')
+        if gaps:
+            before = max(start - sampleStart, 0)
+            after = sampleEnd - sampleStart - before - len(data)
+            data = np.concatenate((np.zeros((before,) + data.shape[1:], 'float32') + fill,
+                                   data,
+                                   np.zeros((after,) + data.shape[1:], 'float32') + fill))
+        return data
+
+    def get_gaps(self, sampleStart, sampleEnd):
+        '''
+        Gets the spans of the given samples, which are not recorded
+
+        Returns
+        -------
+        gaps : list of tuples
+            (sampleStart, sampleEnd) of the gaps
+
+        '''
+        gaps = []
+        if sampleStart < 0:
+            gaps.append((sampleStart, min(sampleEnd, 0)))
+        if sampleEnd > self.nSamples:
+            gaps.append((max(sampleStart, self.nSamples), sampleEnd))
+        return gaps
+
+    def get_markers(self, sampleStart, sampleEnd):
+        '''
+        Gets the markers within the given samples
+
+        Returns
+        -------
+        markers : list of tuples
+            (sample, nPoints, channel, description) of the markers
+
+        '''
+        return [marker for marker in self.markers
+                if sampleStart <= marker[0] < sampleEnd]
+
+    def reopen(self):
+        '''
+        Maps the data file again, e.g. in a forked process
+
+        '''
+        filename, dtype = self.__dataFile
+        data = np.memmap(filename, dtype, 'r')
+        data = data[:len(data) // self.nChannels * self.nChannels]
+        self.__data = data.reshape((-1, self.nChannels))
+
+    def close(self):
+        '''
+        Closes the data file
+
+        '''
+        self.__data = None
+
+
+def open_recording(filename):
+    '''
+    Opens a recording given its file name: a BrainVision header (.vhdr)
+    or an archive (see `archive.ArchiveReader`)
+
+    Parameters
+    ----------
+    filename : string
+        recording file name
+
+    Returns
+    -------
+    recording : BrainVisionReader or archive.ArchiveReader
+
+    '''
+    if os.path.splitext(filename)[1].lower() == '.vhdr':
+        return BrainVisionReader(filename)
+    return archive.ArchiveReader(filename)
+
+def read_ini(filename):
+    '''
+    Reads a BrainVision ini-like file (.vhdr or .vmrk)
+
+    Returns
+    -------
+    sections : dict
+        {section: {key: value}}
+
+    '''
+    sections = {}
+    section = None
+    for line in open(filename, 'rU'):
+        line = line.strip()
+        if not line or line.startswith(';'):
+            continue
+        if line.startswith('[') and line.endswith(']'):
+            section = sections.setdefault(line[1:-1], {})
+        elif section is not None and '=' in line:
+            key, value = line.split('=', 1)
+            section[key.strip()] = value.strip()
+    return sections
+
+def read_markers(filename):
+    '''
+    Reads a BrainVision marker (.vmrk) file
+
+    Returns
+    -------
+    markers : list of tuples
+        (sample, nPoints, channel, description) of the markers, sorted by
+        sample. The description is the marker description or, if empty,
+        its type
+
+    '''
+    markers = []
+    for key, value in read_ini(filename).get('Marker Infos', {}).items():
+        # Mk<n>=<type>,<description>,<position>,<points>,<channel>[,<date>]
+        fields = value.split(',')
+        if not key.startswith('Mk') or len(fields) < 5:
+            continue
+        description = fields[1].replace('\\1', ',') or fields[0]
+        markers.append((int(fields[2]) - 1, int(fields[3]),
+                        int(fields[4]) - 1, description))
+    return sorted(markers)
@@ -4,7 +4,9 @@ Provides a two-dimensional circular buffer with homogeneous elements
 See other classes' docstrings for more information:
 
 * `RingBuffer`: the buffer
+* `Cursor`: incremental reader
 * `datatypes`: supported datatypes
+* `layouts`: supported memory layouts
 * `BufferHeader`: header structure
 * `BufferError`: error definition
     
@@ -12,9 +14,16 @@ See other classes' docstrings for more information:
 
 from multiprocessing import Array
 import ctypes as c
+import ctypes.util
+import threading
+import tempfile
 import logging
+import mmap
+import time
+import os
 
 import numpy as np
+from numpy.lib.stride_tricks import as_strided
 
 __author__ = "Dmytro Bielievtsov"
 __email__ = "belevtsoff@gmail.com"
@@ -38,6 +47,8 @@ class RingBuffer(object):
     bufSize
     pocketSize
     nptype
+    layout
+    oldestSample
     raw
     writePtr
     
@@ -45,6 +56,7 @@ class RingBuffer(object):
     --------
     initialize: allocate new buffer
     initialize_from_raw: use another buffer's raw array
+    resize: move to a new raw array of another capacity
     
     Notes
     -----
@@ -70,6 +82,13 @@ class RingBuffer(object):
     second - already in the beginning. This might be useful when reading
     the data with a sliding window.
     
+    The data and pocket sections are stored either sample-major (the
+    samples are contiguous, default) or channel-major (every channel is
+    contiguous, followed by its own part of the pocket). In both cases,
+    the data is accessed as (nSamples, nChannels) arrays, but reading
+    long chunks of a few channels is much more cache-friendly with the
+    channel-major layout.
+    
     '''
     def __init__(self):
         self.logger = logging.getLogger('ringbuffer')
@@ -112,8 +131,11 @@ class RingBuffer(object):
     #------------------------------------------------------------------------------
     # Properties    
     
-    # number of written samples
+    # number of written samples. Every access checks whether the buffer
+    # has been moved to a new array (see resize)
     def __get_nsamples(self):
+        if self.__hdr.moved:
+            self.follow()
         return self.__hdr.nSamplesWritten
     def __set_nsamples(self, value):
         self.__hdr.nSamplesWritten = value
@@ -134,10 +156,17 @@ class RingBuffer(object):
                         'Size of the buffer pocket in samples, read-only (int)')
     nptype = property(lambda self: self.__nptype, None, None,
                         'The type of the data in the buffer, read-only (string)')
+    layout = property(lambda self: self.__layout, None, None,
+                        'Memory layout of the data, read-only (string)')
+    oldestSample = property(lambda self: max(self.nSamplesWritten - self.bufSize,
+                                             self.__hdr.firstSample, 0),
+                        None, None, 'Index of the oldest available sample, read-only (int)')
     
     #------------------------------------------------------------------------------
     
-    def initialize(self, nChannels, nSamples, windowSize=1, nptype='float32'):
+    def initialize(self, nChannels, nSamples, windowSize=1, nptype='float32',
+                   statsBlockSize=0, layout='sample', hugepages=False,
+                   prefault=False, filename=None):
         '''
         Initializes the buffer with a new raw array
         
@@ -152,6 +181,19 @@ class RingBuffer(object):
             data. The pocket of the this size will be created
         nptype : string, optional
             the type of the data to be stored
+        statsBlockSize : int, optional
+            if positive, running statistics are maintained alongside the
+            data: prefix sums for the mean and variance, and per-block
+            minimums and maximums for the blocks of this size (in
+            samples). See `get_mean_var` and `get_min_max`
+        layout : {'sample', 'channel'}, optional
+            memory layout of the data: sample-major or channel-major
+        hugepages : bool, optional
+            whether to back the buffer with huge pages (see `allocate`)
+        prefault : bool, optional
+            whether to fault the buffer pages in in the background
+        filename : string, optional
+            file to back the buffer with (see `allocate`)
                            
         '''
         self.__initialized = True
@@ -167,20 +209,28 @@ class RingBuffer(object):
             self.logger.warning('wondowSize must be a positive integer, setting to 1')
             windowSize = 1
         
+        layoutCode = layouts.get_code(layout)
+        if statsBlockSize < 0:
+            self.logger.warning('statsBlockSize must be non-negative, setting to 0')
+            statsBlockSize = 0
+        
         # initializing
         sizeBytes = c.sizeof(BufferHeader) + \
-                    (nSamples + windowSize) * nChannels * np.dtype(nptype).itemsize
+                    (nSamples + windowSize) * nChannels * np.dtype(nptype).itemsize + \
+                    get_stats_size(nChannels, nSamples, statsBlockSize)
         
-        raw = Array('c', sizeBytes)
-        hdr = BufferHeader.from_buffer(raw.get_obj())
+        raw = allocate(sizeBytes, hugepages, prefault, filename)
+        hdr = BufferHeader.from_buffer(raw)
         
         hdr.bufSizeBytes = nSamples * nChannels * np.dtype(nptype).itemsize
         hdr.pocketSizeBytes = windowSize * nChannels * np.dtype(nptype).itemsize
         hdr.dataType = datatypes.get_code(nptype)
         hdr.nChannels = nChannels
         hdr.nSamplesWritten = 0
+        hdr.statsBlockSize = statsBlockSize
+        hdr.layout = layoutCode
         
-        self.initialize_from_raw(raw.get_obj())
+        self.initialize_from_raw(raw)
     
     def initialize_from_raw(self, raw):
         '''
@@ -205,19 +255,207 @@ class RingBuffer(object):
         bufSizeFlat = hdr.bufSizeBytes / np.dtype(nptype).itemsize
         pocketSizeFlat = hdr.pocketSizeBytes / np.dtype(nptype).itemsize
          
-        # create numpy view objects pointing to the raw array
+        # create numpy view objects pointing to the raw array. The data
+        # view spans both the data and the pocket sections, so that the
+        # chunks running into the pocket can be sliced directly
         self.__raw = raw
         self.__hdr = hdr
-        self.__buf = np.frombuffer(raw, nptype, bufSizeFlat, bufOffset)\
-                                          .reshape((-1, hdr.nChannels))
-        self.__pocket = np.frombuffer(raw, nptype, pocketSizeFlat, pocketOffset)\
-                                                   .reshape((-1, hdr.nChannels))
+        self.__layout = layouts.get_type(hdr.layout)
+        
+        if self.__layout == 'sample':
+            self.__buf = np.frombuffer(raw, nptype, bufSizeFlat + pocketSizeFlat,
+                                       bufOffset).reshape((-1, hdr.nChannels))
+            self.__pocket = np.frombuffer(raw, nptype, pocketSizeFlat, pocketOffset)\
+                                                       .reshape((-1, hdr.nChannels))
+        else:
+            # (nChannels, nSamples) storage, accessed through the transposed
+            # view. Writing a block thus transposes it in a single operation
+            self.__buf = np.frombuffer(raw, nptype, bufSizeFlat + pocketSizeFlat,
+                                       bufOffset).reshape((hdr.nChannels, -1)).T
+            self.__pocket = self.__buf[bufSizeFlat / hdr.nChannels:]
         
         # helper variables
         self.__nChannels = hdr.nChannels
-        self.__bufSize = len(self.__buf)
+        self.__bufSize = bufSizeFlat / hdr.nChannels
         self.__pocketSize = len(self.__pocket)
         self.__nptype = nptype
+        
+        # statistics section views
+        self.__statsBlockSize = hdr.statsBlockSize
+        if hdr.statsBlockSize:
+            statsOffset = pocketOffset + hdr.pocketSizeBytes
+            nSums = 2 * (self.__bufSize + 1) * hdr.nChannels
+            nBlocks = get_stats_nblocks(self.__bufSize, hdr.statsBlockSize)
+            
+            # prefix sums and sums of squares, restarted every bufSize
+            # samples (epoch), so that they stay small. For the epoch k,
+            # i.e. k*bufSize < n <= (k+1)*bufSize, sums[:, n % (bufSize + 1)]
+            # are the sums of (x - refs[k % 2]) over the samples [k*bufSize, n)
+            self.__sums = np.frombuffer(raw, 'float64', nSums, statsOffset)\
+                                        .reshape((2, -1, hdr.nChannels))
+            # block minimums and maximums: extrema[:, j % nBlocks] are the
+            # extrema of the samples [j*statsBlockSize, (j+1)*statsBlockSize)
+            self.__extrema = np.frombuffer(raw, 'float64', 2 * nBlocks * hdr.nChannels,
+                                           statsOffset + 8 * nSums)\
+                                           .reshape((2, -1, hdr.nChannels))
+            # the reference values of the last two epochs: their first
+            # samples
+            self.__refs = np.frombuffer(raw, 'float64', 2 * hdr.nChannels,
+                                        statsOffset + 8 * (nSums + 2 * nBlocks * hdr.nChannels))\
+                                        .reshape((2, hdr.nChannels))
+    
+    def resize(self, nSamples, filename, hugepages=False, prefault=False):
+        '''
+        Moves the buffer to a new raw array of another capacity, keeping
+        the last samples (as many as fit) and their statistics. The kept
+        samples are copied in at most three contiguous chunks.
+        
+        The new array is backed by a file (see `allocate`), so that the
+        other processes can map it as well: the old header is marked as
+        moved, and every buffer object still pointing to the old array
+        switches to the new one on its next access. Must be called by the
+        (only) writer between the writes
+        
+        Parameters
+        ----------
+        nSamples : int
+            the new capacity in samples
+        filename : string
+            new, empty file to back the array with (see
+            `create_shared_file`)
+        hugepages, prefault : bool, optional
+            see `allocate`
+        
+        '''
+        if len(filename) >= BufferHeader.movedTo.size:
+            raise Exception('file name is too long: %s' % filename)
+        
+        nWritten = self.nSamplesWritten
+        
+        new = RingBuffer()
+        new.initialize(self.nChannels, nSamples, self.pocketSize, self.nptype,
+                       self.__statsBlockSize, self.layout, hugepages, prefault,
+                       filename)
+        
+        sampleStart = max(nWritten - min(nWritten, new.bufSize, self.bufSize),
+                          self.__hdr.firstSample)
+        new.nSamplesWritten = sampleStart
+        
+        # the samples before the copied ones are not available, even if
+        # the new buffer is larger
+        new.__hdr.firstSample = sampleStart
+        new.__hdr.maxChunk = self.__hdr.maxChunk
+        while sampleStart < nWritten:
+            # the chunk mustn't wrap around in either of the buffers
+            sampleEnd = min(nWritten,
+                            (sampleStart // self.bufSize + 1) * self.bufSize,
+                            (sampleStart // new.bufSize + 1) * new.bufSize)
+            new.put_data(self.get_data(sampleStart, sampleEnd))
+            sampleStart = sampleEnd
+        
+        # the file name is published before the flag
+        self.__hdr.movedTo = filename
+        self.__hdr.moved = 1
+        
+        self.initialize_from_raw(new.raw)
+    
+    def follow(self):
+        '''
+        Switches to the array the buffer has been moved to, if any (see
+        `resize`). Done automatically on every nSamplesWritten access
+        
+        Raises
+        ------
+        BufferError
+            If the new array is not available anymore
+        
+        '''
+        if not self.__hdr.moved:
+            return
+        
+        while self.__hdr.moved:
+            try:
+                raw = attach(self.__hdr.movedTo)
+            except EnvironmentError:
+                raise BufferError(9)
+            self.initialize_from_raw(raw)
+        
+        self.logger.info('buffer moved, new capacity: %s samples' % self.bufSize)
+    
+    def snapshot(self):
+        '''
+        Gets a consistent copy of the raw array (header, data and
+        statistics), e.g. to be saved to a file. The array is copied with a
+        single memory copy while the buffer is being written to; the
+        samples written during the copy are then re-written to the copy, so
+        that it's the exact state of the buffer after some write.
+        
+        A write might be in progress when the copy is finished, so the
+        oldest samples of the copy, as many as the largest write (or the
+        pocket size) might be overwritten. They are marked as unavailable
+        in the copy (see `oldestSample`)
+        
+        Returns
+        -------
+        snapshot : bytearray
+            copy of the raw array
+        
+        Raises
+        ------
+        BufferError
+            If the buffer is overrun during the copy
+        
+        '''
+        nSamples = self.nSamplesWritten
+        size = c.sizeof(self.__raw)
+        
+        snapshot = bytearray(size)
+        raw = (c.c_char * size).from_buffer(snapshot)
+        c.memmove(raw, self.__raw, size)
+        
+        # the header of the copy is the state before the copy
+        copy = RingBuffer()
+        copy.initialize_from_raw(raw)
+        copy.nSamplesWritten = nSamples
+        
+        while True:
+            sampleEnd = self.nSamplesWritten
+            
+            # the samples being written (up to the margin) mustn't reach
+            # the ones still to be copied
+            margin = max(self.__hdr.maxChunk, self.pocketSize)
+            if sampleEnd + margin - copy.nSamplesWritten > self.bufSize:
+                raise BufferError(8)
+            if sampleEnd == copy.nSamplesWritten:
+                break
+            copy.put_data(self.get_data(copy.nSamplesWritten, sampleEnd))
+        
+        hdr = BufferHeader.from_buffer(raw)
+        hdr.firstSample = max(hdr.firstSample, sampleEnd - self.bufSize + margin)
+        
+        return snapshot
+    
+    def restore(self, snapshot, sizeBytes=None):
+        '''
+        Initializes the buffer with a new raw array holding a copy of a
+        snapshot (see `snapshot`)
+        
+        Parameters
+        ----------
+        snapshot : str, bytearray or file
+            raw array copy, or a file to read it from
+        sizeBytes : int, optional
+            the copy size, required if the copy is read from a file
+        
+        '''
+        if hasattr(snapshot, 'readinto'):
+            raw = allocate(sizeBytes)
+            if snapshot.readinto(raw) != sizeBytes:
+                raise Exception('the snapshot is truncated')
+        else:
+            raw = allocate(len(snapshot))
+            np.frombuffer(raw, 'uint8')[:] = np.frombuffer(snapshot, 'uint8')
+        self.initialize_from_raw(raw)
     
     def __get_local_idx(self, startIdx, endIdx, nocheck=False):
         '''
@@ -259,6 +497,10 @@ class RingBuffer(object):
         if localStartIdx == localEndIdx == 0:
             return localStartIdx, self.bufSize
         
+        # contiguous chunk, up to the end of the data section
+        if localEndIdx == 0 and 0 < chunkSize <= self.bufSize:
+            return localStartIdx, self.bufSize
+        
         # contiguous chunk
         if (localEndIdx - localStartIdx) > 0:
             return localStartIdx, localEndIdx
@@ -353,12 +595,13 @@ class RingBuffer(object):
             return 5
         if sampleEnd > self.nSamplesWritten:
             return 3 # data is not ready
-        if (self.nSamplesWritten - sampleStart) > self.bufSize:
+        if (self.nSamplesWritten - sampleStart) > self.bufSize or \
+           sampleStart < self.__hdr.firstSample:
             return 2 # data is already erased
         
         return 0
     
-    def get_data(self, sampleStart, sampleEnd, wprotect=True):
+    def get_data(self, sampleStart, sampleEnd, wprotect=True, channels=None):
         '''
         Gets the data from the buffer. If possible, the data is returned
         in the form of a numpy view on the corresponding chunk (without
@@ -372,6 +615,12 @@ class RingBuffer(object):
             last samples index (excluded)
         wprotect : bool, optional
             protect returned views from occasional writes
+        channels : int, slice or sequence of ints, optional
+            channels to select. A single channel, a slice or an evenly
+            spaced sequence of channels is selected without copy (with
+            the channel-major layout, every selected channel is then
+            contiguous in memory). Other sequences are selected with
+            fancy indexing (copy). By default, all channels are returned
         
         Returns
         -------        
@@ -385,9 +634,91 @@ class RingBuffer(object):
         '''
         idx = self.__get_local_idx(sampleStart, sampleEnd)
         data = self.__read_buffer(idx)
+        if channels is not None:
+            data = data[:, get_channel_index(channels)]
         data.setflags(write=not wprotect)
         return data
+
+    def get_windows(self, starts, length, hop=None, nWindows=None, wprotect=True,
+                    channels=None):
+        '''
+        Gets a batch of equally sized windows from the buffer as a single
+        three-dimensional array of shape (nWindows, length, nChannels).
+        If the windows are evenly spaced and the whole range they cover
+        is contiguous (or fits into the pocket), the result is a strided
+        numpy view on the buffer (without copy). Otherwise, the windows
+        are gathered with a single fancy-indexing operation (copy).
+
+        Parameters
+        ----------
+        starts : int or sequence of ints
+            window start indices (in samples). If `hop` is given, this is
+            the start index of the first window
+        length : int
+            window length (in samples)
+        hop : int, optional
+            distance between the starts of consecutive windows (in
+            samples)
+        nWindows : int, optional
+            number of windows, used together with `hop`. By default, as
+            many windows as currently available are returned
+        wprotect : bool, optional
+            protect returned copies from occasional writes. Strided views
+            are always read-only, since their windows may overlap
+        channels : int, slice or sequence of ints, optional
+            channels to select (see `get_data`)
+
+        Returns
+        -------
+        data : ndarray (view or copy)
+            windows stacked along the first axis
+
+        Raises
+        ------
+        BufferError
+            If (part of) the data is not available
+
+        '''
+        if hop is not None:
+            if nWindows is None:
+                nWindows = max(0, (self.nSamplesWritten - starts - length) // hop + 1)
+            starts = starts + hop * np.arange(nWindows)
+        else:
+            starts = np.asarray(starts, dtype=int).ravel()
+
+        chIdx = slice(None) if channels is None else get_channel_index(channels)
         
+        if len(starts) == 0:
+            return np.empty((0, length, self.nChannels), self.nptype)[:, :, chIdx]
+
+        # availability check for the whole batch at once
+        first, last = starts.min(), starts.max() + length
+        e = self.check_availablility(first, last)
+        if e: raise BufferError(e)
+
+        steps = np.diff(starts)
+        uniform = len(steps) == 0 or (steps[0] > 0 and (steps == steps[0]).all())
+
+        # strided view (contiguous or pocketed chunk)
+        localStart = first % self.bufSize
+        if uniform and localStart + last - first <= self.bufSize + self.pocketSize:
+            chunk = self.__buf[localStart:localStart + last - first]
+            step = len(steps) and steps[0]
+            data = as_strided(chunk,
+                              shape=(len(starts), length, self.nChannels),
+                              strides=(step * chunk.strides[0],) + chunk.strides)
+            data.setflags(write=False)
+            data = data[:, :, chIdx]
+            if isinstance(chIdx, np.ndarray):
+                data.setflags(write=not wprotect)
+            return data
+
+        # vectorized gather (copy)
+        data = self.__buf[(starts[:, np.newaxis] + np.arange(length)) % self.bufSize]
+        data = data[:, :, chIdx]
+        data.setflags(write=not wprotect)
+        return data
+
     def put_data(self, data):
         '''
         Pushes the data to the buffer
@@ -412,8 +743,369 @@ class RingBuffer(object):
         
         idx = self.__get_local_idx(sampleStart, sampleEnd, nocheck=True)
         self.__write_buffer(data.reshape(datashape)[sampleStart - sampleEnd :], idx)
-        import time; time.sleep(0.001)
+        
+        if self.__statsBlockSize:
+            self.__write_stats(data.reshape(datashape), sampleEnd)
+        
+        if len(data) > self.__hdr.maxChunk:
+            self.__hdr.maxChunk = len(data)
+        
         self.nSamplesWritten += len(data)
+    
+    def __write_stats(self, data, sampleEnd):
+        '''
+        Updates the running statistics with the new data
+        
+        Parameters
+        ----------
+        data : ndarray
+            properly shaped numpy array (all the new samples)
+        sampleEnd : int
+            index of the last new sample (excluded)
+        
+        '''
+        L = self.bufSize
+        nSums = L + 1
+        sampleStart = sampleEnd - len(data)
+        data = data.astype('float64')
+        
+        # prefix sums, epoch by epoch. Only the last epoch and the end of
+        # the previous one are kept
+        a = max(sampleStart, (sampleEnd - 1) // L * L - L)
+        while a < sampleEnd:
+            k = a // L
+            b = min(sampleEnd, (k + 1) * L)
+            
+            if a == k * L:
+                self.__refs[k % 2] = data[a - sampleStart]
+                base = 0
+            else:
+                base = self.__sums[:, a % nSums, np.newaxis]
+            
+            x = data[a - sampleStart:b - sampleStart] - self.__refs[k % 2]
+            prefix = np.empty((2, b - a, self.nChannels))
+            np.cumsum(x, 0, out=prefix[0])
+            np.cumsum(x ** 2, 0, out=prefix[1])
+            prefix += base
+            
+            self.__sums[:, np.arange(a + 1, b + 1) % nSums] = prefix
+            a = b
+        
+        # block extrema of the (last) blocks touched by the new data
+        B = self.__statsBlockSize
+        nBlocks = self.__extrema.shape[1]
+        first = max(sampleStart, (sampleEnd - 1) // B * B - (nBlocks - 1) * B)
+        data = data[first - sampleStart:]
+        
+        blocks = np.arange(first, sampleEnd) // B
+        bounds = np.concatenate(([0], np.flatnonzero(np.diff(blocks)) + 1))
+        mins = np.minimum.reduceat(data, bounds, 0)
+        maxs = np.maximum.reduceat(data, bounds, 0)
+        
+        # the first block might be a continuation of the previous write
+        if first % B:
+            j = blocks[0] % nBlocks
+            mins[0] = np.minimum(mins[0], self.__extrema[0, j])
+            maxs[0] = np.maximum(maxs[0], self.__extrema[1, j])
+        
+        idx = blocks[bounds] % nBlocks
+        self.__extrema[0, idx] = mins
+        self.__extrema[1, idx] = maxs
+    
+    def get_mean_var(self, sampleStart, sampleEnd):
+        '''
+        Gets the per-channel mean and variance of the given data chunk.
+        The cost doesn't depend on the chunk size. Requires the running
+        statistics to be enabled (see `initialize`)
+        
+        Parameters
+        ----------
+        sampleStart : int
+            first sample index (included)
+        sampleEnd : int
+            last samples index (excluded)
+        
+        Returns
+        -------
+        mean, var : ndarray
+            per-channel mean and (biased) variance
+        
+        Raises
+        ------
+        BufferError
+            If the data is not available or the statistics are disabled
+        
+        '''
+        if not self.__statsBlockSize: raise BufferError(6)
+        e = self.check_availablility(sampleStart, sampleEnd)
+        if e or sampleEnd <= sampleStart: raise BufferError(e or 5)
+        
+        L = self.bufSize
+        nSums = L + 1
+        
+        # the chunk spans the epoch of its last sample and maybe the
+        # previous one. The sums are taken relative to the reference of
+        # the former
+        k = (sampleEnd - 1) // L
+        first = k * L
+        ref = self.__refs[k % 2].copy()
+        sums = self.__sums[:, sampleEnd % nSums].copy()
+        
+        if sampleStart > first:
+            sums -= self.__sums[:, sampleStart % nSums]
+        elif sampleStart < first:
+            prev = self.__sums[:, first % nSums] - self.__sums[:, sampleStart % nSums]
+            m = first - sampleStart
+            d = ref - self.__refs[(k - 1) % 2]
+            sums[0] += prev[0] - m * d
+            sums[1] += prev[1] - 2 * d * prev[0] + m * d ** 2
+        
+        # the chunk might be overwritten while reading
+        e = self.check_availablility(sampleStart, sampleEnd)
+        if e: raise BufferError(e)
+        
+        n = sampleEnd - sampleStart
+        mean = sums[0] / n
+        var = np.maximum(sums[1] / n - mean ** 2, 0)
+        return ref + mean, var
+    
+    def get_min_max(self, sampleStart, sampleEnd):
+        '''
+        Gets the per-channel minimum and maximum of the given data chunk.
+        The full blocks are looked up in the block summary, so only the
+        samples of the (at most two) partial blocks at the edges are read.
+        Requires the running statistics to be enabled (see `initialize`)
+        
+        Parameters
+        ----------
+        sampleStart : int
+            first sample index (included)
+        sampleEnd : int
+            last samples index (excluded)
+        
+        Returns
+        -------
+        min, max : ndarray
+            per-channel minimum and maximum
+        
+        Raises
+        ------
+        BufferError
+            If the data is not available or the statistics are disabled
+        
+        '''
+        if not self.__statsBlockSize: raise BufferError(6)
+        e = self.check_availablility(sampleStart, sampleEnd)
+        if e or sampleEnd <= sampleStart: raise BufferError(e or 5)
+        
+        B = self.__statsBlockSize
+        firstBlock = -(-sampleStart // B)
+        lastBlock = sampleEnd // B
+        
+        # chunk within a single block
+        if firstBlock >= lastBlock:
+            data = self.get_data(sampleStart, sampleEnd)
+            return data.min(0), data.max(0)
+        
+        idx = np.arange(firstBlock, lastBlock) % self.__extrema.shape[1]
+        mins = [self.__extrema[0, idx].min(0)]
+        maxs = [self.__extrema[1, idx].max(0)]
+        
+        # partial blocks at the edges
+        for i, j in ((sampleStart, firstBlock * B), (lastBlock * B, sampleEnd)):
+            if j > i:
+                data = self.get_data(i, j)
+                mins.append(data.min(0))
+                maxs.append(data.max(0))
+        
+        return np.min(mins, 0), np.max(maxs, 0)
+
+
+class Cursor(object):
+    '''
+    An incremental buffer reader. Remembers its read position and returns
+    every sample written to the buffer exactly once. Each consumer should
+    use its own cursor.
+    
+    Parameters
+    ----------
+    buf : RingBuffer
+        an initialized buffer to read from
+    position : int, optional
+        index of the first sample to read. By default, the reading starts
+        from the current write position (only the new samples are read)
+    channels : int, slice or sequence of ints, optional
+        channels to read (see `RingBuffer.get_data`). By default, all
+        channels are read
+    
+    Attributes
+    ----------
+    position
+    available
+    nLost : int
+        number of samples lost due to the overrun during the last read
+    nLostTotal : int
+        total number of samples lost due to the overruns
+    
+    Notes
+    -----
+    If the consumer falls behind by more than the buffer capacity, the
+    oldest unread samples are overwritten. In this case, the cursor jumps
+    to the oldest sample still available, logs a warning and reports the
+    number of skipped samples in `nLost`.
+    
+    '''
+    def __init__(self, buf, position=None, channels=None):
+        self.logger = logging.getLogger('ringbuffer.cursor')
+        self.__buf = buf
+        self.__position = buf.nSamplesWritten if position is None else position
+        self.__channels = None if channels is None else get_channel_index(channels)
+        
+        self.nLost = 0
+        self.nLostTotal = 0
+    
+    position = property(lambda self: self.__position, None, None,
+                        'Index of the next sample to read, read-only (int)')
+    available = property(lambda self: self.__buf.nSamplesWritten - self.__position,
+                         None, None, 'Number of unread samples, read-only (int)')
+    
+    def read(self, maxSamples=None, timeout=0, sleep=5e-4):
+        '''
+        Gets all the samples written since the last read. If possible, the
+        data is returned in the form of a numpy view (without copy).
+        Blocks until at least one new sample is written or timeout is over
+        
+        Parameters
+        ----------
+        maxSamples : int, optional
+            maximum number of samples to return. The rest is left for
+            the next reads
+        timeout : float, optional
+            time to wait for the new data (seconds). If 0, returns
+            immediately
+        sleep : float, optional
+            time to wait until the next loop iteration. Used to avoid
+            100% processor loading.
+        
+        Returns
+        -------
+        data : ndarray (view or copy)
+            new data chunk, empty if there was no new data within the
+            timeout
+        
+        '''
+        buf = self.__buf
+        
+        then = time.time()
+        while buf.nSamplesWritten <= self.__position and \
+              time.time() - then < timeout:
+            time.sleep(sleep)
+        
+        self.nLost = 0
+        while True:
+            sampleEnd = buf.nSamplesWritten
+            
+            # overrun check
+            nLost = max(0, buf.oldestSample - self.__position)
+            if nLost:
+                self.logger.warning('cursor overrun, %s samples lost' % nLost)
+                self.nLost += nLost
+                self.nLostTotal += nLost
+                self.__position += nLost
+            
+            if maxSamples is not None:
+                sampleEnd = min(sampleEnd, self.__position + maxSamples)
+            
+            if sampleEnd <= self.__position:
+                data = np.empty((0, buf.nChannels), buf.nptype)
+                return data if self.__channels is None else data[:, self.__channels]
+            
+            # the writer might lap the cursor after the check
+            try:
+                data = buf.get_data(self.__position, sampleEnd,
+                                    channels=self.__channels)
+            except BufferError as e:
+                if e.code != 2:
+                    raise
+                continue
+            
+            self.__position = sampleEnd
+            return data
+    
+    def seek(self, position):
+        '''
+        Moves the cursor to the given sample index
+        
+        Parameters
+        ----------
+        position : int
+            index of the next sample to read
+        
+        '''
+        self.__position = position
+
+
+def get_channel_index(channels):
+    '''
+    Converts a channel selection to an index, which selects the channels
+    without copy if possible
+    
+    Parameters
+    ----------
+    channels : int, slice or sequence of ints
+        channel selection
+    
+    Returns
+    -------
+    idx : int, slice or ndarray
+        index to be used on the second axis of the data
+    
+    '''
+    if isinstance(channels, (int, long, np.integer, slice)):
+        return channels
+    
+    channels = np.asarray(channels, dtype=int).ravel()
+    
+    # evenly spaced channels can be sliced, unless they run from the
+    # negative indices to the non-negative ones. The stop of the slice
+    # ending at the channel -1 is None
+    if len(channels) == 0:
+        return channels
+    if len(channels) == 1:
+        return slice(channels[0], channels[0] + 1 or None)
+    step = channels[1] - channels[0]
+    if step > 0 and (np.diff(channels) == step).all() and \
+       not channels[0] < 0 <= channels[-1]:
+        return slice(channels[0], channels[-1] + 1 or None, step)
+    
+    return channels
+
+def get_stats_nblocks(nSamples, statsBlockSize):
+    '''
+    Gets the number of blocks in the block extrema summary, so that all
+    the blocks overlapping with the buffered data are kept
+    
+    '''
+    return nSamples // statsBlockSize + 2
+
+def get_stats_size(nChannels, nSamples, statsBlockSize):
+    '''
+    Gets the size of the running statistics section (in bytes)
+    
+    Parameters
+    ----------
+    nChannels : int
+        dimensionality of a single sample
+    nSamples : int
+        the buffer capacity in samples
+    statsBlockSize : int
+        block size of the statistics, 0 if disabled
+    
+    '''
+    if not statsBlockSize:
+        return 0
+    nBlocks = get_stats_nblocks(nSamples, statsBlockSize)
+    return 8 * 2 * (nSamples + 1 + nBlocks + 1) * nChannels
 
 
 class datatypes():
@@ -423,7 +1115,9 @@ class datatypes():
     
     '''
     types = {0:'float32',
-             1:'int16'}
+             1:'int16',
+             2:'float64',
+             3:'uint8'}
     @classmethod
     def get_code(cls, type):
         '''
@@ -450,6 +1144,42 @@ class datatypes():
         '''
         return cls.types[code]
     
+
+class layouts():
+    '''
+    A helper class to interpret the layout code read from buffer header.
+    
+    '''
+    types = {0:'sample',
+             1:'channel'}
+    @classmethod
+    def get_code(cls, type):
+        '''
+        Gets buffer layout code given its name
+        
+        Parameters
+        ----------        
+        type : string
+            layout name (e.g. 'channel')
+        
+        '''
+        if type not in cls.types.values():
+            raise BufferError(7)
+        idx = cls.types.values().index(type)
+        return cls.types.keys()[idx]
+    @classmethod
+    def get_type(cls, code):
+        '''
+        Gets buffer layout name given its code
+        
+        Parameters
+        ----------            
+        code : int
+            layout code (e.g. 0)
+        
+        '''
+        return cls.types[code]
+    
     
 class BufferHeader(c.Structure):
     '''
@@ -457,26 +1187,190 @@ class BufferHeader(c.Structure):
     
     Attributes
     ----------
-    bufSizeBytes : c_ulong
+    bufSizeBytes : c_uint64
         size of the buffer in bytes, excluding header and pocket
-    pocketSizeBytes : c_ulong
+    pocketSizeBytes : c_uint64
         size of the buffer in bytes
-    dataType : c_uint
-        typecode of the data stored in the buffer
-    nChannels : c_ulong
+    nChannels : c_uint64
         sample dimensionality
-    nSamplesWritten : c_ulong
+    nSamplesWritten : c_uint64
         the total number of sample, written after the buffer allocation
+    statsBlockSize : c_uint64
+        block size of the running statistics (in samples), 0 if disabled
+    dataType : c_uint32
+        typecode of the data stored in the buffer
+    layout : c_uint32
+        memory layout code of the data
+    moved : c_uint64
+        nonzero, if the buffer has been moved to another array
+    firstSample : c_uint64
+        index of the first sample that was ever available, e.g. in a
+        restored snapshot
+    maxChunk : c_uint64
+        the largest number of samples written at once
+    movedTo : c_char * 64
+        name of the file backing that array
+    
+    Notes
+    -----
+    The fields have fixed sizes on all platforms. The 64-bit fields are
+    aligned (so that nSamplesWritten is updated atomically)
     '''
     _pack_ = 1
     _fields_ = [
-                ('bufSizeBytes', c.c_ulong),
-                ('pocketSizeBytes', c.c_ulong),
-                ('dataType', c.c_uint),
-                ('nChannels', c.c_ulong),
-                ('nSamplesWritten', c.c_ulong)
+                ('bufSizeBytes', c.c_uint64),
+                ('pocketSizeBytes', c.c_uint64),
+                ('nChannels', c.c_uint64),
+                ('nSamplesWritten', c.c_uint64),
+                ('statsBlockSize', c.c_uint64),
+                ('dataType', c.c_uint32),
+                ('layout', c.c_uint32),
+                ('moved', c.c_uint64),
+                ('firstSample', c.c_uint64),
+                ('maxChunk', c.c_uint64),
+                ('movedTo', c.c_char * 64)
                 ]
     
+#------------------------------------------------------------------------------
+# allocation
+
+HUGEPAGE_SIZE = 2 ** 21
+MAP_HUGETLB = 0x40000
+MADV_HUGEPAGE = 14
+MADV_POPULATE_WRITE = 23
+
+try:
+    _libc = c.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    _madvise = _libc.madvise
+    _madvise.argtypes = [c.c_void_p, c.c_size_t, c.c_int]
+except (OSError, AttributeError):
+    _madvise = None
+
+def allocate(sizeBytes, hugepages=False, prefault=False, filename=None):
+    '''
+    Allocates a raw array, shared with the child processes. Where possible
+    (POSIX), the array is an anonymous shared memory map, so the
+    allocation is instant: the pages are zeroed by the kernel on the first
+    access. Otherwise, the array is a multiprocessing.Array.
+    
+    If a file name is given, the array is a shared map of this (new,
+    empty) file instead, which can be mapped by any process (see
+    `attach`). The file should be created by `create_shared_file`, so
+    that it's located in a memory filesystem and nobody else can open it
+    
+    Parameters
+    ----------
+    sizeBytes : int
+        array size (in bytes)
+    hugepages : bool, optional
+        whether to use huge pages: explicit ones (MAP_HUGETLB), if
+        reserved in the system, otherwise transparent ones (madvise). Huge
+        pages reduce the TLB misses when large buffers are scanned
+    prefault : bool, optional
+        whether to fault the pages in by a background thread, so that the
+        first writes don't wait for the page faults. Requires Linux 5.14
+        (MADV_POPULATE_WRITE), ignored otherwise
+    filename : string, optional
+        new, empty file to back the array with
+    
+    Returns
+    -------
+    raw : ctypes char array
+    
+    '''
+    logger = logging.getLogger('ringbuffer')
+    
+    mm = None
+    if filename is not None:
+        fd = os.open(filename, os.O_RDWR | getattr(os, 'O_NOFOLLOW', 0))
+        try:
+            if os.fstat(fd).st_size:
+                raise Exception('%s is not a new file' % filename)
+            os.ftruncate(fd, sizeBytes)
+            mm = mmap.mmap(fd, sizeBytes)
+        finally:
+            os.close(fd)
+        if hugepages:
+            _advise(mm, MADV_HUGEPAGE)
+    elif not hasattr(mmap, 'MAP_SHARED'):
+        return Array('c', sizeBytes).get_obj()
+    elif hugepages:
+        size = -(-sizeBytes // HUGEPAGE_SIZE) * HUGEPAGE_SIZE
+        try:
+            mm = mmap.mmap(-1, size, mmap.MAP_SHARED | mmap.MAP_ANONYMOUS | MAP_HUGETLB)
+        except (EnvironmentError, ValueError):
+            logger.info('no huge pages reserved, using transparent ones')
+    
+    if mm is None:
+        mm = mmap.mmap(-1, sizeBytes, mmap.MAP_SHARED | mmap.MAP_ANONYMOUS)
+        if hugepages:
+            _advise(mm, MADV_HUGEPAGE)
+    
+    # the array keeps a reference to the map
+    raw = (c.c_char * sizeBytes).from_buffer(mm)
+    
+    if prefault:
+        thread = threading.Thread(target=_advise, args=(mm, MADV_POPULATE_WRITE))
+        thread.daemon = True
+        thread.start()
+    
+    return raw
+
+def attach(filename):
+    '''
+    Maps a raw array allocated by another process (see `allocate`)
+    
+    Parameters
+    ----------
+    filename : string
+        file backing the array
+    
+    Returns
+    -------
+    raw : ctypes char array
+    
+    '''
+    fd = os.open(filename, os.O_RDWR)
+    try:
+        sizeBytes = os.fstat(fd).st_size
+        mm = mmap.mmap(fd, sizeBytes)
+    finally:
+        os.close(fd)
+    
+    return (c.c_char * sizeBytes).from_buffer(mm)
+
+def create_shared_file(prefix='ringbuffer-'):
+    '''
+    Creates a new, empty file for a shared raw array (see `allocate`),
+    located in the memory filesystem (/dev/shm), if available. The file
+    is created atomically with a unique name, readable and writable only
+    by the owner
+    
+    Returns
+    -------
+    filename : string
+    
+    '''
+    folder = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+    fd, filename = tempfile.mkstemp(prefix=prefix, dir=folder)
+    os.close(fd)
+    return filename
+
+def _advise(mm, advice):
+    '''
+    Gives an advice about a memory map to the kernel, ignoring failures
+    
+    '''
+    if _madvise is None:
+        return False
+    
+    address = c.addressof(c.c_char.from_buffer(mm))
+    if _madvise(address, len(mm), advice):
+        logging.getLogger('ringbuffer').info('madvise(%s) failed: %s' %
+                                             (advice, c.get_errno()))
+        return False
+    return True
+
 class BufferError(Exception):
     '''
     Represents different types of buffer errors
@@ -506,6 +1400,14 @@ class BufferError(Exception):
             return 'writing incompatible data (error %s)' % repr(self.code)
         elif self.code == 5:
             return 'negative index (error %s)' % repr(self.code)
+        elif self.code == 6:
+            return 'statistics are disabled (error %s)' % repr(self.code)
+        elif self.code == 7:
+            return 'unknown memory layout (error %s)' % repr(self.code)
+        elif self.code == 8:
+            return 'buffer overrun during the snapshot (error %s)' % repr(self.code)
+        elif self.code == 9:
+            return 'buffer moved to an unavailable array (error %s)' % repr(self.code)
         else:
             return '(error %s)' % repr(self.code)
 
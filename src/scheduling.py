@@ -0,0 +1,386 @@
+'''
+CPU placement of the Streamer: affinity, priority and memory locking (see
+`apply_placement`), and a self-test measuring the acquisition jitter with
+a given placement (see `self_test`)
+
+'''
+
+from multiprocessing import Process
+from multiprocessing.sharedctypes import RawArray, RawValue
+import ctypes as c
+import ctypes.util
+import logging
+import socket
+import time
+import os
+
+import numpy as np
+
+import rdadefs
+import rdatools
+
+__author__ = "Dmytro Bielievtsov"
+__email__ = "belevtsoff@gmail.com"
+
+CPU_SETSIZE = 1024
+MCL_CURRENT = 1
+
+try:
+    _libc = c.CDLL(ctypes.util.find_library('c'), use_errno=True)
+except OSError:
+    _libc = None
+
+def apply_placement(cpus=None, nice=None, mlock=False):
+    '''
+    Applies a placement to the calling process. Every setting is applied
+    where permitted, the failures are logged and otherwise ignored
+
+    Parameters
+    ----------
+    cpus : sequence of ints, optional
+        CPUs to run on (see `set_affinity`)
+    nice : int, optional
+        niceness (see `set_nice`)
+    mlock : bool, optional
+        whether to lock the memory (see `lock_memory`)
+
+    Returns
+    -------
+    applied : dict
+        {setting: whether it was applied} for the requested settings
+
+    '''
+    applied = {}
+    if cpus is not None:
+        applied['cpus'] = set_affinity(cpus)
+    if nice is not None:
+        applied['nice'] = set_nice(nice)
+    if mlock:
+        applied['mlock'] = lock_memory()
+    return applied
+
+def set_affinity(cpus, pid=0):
+    '''
+    Restricts a process to the given CPUs (sched_setaffinity)
+
+    Parameters
+    ----------
+    cpus : sequence of ints
+        CPU indices
+    pid : int, optional
+        process ID, the calling process by default
+
+    Returns
+    -------
+    success : bool
+
+    '''
+    logger = logging.getLogger('scheduling')
+    cpus = sorted(set(int(cpu) for cpu in cpus))
+
+    try:
+        if hasattr(os, 'sched_setaffinity'):
+            os.sched_setaffinity(pid, cpus)
+        else:
+            mask = _cpu_set(cpus)
+            if _libc is None or _libc.sched_setaffinity(pid, c.sizeof(mask), mask):
+                raise OSError(c.get_errno(), os.strerror(c.get_errno()))
+    except (OSError, ValueError, AttributeError) as e:
+        logger.warning('unable to set the CPU affinity to %s: %s' % (cpus, e))
+        return False
+
+    logger.info('CPU affinity set to %s' % cpus)
+    return True
+
+def get_affinity(pid=0):
+    '''
+    Gets the CPUs a process may run on
+
+    Returns
+    -------
+    cpus : list of ints or None, if unknown
+
+    '''
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(pid))
+
+    mask = _cpu_set(())
+    if _libc is None or _libc.sched_getaffinity(pid, c.sizeof(mask), mask):
+        return None
+
+    bits = 8 * c.sizeof(c.c_ulong)
+    return [cpu for cpu in xrange(CPU_SETSIZE)
+            if mask[cpu // bits] >> (cpu % bits) & 1]
+
+def _cpu_set(cpus):
+    '''
+    Creates a cpu_set_t mask with the given CPUs
+
+    '''
+    bits = 8 * c.sizeof(c.c_ulong)
+    mask = (c.c_ulong * (CPU_SETSIZE // bits))()
+    for cpu in cpus:
+        mask[cpu // bits] |= 1 << (cpu % bits)
+    return mask
+
+def set_nice(nice):
+    '''
+    Sets the niceness of the calling process. Lowering it (raising the
+    priority) usually requires privileges (CAP_SYS_NICE)
+
+    Parameters
+    ----------
+    nice : int
+        niceness, from -20 (highest priority) to 19
+
+    Returns
+    -------
+    success : bool
+
+    '''
+    logger = logging.getLogger('scheduling')
+    try:
+        os.nice(nice - os.nice(0))
+    except OSError as e:
+        logger.warning('unable to set the niceness to %s: %s' % (nice, e))
+        return False
+
+    logger.info('niceness set to %s' % os.nice(0))
+    return True
+
+def lock_memory():
+    '''
+    Locks the pages currently mapped by the calling process (including
+    the shared buffers) in the memory, so that they're never swapped out
+    and no page faults happen on access (mlockall). The pages are faulted
+    in at once, which takes a while for large buffers. Requires a large
+    enough RLIMIT_MEMLOCK or privileges (CAP_IPC_LOCK)
+
+    Returns
+    -------
+    success : bool
+
+    '''
+    logger = logging.getLogger('scheduling')
+    if _libc is None or not hasattr(_libc, 'mlockall'):
+        logger.warning('unable to lock the memory: mlockall is not available')
+        return False
+
+    if _libc.mlockall(MCL_CURRENT):
+        logger.warning('unable to lock the memory: %s' %
+                       os.strerror(c.get_errno()))
+        return False
+
+    logger.info('memory locked')
+    return True
+
+
+#------------------------------------------------------------------------------
+# self-test
+
+def self_test(target=1e-3, duration=10., samplingFreq=1000., blockSize=10,
+              nChannels=32, cpus=None, nice=None, mlock=False, workload=None):
+    '''
+    Measures the acquisition jitter with a given Streamer placement. A
+    local RDA simulator sends the blocks on a fixed schedule to a client
+    with the placement, whose plugin times every block:
+
+    * wakeup: from the moment the block is sent to the start of the
+      plugins, i.e. the network stack, the scheduling of the Streamer
+      process and writing to the buffer
+    * processing: duration of the workload run on the block
+
+    The placement meets the target, if the 99th percentile of their sum
+    (the total latency) doesn't exceed it. Since the simulator runs on the
+    same machine, the test should be run with the rest of the system in
+    its usual state
+
+    Parameters
+    ----------
+    target : float, optional
+        target 99th percentile of the latency (seconds)
+    duration : float, optional
+        test duration (seconds)
+    samplingFreq : float, optional
+        simulated sampling frequency (Hz)
+    blockSize : int, optional
+        simulated block size (in samples)
+    nChannels : int, optional
+        simulated number of channels
+    cpus, nice, mlock : optional
+        the placement (see `apply_placement`)
+    workload : callable, optional
+        workload(data) run on every block, by default a channel covariance
+
+    Returns
+    -------
+    report : dict
+        'wakeup', 'processing' and 'latency' percentiles (dicts with
+        'p50', 'p99' and 'max', seconds), the 'target', whether it's
+        'met', the numbers of blocks ('nBlocks') and of blocks not
+        received ('nMissed'), and the effective 'cpus' and 'nice' of the
+        Streamer
+
+    Examples
+    --------
+    >>> report = self_test(target=2e-3, cpus=[3], nice=-10, mlock=True)
+    >>> print report['latency']['p99'], report['met']
+
+    '''
+    # rdaclient imports this module
+    import rdaclient
+
+    nBlocks = int(duration * samplingFreq / blockSize)
+
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(('localhost', 0))
+    server.listen(1)
+
+    sent = RawArray(c.c_double, nBlocks)
+    simulator = Process(target=_simulate, args=(server, samplingFreq, blockSize,
+                                                 nChannels, sent))
+    simulator.daemon = True
+    simulator.start()
+
+    probe = _Probe(nBlocks, blockSize, workload or _covariance)
+    client = rdaclient.Client(buffer_size=int(10 * samplingFreq),
+                              streamer_cpus=cpus, streamer_nice=nice,
+                              streamer_mlock=mlock)
+    client.add_plugin(probe, budget=None, name='self-test probe')
+
+    try:
+        client.connect(server.getsockname())
+        server.close()
+        client.start_streaming()
+
+        # the simulator sends a stop message at the end
+        deadline = time.time() + duration + 10
+        while client.is_streaming and time.time() < deadline:
+            time.sleep(.1)
+        if client.is_streaming:
+            client.stop_streaming()
+    finally:
+        client.disconnect()
+        simulator.join(1)
+
+    sent = np.frombuffer(sent)
+    starts = np.frombuffer(probe.starts)
+    ends = np.frombuffer(probe.ends)
+    received = (starts > 0) & (sent > 0)
+
+    wakeup = (starts - sent)[received]
+    processing = (ends - starts)[received]
+    latency = wakeup + processing
+
+    report = {'wakeup': _percentiles(wakeup),
+              'processing': _percentiles(processing),
+              'latency': _percentiles(latency),
+              'target': target,
+              'met': bool(received.any()) and
+                     _percentiles(latency)['p99'] <= target,
+              'nBlocks': nBlocks,
+              'nMissed': int(nBlocks - received.sum()),
+              'cpus': [cpu for cpu in xrange(CPU_SETSIZE) if probe.cpus[cpu]] or None,
+              'nice': probe.nice.value}
+
+    logging.getLogger('scheduling').info(
+        'self-test: latency p99 %.3f ms (wakeup %.3f ms, processing %.3f ms), '
+        'target %.3f ms %s' % (1e3 * report['latency']['p99'],
+                               1e3 * report['wakeup']['p99'],
+                               1e3 * report['processing']['p99'], 1e3 * target,
+                               report['met'] and 'met' or 'NOT met'))
+    return report
+
+def _percentiles(x):
+    '''
+    Gets the median, the 99th percentile and the maximum of the samples
+
+    '''
+    if not len(x):
+        return {'p50': np.nan, 'p99': np.nan, 'max': np.nan}
+    return {'p50': np.percentile(x, 50),
+            'p99': np.percentile(x, 99),
+            'max': x.max()}
+
+def _covariance(data):
+    '''
+    The default self-test workload
+
+    '''
+    x = np.asarray(data, 'float64')
+    return np.dot(x.T, x)
+
+
+class _Probe(object):
+    '''
+    The self-test plugin, recording the start and end times of every
+    block in the shared memory
+
+    '''
+    def __init__(self, nBlocks, blockSize, workload):
+        self.blockSize = blockSize
+        self.workload = workload
+        self.starts = RawArray(c.c_double, nBlocks)
+        self.ends = RawArray(c.c_double, nBlocks)
+
+        # the effective placement, recorded by the first call
+        self.cpus = RawArray(c.c_byte, CPU_SETSIZE)
+        self.nice = RawValue(c.c_int)
+        self.__first = True
+
+    def __call__(self, data, sampleStart):
+        then = time.time()
+
+        if self.__first:
+            self.__first = False
+            for cpu in get_affinity() or ():
+                self.cpus[cpu] = 1
+            self.nice.value = os.nice(0)
+
+        self.workload(data)
+
+        k = sampleStart // self.blockSize
+        if k < len(self.starts):
+            self.starts[k] = then
+            self.ends[k] = time.time()
+
+def _simulate(server, samplingFreq, blockSize, nChannels, sent):
+    '''
+    Serves a client with random data blocks on a fixed schedule, storing
+    the send times in `sent`, then sends a stop message
+
+    '''
+    conn = server.accept()[0]
+    conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    names = [str(ch + 1) for ch in xrange(nChannels)]
+    conn.sendall(rdatools.create_start_msg(1e6 / samplingFreq,
+                                           np.ones(nChannels), names))
+
+    msg = rdadefs.rda_msg_data_t.full(nChannels, blockSize, 0)()
+    msg.hdr.guid = rdadefs.RDA_GUID
+    msg.hdr.nSize = c.sizeof(msg)
+    msg.hdr.nType = rdadefs.RDA_FLOAT_MSG
+    msg.nPoints = blockSize
+    data = np.frombuffer(msg.fData, 'float32')
+
+    interval = blockSize / samplingFreq
+
+    # leave the Streamer some time to start
+    then = time.time() + 1
+    for k in xrange(len(sent)):
+        data[:] = np.random.randn(len(data))
+        msg.nBlock = k
+
+        delay = then + (k + 1) * interval - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        sent[k] = time.time()
+        conn.sendall(msg)
+
+    stop = rdadefs.rda_msg_stop_t()
+    stop.hdr.guid = rdadefs.RDA_GUID
+    stop.hdr.nSize = c.sizeof(stop)
+    stop.hdr.nType = rdadefs.RDA_STOP_MSG
+    conn.sendall(stop)
+    conn.close()
@@ -0,0 +1,449 @@
+'''
+Spectral analysis of the buffered data. See spectral.SpectralEngine's
+docstring for more information
+
+'''
+
+from multiprocessing import Pool
+import logging
+import signal
+
+import numpy as np
+
+import ringbuffer
+
+__author__ = "Dmytro Bielievtsov"
+__email__ = "belevtsoff@gmail.com"
+
+class SpectralEngine(object):
+    '''
+    An incremental short-time Fourier transform (STFT) and band power
+    estimator.
+
+    The signal is split into hop-aligned frames, each of which is
+    transformed only once for all channels at once. Band powers of the
+    frames are averaged over the last `nAverage` frames (Welch's method),
+    so the overlapping frames are reused by the subsequent updates instead
+    of being recomputed. The results are written to a result buffer, one
+    row per frame.
+
+    Parameters
+    ----------
+    nChannels : int
+        number of channels
+    samplingFreq : float
+        sampling frequency (Hz)
+    bands : sequence of (float, float)
+        frequency bands (Hz), a band (lo, hi) includes the frequencies
+        lo < f <= hi
+    nfft : int, optional
+        frame length (in samples)
+    hop : int, optional
+        distance between the starts of consecutive frames (in samples).
+        Defaults to the half of the frame length
+    nAverage : int, optional
+        number of the most recent frames to average
+    window : string or ndarray, optional
+        window function: 'hanning', 'hamming', 'blackman', 'bartlett',
+        'boxcar' or an array of length `nfft`
+    resultSize : int, optional
+        capacity of the result buffer (in frames)
+
+    Attributes
+    ----------
+    freqs : ndarray
+        frequencies of the frame spectrum bins (Hz)
+    result : RingBuffer
+        result buffer, its rows are the flattened (nChannels, nBands)
+        band power arrays
+    nFrames : int
+        total number of the processed frames
+
+    '''
+    def __init__(self, nChannels, samplingFreq, bands, nfft=256, hop=None,
+                 nAverage=1, window='hanning', resultSize=1000):
+        self.logger = logging.getLogger('spectral')
+
+        self.nChannels = nChannels
+        self.samplingFreq = float(samplingFreq)
+        self.bands = np.asarray(bands, dtype=float).reshape((-1, 2))
+        self.nfft = nfft
+        self.hop = hop or max(1, nfft // 2)
+        self.nAverage = nAverage
+
+        # cached window function, normalized to get the power spectral
+        # density (one-sided)
+        self.__window = get_window(window, nfft)
+        scale = 2. / (self.samplingFreq * np.sum(self.__window ** 2))
+
+        # band masks, including the bin width (integration weights)
+        self.freqs = np.arange(nfft // 2 + 1) * self.samplingFreq / nfft
+        masks = (self.freqs > self.bands[:, :1]) & (self.freqs <= self.bands[:, 1:])
+        self.__masks = masks.T * scale * self.samplingFreq / nfft
+
+        # band powers of the last frames and their running sum
+        nBands = len(self.bands)
+        self.__frames = np.zeros((nAverage, nChannels, nBands))
+        self.__sum = np.zeros((nChannels, nBands))
+
+        self.result = ringbuffer.RingBuffer()
+        self.result.initialize(nChannels * nBands, resultSize)
+
+        self.nFrames = 0
+
+    def update(self, frames):
+        '''
+        Processes new frames and writes the averaged band powers to the
+        result buffer
+
+        Parameters
+        ----------
+        frames : ndarray
+            consecutive frames, stacked in an array of shape (nNewFrames,
+            nfft, nChannels) (see `RingBuffer.get_windows`)
+
+        Returns
+        -------
+        power : ndarray
+            averaged band powers of shape (nNewFrames, nChannels, nBands)
+
+        '''
+        # spectra of all frames and channels at once
+        spec = np.fft.rfft(frames * self.__window[:, np.newaxis], axis=1)
+        spec = spec.real ** 2 + spec.imag ** 2
+
+        # integrate over the bands: (frames, channels, bands)
+        bandPower = np.dot(spec.transpose((0, 2, 1)), self.__masks)
+
+        # running average over the last frames
+        power = np.empty_like(bandPower)
+        for i, p in enumerate(bandPower):
+            slot = self.nFrames % self.nAverage
+            self.__sum += p - self.__frames[slot]
+            self.__frames[slot] = p
+            self.nFrames += 1
+            power[i] = self.__sum / min(self.nFrames, self.nAverage)
+
+        self.result.put_data(power.reshape((len(power), -1)).astype(self.result.nptype))
+        return power
+
+    def run(self, client, policy='coalesce', timeout=10):
+        '''
+        Feeds the engine from the client's buffer with hop-aligned frames
+        until the streaming stops (see `rdaclient.Client.iter_windows`)
+
+        Parameters
+        ----------
+        client : rdaclient.Client
+            a streaming client
+        policy : {'all', 'latest', 'coalesce'}, optional
+            lag policy. Note, that skipping the frames ('latest') breaks
+            the frame averaging
+        timeout : float, optional
+            time to wait for the next frame (seconds)
+
+        '''
+        for k, frames, latency in client.iter_windows(self.nfft, self.hop,
+                                                      policy, timeout=timeout):
+            if frames.ndim == 2:
+                frames = frames[np.newaxis]
+            self.update(frames)
+
+
+class ConnectivityEngine(object):
+    '''
+    An incremental all-pairs connectivity estimator (coherence or phase
+    locking value).
+
+    As in `SpectralEngine`, the signal is split into hop-aligned frames,
+    each of which is transformed only once. For every frame, the cross
+    spectra of all channel pairs are computed at once and summed over the
+    frequency bins of every band. These band terms are averaged over the
+    last `nAverage` frames with a running sum, so the overlapping sliding
+    windows share both the transforms and the cross spectra.
+
+    * 'coherence': |<Sxy>|^2 / (<Sxx> <Syy>), where Sxy is the band
+      cross spectrum of a frame and <> is the average over the frames
+    * 'plv': |<exp(i (phi_x - phi_y))>|, the average over the frames and
+      the band bins
+
+    Only the upper triangle of the connectivity matrix (i < j) is stored:
+    the result buffer rows are the flattened (nBands, nPairs) arrays (see
+    `pairs` and `to_matrix`).
+
+    Parameters
+    ----------
+    nChannels : int
+        number of channels
+    samplingFreq : float
+        sampling frequency (Hz)
+    bands : sequence of (float, float)
+        frequency bands (Hz), a band (lo, hi) includes the frequencies
+        lo < f <= hi
+    measure : {'coherence', 'plv'}, optional
+        connectivity measure
+    nfft : int, optional
+        frame length (in samples)
+    hop : int, optional
+        distance between the starts of consecutive frames (in samples).
+        Defaults to the half of the frame length
+    nAverage : int, optional
+        number of the most recent frames to average
+    window : string or ndarray, optional
+        window function (see `get_window`)
+    workers : int, optional
+        if given, the bands are split into this many groups, processed by
+        a pool of worker processes in parallel (see `close`)
+    resultSize : int, optional
+        capacity of the result buffer (in frames)
+
+    Attributes
+    ----------
+    freqs : ndarray
+        frequencies of the frame spectrum bins (Hz)
+    pairs : tuple of ndarrays
+        channel indices (i, j) of the stored pairs
+    result : RingBuffer
+        result buffer
+    nFrames : int
+        total number of the processed frames
+
+    '''
+    def __init__(self, nChannels, samplingFreq, bands, measure='coherence',
+                 nfft=256, hop=None, nAverage=8, window='hanning', workers=None,
+                 resultSize=1000):
+        self.logger = logging.getLogger('spectral')
+
+        if measure not in ('coherence', 'plv'):
+            raise Exception('unknown measure: %s' % measure)
+
+        self.nChannels = nChannels
+        self.samplingFreq = float(samplingFreq)
+        self.bands = np.asarray(bands, dtype=float).reshape((-1, 2))
+        self.measure = measure
+        self.nfft = nfft
+        self.hop = hop or max(1, nfft // 2)
+        self.nAverage = nAverage
+        self.workers = workers
+
+        self.__window = get_window(window, nfft)
+        self.freqs = np.arange(nfft // 2 + 1) * self.samplingFreq / nfft
+        self.pairs = np.triu_indices(nChannels, 1)
+
+        # shards: band groups with the bins they need and the band masks
+        # restricted to these bins
+        nBands = len(self.bands)
+        masks = (self.freqs > self.bands[:, :1]) & (self.freqs <= self.bands[:, 1:])
+        self.__nBins = masks.sum(1).astype(float)
+        if not self.__nBins.all():
+            raise Exception('every band must contain at least one frequency bin')
+
+        self.__shards = []
+        for group in np.array_split(np.arange(nBands), workers or 1):
+            if len(group):
+                bins = np.flatnonzero(masks[group].any(0))
+                self.__shards.append((group, bins,
+                                      masks[group][:, bins].T.astype(float)))
+        self.__pool = None
+
+        # band terms of the last frames and their running sums: cross
+        # spectra (or phase differences) of the pairs, and auto spectra
+        nPairs = len(self.pairs[0])
+        self.__frames = np.zeros((nAverage, nBands, nPairs), complex)
+        self.__sum = np.zeros((nBands, nPairs), complex)
+        self.__autoFrames = np.zeros((nAverage, nBands, nChannels))
+        self.__autoSum = np.zeros((nBands, nChannels))
+
+        self.result = ringbuffer.RingBuffer()
+        self.result.initialize(nBands * nPairs, resultSize)
+
+        self.nFrames = 0
+
+    def update(self, frames):
+        '''
+        Processes new frames and writes the connectivity estimates to the
+        result buffer
+
+        Parameters
+        ----------
+        frames : ndarray
+            consecutive frames, stacked in an array of shape (nNewFrames,
+            nfft, nChannels) (see `RingBuffer.get_windows`)
+
+        Returns
+        -------
+        conn : ndarray
+            connectivity of shape (nNewFrames, nBands, nPairs)
+
+        '''
+        spec = np.fft.rfft(frames * self.__window[:, np.newaxis], axis=1)
+
+        # band terms of all frames: (frames, bands, pairs/channels)
+        tasks = [(spec[:, bins], masks, self.pairs, self.measure)
+                 for group, bins, masks in self.__shards]
+        if self.workers:
+            if self.__pool is None:
+                self.__pool = Pool(len(self.__shards), _init_worker)
+            terms = self.__pool.map(_band_terms, tasks)
+        else:
+            terms = [_band_terms(task) for task in tasks]
+
+        if len(terms) == 1:
+            cross, auto = terms[0]
+        else:
+            cross = np.concatenate([t[0] for t in terms], 1)
+            auto = np.concatenate([t[1] for t in terms], 1)
+
+        # running average over the last frames
+        conn = np.empty(cross.shape)
+        for i in xrange(len(cross)):
+            slot = self.nFrames % self.nAverage
+            self.__sum += cross[i] - self.__frames[slot]
+            self.__frames[slot] = cross[i]
+            self.__autoSum += auto[i] - self.__autoFrames[slot]
+            self.__autoFrames[slot] = auto[i]
+            self.nFrames += 1
+            conn[i] = self.__get_conn(min(self.nFrames, self.nAverage))
+
+        self.result.put_data(conn.reshape((len(conn), -1)).astype(self.result.nptype))
+        return conn
+
+    def __get_conn(self, n):
+        '''
+        Gets the connectivity from the running sums over n frames
+
+        '''
+        if self.measure == 'plv':
+            return np.abs(self.__sum) / (n * self.__nBins[:, np.newaxis])
+
+        i, j = self.pairs
+        power = self.__autoSum[:, i] * self.__autoSum[:, j]
+        power[power == 0] = np.inf
+        return (self.__sum.real ** 2 + self.__sum.imag ** 2) / power
+
+    def to_matrix(self, conn):
+        '''
+        Expands the upper-triangular connectivity to full symmetric
+        matrices
+
+        Parameters
+        ----------
+        conn : ndarray
+            connectivity of shape (..., nBands * nPairs) or (..., nBands,
+            nPairs), e.g. the result buffer rows
+
+        Returns
+        -------
+        matrix : ndarray
+            connectivity matrices of shape (..., nBands, nChannels,
+            nChannels) with ones on the diagonal
+
+        '''
+        shape = (len(self.bands), len(self.pairs[0]))
+        conn = np.asarray(conn)
+        if conn.shape[-2:] != shape:
+            conn = conn.reshape(conn.shape[:-1] + shape)
+
+        C = self.nChannels
+        i, j = self.pairs
+        matrix = np.empty(conn.shape[:-1] + (C, C))
+        matrix[..., i, j] = conn
+        matrix[..., j, i] = conn
+        matrix[..., np.arange(C), np.arange(C)] = 1
+        return matrix
+
+    def run(self, client, policy='coalesce', timeout=10):
+        '''
+        Feeds the engine from the client's buffer with hop-aligned frames
+        until the streaming stops (see `SpectralEngine.run`)
+
+        '''
+        try:
+            for k, frames, latency in client.iter_windows(self.nfft, self.hop,
+                                                          policy, timeout=timeout):
+                if frames.ndim == 2:
+                    frames = frames[np.newaxis]
+                self.update(frames)
+        finally:
+            self.close()
+
+    def close(self):
+        '''
+        Terminates the worker pool, if any
+
+        '''
+        if self.__pool is not None:
+            self.__pool.terminate()
+            self.__pool.join()
+            self.__pool = None
+
+
+def get_window(window, n):
+    '''
+    Gets a window function
+
+    Parameters
+    ----------
+    window : string or ndarray
+        window name ('hanning', 'hamming', 'blackman', 'bartlett' or
+        'boxcar') or the window itself
+    n : int
+        window length
+
+    Returns
+    -------
+    window : ndarray
+
+    '''
+    if not isinstance(window, basestring):
+        window = np.asarray(window, dtype=float)
+        if len(window) != n:
+            raise Exception('window length must be %s' % n)
+        return window
+
+    if window == 'boxcar':
+        return np.ones(n)
+    elif window in ('hanning', 'hamming', 'blackman', 'bartlett'):
+        return getattr(np, window)(n)
+    else:
+        raise Exception('unknown window: %s' % window)
+
+def _init_worker():
+    '''
+    Makes a pool worker ignore Ctrl+C, it's handled by the parent process
+
+    '''
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+def _band_terms(task):
+    '''
+    Computes the band terms of a group of bands
+
+    Parameters
+    ----------
+    task : tuple
+        spectra of the frames (nFrames, nBins, nChannels), restricted to
+        the bins of the bands, band masks (nBins, nBands), channel pairs and
+        the connectivity measure
+
+    Returns
+    -------
+    cross : ndarray
+        band sums of the cross spectra or the phase differences of the
+        pairs (nFrames, nBands, nPairs)
+    auto : ndarray
+        band sums of the auto spectra (nFrames, nBands, nChannels)
+
+    '''
+    spec, masks, (i, j), measure = task
+
+    if measure == 'plv':
+        mag = np.abs(spec)
+        mag[mag == 0] = 1
+        spec = spec / mag
+
+    # all pairs at once: (frames, bins, pairs)
+    cross = spec[:, :, i] * spec[:, :, j].conj()
+    cross = np.einsum('nfp,fb->nbp', cross, masks)
+    auto = np.einsum('nfc,fb->nbc', spec.real ** 2 + spec.imag ** 2, masks)
+    return cross, auto
@@ -0,0 +1,734 @@
+'''
+Block-wise processing stages. A stage consumes the data blocks as they
+arrive and writes the result to its own (derived) ring buffer, so that the
+processing is done once per sample, not once per consumer.
+
+See other classes' docstrings for more information:
+
+* `Stage`: the base class
+* `FilterStage`: temporal (IIR/FIR) filter
+* `SpatialFilterStage`: spatial filter (re-referencing, montages)
+* `ResampleStage`: rational resampler
+
+'''
+
+from multiprocessing.sharedctypes import RawValue
+from fractions import Fraction
+import ctypes as c
+import logging
+
+import numpy as np
+
+import ringbuffer
+
+try:
+    from scipy import signal
+    from scipy import sparse
+except ImportError:
+    signal = None
+    sparse = None
+
+try:
+    # y += A x for a CSR matrix A and row-major blocks of vectors x and y
+    from scipy.sparse._sparsetools import csr_matvecs
+except ImportError:
+    csr_matvecs = None
+
+# chunk size of the numpy SOS filtering, and its matrices cache
+SOS_CHUNK = 64
+_section_matrices = {}
+
+__author__ = "Dmytro Bielievtsov"
+__email__ = "belevtsoff@gmail.com"
+
+class Stage(object):
+    '''
+    Base class for the block-wise processing stages.
+
+    The stage is added to a Client before the streaming is started (see
+    `rdaclient.Client.add_stage`). When the buffer is initialized, the
+    Client initializes the stage as well, so that its output buffer is
+    allocated in the shared memory. After that, the Streamer passes every
+    data block written to the buffer (or to the output of the `source`
+    stage) to the `process` method.
+
+    Subclasses should implement the `transform` method and, if the number
+    of channels or the sampling frequency changes, the `get_output_channels`
+    or `get_output_freq` methods.
+
+    Note, that the stage output is written right after the raw data, so it
+    may lag behind the raw buffer by the block being processed. If the
+    stage raises an exception in the Streamer, it's disabled, and the
+    stages processing its output are skipped.
+
+    Parameters
+    ----------
+    source : Stage, optional
+        the stage whose output should be processed. By default, the raw
+        data is processed
+
+    Attributes
+    ----------
+    source
+    is_enabled
+    output : RingBuffer
+        the output buffer
+    nChannels : int
+        number of input channels
+    samplingFreq : float
+        input sampling frequency (Hz)
+    resolutions : None or ndarray
+        channel resolutions of the raw data (uV), set by the Client before
+        the initialization, if the stage processes the raw data
+
+    '''
+    def __init__(self, source=None):
+        self.logger = logging.getLogger('stage')
+        self.source = source
+        self.output = ringbuffer.RingBuffer()
+
+        self.nChannels = None
+        self.samplingFreq = None
+        self.resolutions = None
+
+        self.__disabled = RawValue(c.c_byte)
+
+    is_enabled = property(lambda self: not self.__disabled.value, None, None,
+                          'Whether the stage is enabled, read-only (bool)')
+
+    def disable(self):
+        '''
+        Disables the stage, e.g. after a failure. Its output is not
+        written anymore
+
+        '''
+        self.__disabled.value = 1
+
+    def initialize(self, nChannels, samplingFreq, bufSize, windowSize=1):
+        '''
+        Allocates the output buffer and the processing state
+
+        Parameters
+        ----------
+        nChannels : int
+            number of input channels
+        samplingFreq : float
+            input sampling frequency (Hz)
+        bufSize : int
+            output buffer capacity (in samples)
+        windowSize : int, optional
+            output buffer pocket size (in samples)
+
+        '''
+        self.nChannels = nChannels
+        self.samplingFreq = samplingFreq
+        self.output.initialize(self.get_output_channels(nChannels),
+                               bufSize, windowSize)
+
+    def get_output_channels(self, nChannels):
+        '''
+        Gets the number of output channels given the number of input ones
+
+        '''
+        return nChannels
+
+    def get_output_freq(self, samplingFreq):
+        '''
+        Gets the output sampling frequency given the input one
+
+        '''
+        return samplingFreq
+
+    def process(self, data):
+        '''
+        Processes a new data block and writes the result to the output
+        buffer
+
+        Parameters
+        ----------
+        data : ndarray
+            data block of shape (nSamples, nChannels)
+
+        Returns
+        -------
+        out : ndarray
+            processed block
+
+        '''
+        out = self.transform(data)
+        if len(out):
+            self.output.put_data(np.asarray(out, self.output.nptype))
+        return out
+
+    def transform(self, data):
+        '''
+        Processes a new data block. Should be implemented by the subclasses
+
+        Parameters
+        ----------
+        data : ndarray
+            data block of shape (nSamples, nChannels)
+
+        Returns
+        -------
+        out : ndarray
+            processed block
+
+        '''
+        raise NotImplementedError
+
+    def run(self, buf, position=None, timeout=1, sleep=5e-4):
+        '''
+        Processes the data from the given buffer in a loop, reading it with
+        a cursor. Can be used to run the stage in a helper process instead
+        of the Streamer. Returns, when there's no new data within timeout
+
+        Parameters
+        ----------
+        buf : RingBuffer
+            source buffer
+        position : int, optional
+            index of the first sample to process. By default, starts from
+            the current write position
+        timeout : float, optional
+            time to wait for the new data (seconds)
+        sleep : float, optional
+            time to wait until the next loop iteration
+
+        '''
+        cursor = ringbuffer.Cursor(buf, position)
+
+        while True:
+            data = cursor.read(timeout=timeout, sleep=sleep)
+            if not len(data):
+                return
+            self.process(data)
+
+
+class FilterStage(Stage):
+    '''
+    A temporal filter with a persistent per-channel state. The output buffer
+    shares the sample indexing with the input one.
+
+    The filter is given either as second-order sections (IIR) or as FIR
+    coefficients. SOS filtering uses scipy.signal if available, and a
+    vectorized numpy implementation otherwise (see `sosfilt`). The FIR
+    filtering is vectorized with numpy. The filter starts in the steady
+    state for the first sample, so there's no initial transient.
+
+    Parameters
+    ----------
+    sos : array_like, optional
+        second-order sections of shape (nSections, 6), each row is
+        [b0, b1, b2, a0, a1, a2] (see `scipy.signal.sosfilt`)
+    fir : array_like, optional
+        FIR filter coefficients
+    source : Stage, optional
+        the stage whose output should be filtered
+
+    '''
+    def __init__(self, sos=None, fir=None, source=None):
+        super(FilterStage, self).__init__(source)
+
+        if (sos is None) == (fir is None):
+            raise Exception('either sos or fir coefficients are required')
+
+        if sos is not None:
+            sos = np.atleast_2d(np.asarray(sos, dtype=float))
+            if sos.shape[1] != 6:
+                raise Exception('sos must be of shape (nSections, 6)')
+            # normalize the sections
+            sos = sos / sos[:, 3:4]
+        else:
+            fir = np.asarray(fir, dtype=float).ravel()
+
+        self.sos = sos
+        self.fir = fir
+        self.__zi = None
+
+    def initialize(self, nChannels, samplingFreq, bufSize, windowSize=1):
+        super(FilterStage, self).initialize(nChannels, samplingFreq,
+                                            bufSize, windowSize)
+        self.__zi = None
+
+    def transform(self, data):
+        data = np.asarray(data, dtype=float).reshape((len(data), -1))
+
+        if self.sos is not None:
+            if self.__zi is None:
+                self.__zi = self.__get_initial_state(data[0])
+            out, self.__zi = sosfilt(self.sos, data, self.__zi)
+        else:
+            if self.__zi is None:
+                self.__zi = np.zeros((len(self.fir) - 1, data.shape[1])) + data[0]
+            out, self.__zi = firfilt(self.fir, data, self.__zi)
+
+        return out
+
+    def __get_initial_state(self, x0):
+        '''
+        Gets the initial state corresponding to the steady state response
+        to the first sample (avoids the initial transient)
+
+        '''
+        zi = np.zeros((len(self.sos), 2, len(x0)))
+
+        # scale the step response state of every section by its input
+        scale = np.ones(len(x0)) * x0
+        for s, section in enumerate(self.sos):
+            b, a = section[:3], section[3:]
+            zi[s] = lfilter_zi(section)[:, np.newaxis] * scale
+            scale = scale * np.sum(b) / np.sum(a)
+        return zi
+
+
+class SpatialFilterStage(Stage):
+    '''
+    A spatial filter, applying an (nOutChannels x nInChannels) matrix to
+    every sample of a new block. The output buffer shares the sample
+    indexing with the input one.
+
+    The matrix is applied once per block with a single matrix product
+    into a preallocated scratch buffer. Sparse matrices (e.g. Laplacian
+    montages) are multiplied as such if scipy is available, through the
+    transposed scratch buffers. Since both
+    spatial and temporal filters are linear, the stage can be placed
+    before or after a `FilterStage` (`source` argument); placing it first
+    is cheaper when it reduces the number of channels. Note, that the
+    block returned by `process` is a view on the scratch buffer, valid
+    only until the next block is processed.
+
+    Parameters
+    ----------
+    matrix : array_like, sparse matrix or 'car'
+        filter matrix of shape (nOutChannels, nInChannels), or 'car' for
+        the common average reference (computed when initialized)
+    source : Stage, optional
+        the stage whose output should be filtered
+
+    See Also
+    --------
+    car_matrix, laplacian_matrix: matrix constructors
+
+    '''
+    def __init__(self, matrix, source=None):
+        super(SpatialFilterStage, self).__init__(source)
+
+        if isinstance(matrix, basestring):
+            if matrix != 'car':
+                raise Exception('unknown spatial filter: %s' % matrix)
+        elif sparse is not None and sparse.issparse(matrix):
+            matrix = matrix.tocsr()
+        else:
+            matrix = np.atleast_2d(np.asarray(matrix, dtype=float))
+
+        self.matrix = matrix
+        self.__m = None
+        self.__scratch = None
+        self.__scratchT = None
+        self.__kernel = None
+
+    def initialize(self, nChannels, samplingFreq, bufSize, windowSize=1):
+        if isinstance(self.matrix, basestring):
+            self.matrix = car_matrix(nChannels)
+
+        if self.matrix.shape[1] != nChannels:
+            raise Exception('the matrix must have %s columns' % nChannels)
+
+        super(SpatialFilterStage, self).initialize(nChannels, samplingFreq,
+                                                   bufSize, windowSize)
+
+        dtype = self.output.nptype
+        if sparse is not None and sparse.issparse(self.matrix):
+            self.__m = self.matrix.astype(dtype)
+        elif sparse is not None and np.mean(self.matrix != 0) < 0.1:
+            self.__m = sparse.csr_matrix(self.matrix, dtype=dtype)
+        else:
+            # transposed, so that the block is multiplied from the left
+            self.__m = np.ascontiguousarray(self.matrix.T, dtype=dtype)
+
+        self.__scratch = np.empty((0, self.matrix.shape[0]), dtype)
+
+        # the sparse product is computed on the transposed blocks (the
+        # samples are the vectors), stored as flat input and output buffers
+        self.__scratchT = (np.empty(0, dtype), np.empty(0, dtype))
+
+        # the kernel is private to scipy: check it against the public
+        # product, it's not used if its interface has changed
+        self.__kernel = None
+        if csr_matvecs is not None and sparse is not None and \
+           sparse.issparse(self.__m):
+            self.__kernel = csr_matvecs
+            probe = np.arange(3 * nChannels, dtype=dtype).reshape((3, -1))
+            expected = self.__m.dot(probe.T).T
+            result = np.empty_like(expected)
+            if self.__matvecs(probe, result) and \
+               not np.allclose(result, expected):
+                self.logger.warning('unexpected scipy CSR kernel output, ' \
+                                    'using the sparse product')
+                self.__kernel = None
+
+    def get_output_channels(self, nChannels):
+        if isinstance(self.matrix, basestring):
+            return nChannels
+        return self.matrix.shape[0]
+
+    def transform(self, data):
+        data = np.ascontiguousarray(np.reshape(data, (len(data), -1)),
+                                    self.output.nptype)
+
+        # grow the scratch buffer if needed
+        if len(self.__scratch) < len(data):
+            self.__scratch = np.empty((len(data), self.__scratch.shape[1]),
+                                      self.__scratch.dtype)
+
+        out = self.__scratch[:len(data)]
+        if sparse is None or not sparse.issparse(self.__m):
+            np.dot(data, self.__m, out=out)
+        elif self.__kernel is None or not self.__matvecs(data, out):
+            np.copyto(out, self.__m.dot(data.T).T)
+        return out
+
+    def __matvecs(self, data, out):
+        '''
+        Computes the sparse product into `out` with the scipy CSR kernel,
+        through the transposed scratch buffers. Returns False and stops
+        using the kernel, if it fails (e.g. its signature has changed)
+
+        '''
+        m = self.__m
+        xT, yT = self.__scratchT
+        if len(yT) < out.size:
+            xT = np.empty(data.size, xT.dtype)
+            yT = np.empty(out.size, yT.dtype)
+            self.__scratchT = (xT, yT)
+
+        xT, yT = xT[:data.size], yT[:out.size]
+        np.copyto(xT.reshape(data.shape[::-1]), data.T)
+        yT.fill(0)
+        try:
+            self.__kernel(m.shape[0], m.shape[1], len(data), m.indptr,
+                          m.indices, m.data, xT, yT)
+        except (TypeError, ValueError) as e:
+            self.logger.warning('scipy CSR kernel failed (%s), ' \
+                                'using the sparse product' % e)
+            self.__kernel = None
+            return False
+
+        np.copyto(out, yT.reshape(out.shape[::-1]).T)
+        return True
+
+
+class ResampleStage(Stage):
+    '''
+    A streaming rational resampler to a fixed target sampling frequency.
+
+    The input is resampled by the factor up/down (the target to input
+    frequency ratio, approximated by a fraction) with a polyphase FIR
+    filter: only the filter taps hitting the non-zero samples of the
+    upsampled signal are evaluated, and all the output samples of a block
+    are computed at once. The filter is a Kaiser-windowed sinc with the
+    cutoff at the lower of the two Nyquist frequencies. The input history
+    is carried between the blocks.
+
+    The filter delay is compensated, so the output sample m corresponds
+    to the (fractional) input sample m * down / up, i.e. both buffers
+    share the time origin (see `to_input_index` and `to_output_index`).
+    The output sample m is written as soon as the input samples up to
+    (m * down + delay) / up are available, where delay = halfTaps *
+    max(up, down) (in the upsampled samples).
+
+    Parameters
+    ----------
+    targetFreq : float
+        output sampling frequency (Hz)
+    halfTaps : int, optional
+        half length of the filter (in input samples), the longer filters
+        have the sharper cutoff and the longer delay
+    beta : float, optional
+        Kaiser window parameter
+    maxDenominator : int, optional
+        maximum denominator of the up/down ratio
+    source : Stage, optional
+        the stage whose output should be resampled
+
+    Attributes
+    ----------
+    up, down : int
+        resampling factors
+    filter : ndarray
+        FIR filter coefficients (at the upsampled rate)
+
+    '''
+    def __init__(self, targetFreq, halfTaps=10, beta=5., maxDenominator=1000,
+                 source=None):
+        super(ResampleStage, self).__init__(source)
+
+        self.targetFreq = float(targetFreq)
+        self.halfTaps = halfTaps
+        self.beta = beta
+        self.maxDenominator = maxDenominator
+
+        self.up = None
+        self.down = None
+        self.filter = None
+
+        self.__bank = None
+        self.__delay = None
+        self.__hist = None
+        self.__histStart = 0
+        self.__nIn = 0
+        self.__nOut = 0
+
+    def initialize(self, nChannels, samplingFreq, bufSize, windowSize=1):
+        ratio = Fraction(self.targetFreq / samplingFreq).limit_denominator(
+                                                            self.maxDenominator)
+        if ratio <= 0:
+            raise Exception('target frequency must be positive')
+        self.up, self.down = ratio.numerator, ratio.denominator
+
+        if float(ratio) != self.targetFreq / samplingFreq:
+            self.logger.warning('the resampling ratio is approximated as ' \
+                                '%s/%s' % (self.up, self.down))
+
+        # windowed sinc, the passband gain is up
+        up, down = self.up, self.down
+        n = 2 * self.halfTaps * max(up, down) + 1
+        t = np.arange(n) - (n - 1) / 2.
+        cutoff = 1. / max(up, down)
+        self.filter = cutoff * up * np.sinc(cutoff * t) * np.kaiser(n, self.beta)
+
+        # polyphase bank: bank[p, k] = filter[p + k*up]
+        nTaps = -(-n // up)
+        bank = np.zeros(nTaps * up)
+        bank[:n] = self.filter
+        self.__bank = bank.reshape((nTaps, up)).T.copy()
+        self.__delay = (n - 1) // 2
+
+        self.nChannels = nChannels
+        self.samplingFreq = samplingFreq
+        self.output.initialize(nChannels, max(bufSize * up // down, 1),
+                               max(windowSize * up // down, 1))
+
+        # zeros before the first sample
+        self.__hist = np.zeros((nTaps, nChannels))
+        self.__histStart = -nTaps
+        self.__nIn = 0
+        self.__nOut = 0
+
+    def get_output_freq(self, samplingFreq):
+        return self.targetFreq
+
+    def transform(self, data):
+        data = np.reshape(data, (len(data), -1))
+        hist = np.concatenate((self.__hist, data))
+        self.__nIn += len(data)
+
+        # the output samples, whose last input sample is available
+        up, down, delay = self.up, self.down, self.__delay
+        nOut = ((self.__nIn - 1) * up - delay) // down + 1
+        m = np.arange(self.__nOut, max(nOut, self.__nOut))
+
+        nTaps = self.__bank.shape[1]
+        last = (m * down + delay) // up
+        phase = (m * down + delay) - last * up
+
+        # gather the input samples of all the outputs: (out, taps, channels)
+        idx = last[:, np.newaxis] - np.arange(nTaps) - self.__histStart
+        out = np.einsum('mk,mkc->mc', self.__bank[phase], hist[idx])
+
+        self.__nOut += len(m)
+
+        # keep the samples needed by the next outputs
+        first = (self.__nOut * down + delay) // up - nTaps + 1
+        self.__hist = hist[first - self.__histStart:]
+        self.__histStart = first
+
+        return out
+
+    def to_input_index(self, outputIndex):
+        '''
+        Maps an output sample index to the (fractional) input sample index
+
+        '''
+        return np.asarray(outputIndex) * float(self.down) / self.up
+
+    def to_output_index(self, inputIndex):
+        '''
+        Maps an input sample index to the (fractional) output sample index
+
+        '''
+        return np.asarray(inputIndex) * float(self.up) / self.down
+
+
+def car_matrix(nChannels, channels=None):
+    '''
+    Gets a common average reference matrix
+
+    Parameters
+    ----------
+    nChannels : int
+        number of channels
+    channels : sequence of ints, optional
+        channels to compute the average from, by default all
+
+    Returns
+    -------
+    matrix : ndarray
+        matrix of shape (nChannels, nChannels)
+
+    '''
+    channels = np.arange(nChannels) if channels is None else np.asarray(channels)
+    matrix = np.eye(nChannels)
+    matrix[:, channels] -= 1. / len(channels)
+    return matrix
+
+def laplacian_matrix(names, neighbours):
+    '''
+    Gets a (small) Laplacian montage matrix: every channel of the montage
+    minus the average of its neighbours
+
+    Parameters
+    ----------
+    names : list of strings
+        input channel names (e.g. as configured in the recorder)
+    neighbours : dict
+        neighbour names of every output channel, e.g.
+        {'C3': ['FC3', 'CP3', 'C1', 'C5']}. The output channels are sorted
+        in the order of the input ones
+
+    Returns
+    -------
+    matrix : sparse matrix or ndarray
+        matrix of shape (len(neighbours), len(names)), sparse if scipy is
+        available
+
+    '''
+    centres = sorted(neighbours, key=names.index)
+    matrix = np.zeros((len(centres), len(names)))
+
+    for i, centre in enumerate(centres):
+        matrix[i, names.index(centre)] = 1
+        for name in neighbours[centre]:
+            matrix[i, names.index(name)] -= 1. / len(neighbours[centre])
+
+    if sparse is not None:
+        return sparse.csr_matrix(matrix)
+    return matrix
+
+
+def sosfilt(sos, x, zi):
+    '''
+    Filters the data along the first axis with a cascade of second-order
+    sections (transposed direct form II).
+
+    Without scipy, every section is applied to the chunks of up to
+    SOS_CHUNK samples in the state-space form: the output and the final
+    state of a chunk are linear in its input and initial state, so they
+    are computed with a few matrix products for all the channels at once
+
+    Parameters
+    ----------
+    sos : ndarray
+        normalized second-order sections of shape (nSections, 6)
+    x : ndarray
+        data of shape (nSamples, nChannels)
+    zi : ndarray
+        filter state of shape (nSections, 2, nChannels)
+
+    Returns
+    -------
+    y : ndarray
+        filtered data
+    zf : ndarray
+        final filter state
+
+    '''
+    if signal is not None:
+        return signal.sosfilt(sos, x, axis=0, zi=zi)
+
+    y = np.array(x, dtype=float)
+    zf = np.array(zi, dtype=float)
+    for s, section in enumerate(sos):
+        for i in xrange(0, len(y), SOS_CHUNK):
+            chunk = y[i:i + SOS_CHUNK]
+            H, O, F, G = _get_section_matrices(tuple(section), len(chunk))
+            out = np.dot(H, chunk) + np.dot(O, zf[s])
+            zf[s] = np.dot(F, zf[s]) + np.dot(G, chunk)
+            chunk[:] = out
+    return y, zf
+
+def _get_section_matrices(section, n):
+    '''
+    Gets the state-space matrices of a normalized second-order section for
+    a chunk of n samples: y = H x + O z, zf = F z + G x (cached)
+
+    '''
+    key = (section, n)
+    if key in _section_matrices:
+        return _section_matrices[key]
+
+    b0, b1, b2, a0, a1, a2 = section
+    A = np.array([[-a1, 1.], [-a2, 0.]])
+    B = np.array([b1 - a1 * b0, b2 - a2 * b0])
+
+    # powers of the state transition matrix
+    P = np.empty((n + 1, 2, 2))
+    P[0] = np.eye(2)
+    for k in xrange(n):
+        P[k + 1] = np.dot(A, P[k])
+
+    # impulse response: b0, then the first state component of A^(k-1) B
+    h = np.empty(n)
+    h[0] = b0
+    h[1:] = np.dot(P[:n - 1, 0], B)
+    lag = np.arange(n)[:, np.newaxis] - np.arange(n)
+
+    H = np.where(lag >= 0, h[np.maximum(lag, 0)], 0)
+    O = P[:n, 0]
+    F = P[n]
+    G = np.dot(P[n - 1::-1], B).T
+
+    _section_matrices[key] = H, O, F, G
+    return H, O, F, G
+
+def lfilter_zi(section):
+    '''
+    Gets the steady state of a normalized second-order section for a unit
+    step input (see `scipy.signal.lfilter_zi`). Zeros, if the section has
+    a pole at 1 (no steady state)
+
+    '''
+    b0, b1, b2, a0, a1, a2 = section
+    try:
+        return np.linalg.solve([[1 + a1, -1], [a2, 1]],
+                               [b1 - a1 * b0, b2 - a2 * b0])
+    except np.linalg.LinAlgError:
+        return np.zeros(2)
+
+def firfilt(b, x, zi):
+    '''
+    Filters the data along the first axis with an FIR filter
+
+    Parameters
+    ----------
+    b : ndarray
+        filter coefficients
+    x : ndarray
+        data of shape (nSamples, nChannels)
+    zi : ndarray
+        the last len(b) - 1 input samples of shape (len(b) - 1, nChannels)
+
+    Returns
+    -------
+    y : ndarray
+        filtered data
+    zf : ndarray
+        final filter state
+
+    '''
+    ext = np.concatenate((zi, x))
+    y = np.zeros(x.shape)
+    for k, bk in enumerate(b):
+        y += bk * ext[len(b) - 1 - k:len(ext) - k]
+    return y, ext[len(ext) - len(b) + 1:]